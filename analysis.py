@@ -1,36 +1,341 @@
-# Hides pygame welcome message
 import os
-os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"  # noqa: E402
-
 import json
-from pygame.math import Vector2
+import hashlib
 from configparser import ConfigParser
+from functools import cached_property
+from itertools import islice
 import math
 import logging
 import numpy as np
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import instrumentation
+from dataset import (CATEGORICAL, COLUMNAR_DATASET_DIR, DATASET_FILE, append_columns, is_columnar_dataset,
+                     iter_smoke_records, load_columns, records_to_columns, save_columns, secs_to_throw_time)
 
-logging.basicConfig(level=logging.INFO, filename='logs//analysis.log',
-                    filemode='w', format='%(name)s - %(levelname)s - %(message)s')
+# Save locations, relative to the repository root. Nothing is read or written when the module is imported.
+CONFIG_FILE = os.path.join("data", "config.ini")
+LOG_FILE = os.path.join("logs", "analysis.log")
+CONDENSED_DATASET_FILE = os.path.join("data", "condensed_dataset.json")
+DOORWAY_FILE = os.path.join("data", "mirage_entrances.json")
+COVERAGE_CACHE_DIR = os.path.join("data", "coverage_cache")
+CHUNK_SIZE = 10_000
 
-# Read config.ini file and defines save locations.
-CONFIG = ConfigParser()
-CONFIG.read("data\\config.ini")
-DATASET_FILE = "data\\dataset.json"
-CONDENSED_DATASET_FILE = "data\\condensed_dataset.json"
-DOORWAY_FILE = "data\\mirage_entrances.json"
+# Cached assignment and coverage results are recomputed if this changes, bump it when the geometry changes. Only the
+# most recently used entries are kept.
+COVERAGE_CACHE_VERSION = 1
+COVERAGE_CACHE_ENTRIES = 8
 
 # Retrieved from Valve developer wiki
 PLAYER_WIDTH = 32
+# Offset between the heights recorded in the doorway file and the landing height of a smoke in the doorway
+DOORWAY_Z_OFFSET = 64.093811
 UNIT_METER_CONVERSION = 0.01905
 
 
+def config_path(path):
+    """Converts a path from the config file, which may use Windows separators, to the current OS.
+    """
+    return os.path.normpath(path.replace("\\", "/"))
+
+
+class Settings():
+    """Analysis settings from the [Data] section of the config file. The file is only read when a setting is first
+    used, and any setting can be overridden by passing it as a keyword argument (e.g. Settings(smoke_radius=100)).
+    """
+    SETTINGS = {"smoke_radius": ("smoke_radius_units", None),
+                "detection_radius": ("detection_radius_units", None),
+                "height_tolerance": ("height_tolerance_units", None),
+                "map_workers": ("map_workers", 1),
+                "sweep_workers": ("sweep_workers", 1)}
+
+    def __init__(self, config_file=CONFIG_FILE, **overrides):
+        unknown = set(overrides) - set(self.SETTINGS)
+        if unknown:
+            raise TypeError(f"Unknown settings {sorted(unknown)}")
+        self.config_file = config_file
+        self.overrides = overrides
+
+    @cached_property
+    def config(self) -> ConfigParser:
+        config = ConfigParser()
+        if not config.read(self.config_file):
+            raise FileNotFoundError(f"Config file [{self.config_file}] not found")
+        return config
+
+    def _setting(self, name):
+        if name in self.overrides:
+            return self.overrides[name]
+        key, fallback = self.SETTINGS[name]
+        if fallback is None:
+            return self.config.getint("Data", key)
+        return self.config.getint("Data", key, fallback=fallback)
+
+    @cached_property
+    def smoke_radius(self) -> int:
+        return self._setting("smoke_radius")
+
+    @cached_property
+    def detection_radius(self) -> int:
+        return self._setting("detection_radius")
+
+    @cached_property
+    def height_tolerance(self) -> int:
+        return self._setting("height_tolerance")
+
+    @cached_property
+    def map_workers(self) -> int:
+        return self._setting("map_workers")
+
+    @cached_property
+    def sweep_workers(self) -> int:
+        return self._setting("sweep_workers")
+
+
+# Settings used whenever a function isn't given an explicit value, replace to use a different config file
+SETTINGS = Settings()
+
+
+def configure_logging(path=LOG_FILE, level=logging.INFO):
+    """Writes the analysis log to a file, creating its directory. Not done on import so that importing the module
+    (e.g. in a worker process or the notebook) has no side effects.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    logging.basicConfig(level=level, filename=path, filemode='w', format='%(name)s - %(levelname)s - %(message)s')
+
+
+class Vector2():
+    """Minimal 2D vector with the parts of the pygame.math.Vector2 interface used by the analysis.
+    """
+    __slots__ = ("x", "y")
+
+    def __init__(self, x, y):
+        self.x = float(x)
+        self.y = float(y)
+
+    def __add__(self, other):
+        return Vector2(self.x + other.x, self.y + other.y)
+
+    def __sub__(self, other):
+        return Vector2(self.x - other.x, self.y - other.y)
+
+    def __mul__(self, scalar):
+        return Vector2(self.x * scalar, self.y * scalar)
+
+    __rmul__ = __mul__
+
+    def __eq__(self, other):
+        return isinstance(other, Vector2) and self.x == other.x and self.y == other.y
+
+    def __iter__(self):
+        return iter((self.x, self.y))
+
+    def __repr__(self):
+        return f"Vector2({self.x}, {self.y})"
+
+    def dot(self, other) -> float:
+        return self.x * other.x + self.y * other.y
+
+    def distance_to(self, other) -> float:
+        dx = self.x - other.x
+        dy = self.y - other.y
+        return math.sqrt(dx * dx + dy * dy)
+
+
 def point_within_circle(point: Vector2, circle_centre: Vector2, radius: int) -> bool:
     """Checks if a point is located within a circles area.
     """
     return (point.x - circle_centre.x)**2 + (point.y - circle_centre.y)**2 < radius**2
 
 
+def _coverage_kernel(cx, cy, x1, y1, x2, y2, radius):
+    """Vectorised form of Smoke.calculate_coverage(). All arguments are arrays (or scalars) which are broadcast
+    against each other, each of the six cases is resolved with a mask rather than a branch. The arithmetic is
+    performed in the same order as the per-object version so the results are identical.
+
+    Returns the percentage coverage and the case number (1-6) for every smoke/doorway pair.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Case 1: Checks if both coordinates are within the circle
+        d1_in_smoke = (x1 - cx)**2 + (y1 - cy)**2 < radius**2
+        d2_in_smoke = (x2 - cx)**2 + (y2 - cy)**2 < radius**2
+
+        # Coefficients of the quadratic equation (Formulas 5.7-5.10)
+        vx = x2 - x1
+        vy = y2 - y1
+        a = vx * vx + vy * vy
+        b = 2 * (vx * (x1 - cx) + vy * (y1 - cy))
+        c = (x1 * x1 + y1 * y1) + (cx * cx + cy * cy) - 2 * (x1 * cx + y1 * cy) - radius**2
+
+        # Case 2: Negative discriminant, no collision
+        disc = b**2 - 4 * a * c
+        no_collision = disc < 0
+
+        sqrt_disc = np.sqrt(np.where(no_collision, 0, disc))
+        t1 = (-b + sqrt_disc) / (2 * a)
+        t2 = (-b - sqrt_disc) / (2 * a)
+        t1_on_doorway = (0 <= t1) & (t1 <= 1)
+        t2_on_doorway = (0 <= t2) & (t2 <= 1)
+
+        # Case 3: Neither solution is on the doorway segment. Case 4: Doorway is a tangent to the smoke
+        outside_segment = ~(t1_on_doorway | t2_on_doorway)
+        tangent = t1 == t2
+
+        # Case 5: Points of intersection on both sides of the smoke
+        p1x, p1y = x1 + t1 * vx, y1 + t1 * vy
+        p2x, p2y = x1 + t2 * vx, y1 + t2 * vy
+
+        # Case 6: Replace the hypothetical intersection with the doorway coordinate inside the smoke
+        inside_x = np.where(d1_in_smoke, x1, x2)
+        inside_y = np.where(d1_in_smoke, y1, y2)
+        clamp_p2 = t1_on_doorway & ~t2_on_doorway
+        clamp_p1 = ~t1_on_doorway & t2_on_doorway
+        p2x, p2y = np.where(clamp_p2, inside_x, p2x), np.where(clamp_p2, inside_y, p2y)
+        p1x, p1y = np.where(clamp_p1, inside_x, p1x), np.where(clamp_p1, inside_y, p1y)
+
+        coverage_in_units = np.sqrt((p1x - p2x) * (p1x - p2x) + (p1y - p2y) * (p1y - p2y))
+        length = np.sqrt((x1 - x2) * (x1 - x2) + (y1 - y2) * (y1 - y2))
+        partial = (coverage_in_units / length) * 100
+
+    fully_covered = d1_in_smoke & d2_in_smoke
+    conditions = [fully_covered, no_collision, outside_segment, tangent, clamp_p1 | clamp_p2]
+    coverage = np.select(conditions, [100.0, 0.0, 0.0, 0.0, partial], default=partial)
+    cases = np.select(conditions, [1, 2, 3, 4, 6], default=5)
+    return coverage, cases
+
+
+def doorway_segments(doorways) -> np.ndarray:
+    """Converts a list of doorways into an (M, 4) array of their (x1, y1, x2, y2) coordinates.
+    """
+    return np.array([[d.vector1.x, d.vector1.y, d.vector2.x, d.vector2.y] for d in doorways],
+                    dtype=np.float64).reshape(-1, 4)
+
+
+def coverage_matrix(centres, segments, radius, return_cases=False):
+    """Calculates the percentage coverage of every smoke against every doorway in one vectorised pass.
+
+    centres is an (N, 2) array of smoke (x, y) coordinates and segments an (M, 4) array of doorway
+    (x1, y1, x2, y2) coordinates, the result is an (N, M) array.
+    """
+    centres = np.asarray(centres, dtype=np.float64).reshape(-1, 2)
+    segments = np.asarray(segments, dtype=np.float64).reshape(-1, 4)
+    radius = np.asarray(radius, dtype=np.float64)
+    if radius.ndim == 1:
+        radius = radius[:, None]
+
+    coverage, cases = _coverage_kernel(centres[:, 0, None], centres[:, 1, None],
+                                       segments[None, :, 0], segments[None, :, 1],
+                                       segments[None, :, 2], segments[None, :, 3], radius)
+    return (coverage, cases) if return_cases else coverage
+
+
+def paired_coverage(centres, segments, radius, return_cases=False):
+    """Calculates the percentage coverage of the nth smoke against the nth doorway segment.
+
+    centres is an (N, 2) array and segments an (N, 4) array, the result is an (N,) array.
+    """
+    centres = np.asarray(centres, dtype=np.float64).reshape(-1, 2)
+    segments = np.asarray(segments, dtype=np.float64).reshape(-1, 4)
+    radius = np.asarray(radius, dtype=np.float64)
+
+    coverage, cases = _coverage_kernel(centres[:, 0], centres[:, 1], segments[:, 0], segments[:, 1],
+                                       segments[:, 2], segments[:, 3], radius)
+    return (coverage, cases) if return_cases else coverage
+
+
+@instrumentation.timed("analysis.calculate_coverages")
+def calculate_coverages(smokes):
+    """Calculates the coverage for a list of smokes against their assigned doorways using the vectorised engine.
+    Equivalent to calling Smoke.calculate_coverage() on each smoke.
+    """
+    if len(smokes) == 0:
+        return
+    centres = np.array([(smoke.vector.x, smoke.vector.y) for smoke in smokes], dtype=np.float64)
+    segments = doorway_segments([smoke.doorway for smoke in smokes])
+    radii = np.array([smoke.radius for smoke in smokes], dtype=np.float64)
+
+    coverages, cases = paired_coverage(centres, segments, radii, return_cases=True)
+    for smoke, coverage in zip(smokes, coverages):
+        smoke.coverage = float(coverage)
+    if _DIAGNOSTICS is not None:
+        _DIAGNOSTICS.record_cases(cases, smokes)
+
+
+class Diagnostics():
+    """Opt-in counters and sampled traces for the doorway assignment and coverage hot paths, which otherwise do no
+    per-smoke logging. While active (as a context manager) every assignment, doorway range check and coverage case
+    is counted, and the first and then every sample_every-th event of each kind is logged at DEBUG level with lazy
+    formatting. Only events in the current process are recorded.
+    """
+    CASES = {1: "fully covered", 2: "no collision", 3: "no collision (would if doorway extended)", 4: "tangent",
+             5: "gaps on both sides", 6: "gap on one side"}
+
+    def __init__(self, sample_every=1000, logger=None):
+        self.sample_every = sample_every
+        self.logger = logger or logging.getLogger("analysis.diagnostics")
+        self.assignments = Counter()
+        self.range_checks = Counter()
+        self.cases = Counter()
+        self._previous = None
+
+    def __enter__(self):
+        global _DIAGNOSTICS
+        self._previous, _DIAGNOSTICS = _DIAGNOSTICS, self
+        return self
+
+    def __exit__(self, *exc_info):
+        global _DIAGNOSTICS
+        _DIAGNOSTICS = self._previous
+
+    def _sampled(self, count):
+        return self.sample_every > 0 and (count - 1) % self.sample_every == 0
+
+    def record_assignment(self, smoke, doorways):
+        kind = "none" if len(doorways) == 0 else "single" if len(doorways) == 1 else "multiple"
+        self.assignments[kind] += 1
+        if self._sampled(self.assignments[kind]):
+            self.logger.debug("%s in range of %d doorways: %s", smoke, len(doorways),
+                              [doorway.name for doorway in doorways])
+
+    def record_range_check(self, smoke, doorway, in_radius, in_range):
+        outcome = "in range" if in_range else "outside height tolerance" if in_radius else "outside target radius"
+        self.range_checks[outcome] += 1
+        if self._sampled(self.range_checks[outcome]):
+            self.logger.debug("%s %s of %s", smoke, outcome, doorway.name)
+
+    def record_case(self, case, smoke, **details):
+        self.cases[case] += 1
+        if self._sampled(self.cases[case]):
+            self.logger.debug("Case %d (%s) for %s - %s: coverage=%s %s", case, self.CASES[case], smoke,
+                              smoke.doorway, smoke.coverage, details)
+
+    def record_cases(self, cases, smokes):
+        """Counts the cases returned by the vectorised coverage engine for a list of smokes.
+        """
+        for case in np.unique(cases).tolist():
+            rows = np.flatnonzero(cases == case)
+            before = self.cases[case]
+            self.cases[case] += len(rows)
+            if self.sample_every > 0:
+                for row in rows[(before + np.arange(len(rows))) % self.sample_every == 0]:
+                    self.logger.debug("Case %d (%s) for %s - %s: coverage=%s", case, self.CASES[case], smokes[row],
+                                      smokes[row].doorway, smokes[row].coverage)
+
+    def summary(self):
+        return {"assignments": dict(self.assignments),
+                "range_checks": dict(self.range_checks),
+                "coverage_cases": {self.CASES[case]: self.cases[case] for case in self.CASES}}
+
+
+# Active Diagnostics, None unless diagnostics have been opted in to
+_DIAGNOSTICS = None
+
+
 class Smoke():
+    __slots__ = ("demo_id", "thrower", "team", "side", "round_num", "time_thrown", "round_won",
+                 "vector", "z", "radius", "doorway", "coverage")
+
     def __init__(self, demo_id, thrower, team, side, round_num, time_thrown, round_won, x, y, z):
         self.demo_id = demo_id
         self.thrower = thrower
@@ -42,7 +347,7 @@ class Smoke():
 
         self.vector = Vector2(x, y)
         self.z = z
-        self.radius = int(CONFIG["Data"]["smoke_radius_units"])
+        self.radius = SETTINGS.smoke_radius
 
         self.doorway = None
         self.coverage = None
@@ -70,30 +375,44 @@ class Smoke():
     def calculate_coverage(self):
         """Calculates the percentage coverage for the smoke and its assigned doorway.
         """
-        logging.info(f"Calculating Coverage for {self} - {self.doorway}")
+        doorway = self.doorway
+        centre = self.vector
+        cx, cy = centre.x, centre.y
+        r = self.radius
+
+        # Smokes centred outside the doorway's bounding box expanded by the radius can't cover it. Diagnostics need
+        # to know which case applies, so they always take the full calculation.
+        if _DIAGNOSTICS is None and not doorway.may_cover(cx, cy, r):
+            self.coverage = 0
+            return
 
         # Case 1: Checks if both coordinates are within the circle
-        d1_in_smoke = self.doorway_coord_in_smoke(self.doorway.vector1)
-        d2_in_smoke = self.doorway_coord_in_smoke(self.doorway.vector2)
+        x1, y1 = doorway.vector1.x, doorway.vector1.y
+        dx1, dy1 = x1 - cx, y1 - cy
+        dx2, dy2 = doorway.vector2.x - cx, doorway.vector2.y - cy
+        r_sq = r * r
+        d1_in_smoke = dx1 * dx1 + dy1 * dy1 < r_sq
+        d2_in_smoke = dx2 * dx2 + dy2 * dy2 < r_sq
         if d1_in_smoke and d2_in_smoke:
             self.coverage = 100
-            logging.info(f"Doorway entirely within smoke - {self.coverage=}")
+            if _DIAGNOSTICS is not None:
+                _DIAGNOSTICS.record_case(1, self)
             return
 
         # Defining the quadratic equation shown by Formulas 5.7-5.10 under '5.5.3 Calculating Coverage'
-        # Coefficients
-        V = self.doorway.vector2-self.doorway.vector1
-        a = V.dot(V)
-        b = 2 * V.dot(self.doorway.vector1 - self.vector)
-        c = self.doorway.vector1.dot(self.doorway.vector1) + self.vector.dot(self.vector) - \
-            2 * self.doorway.vector1.dot(self.vector) - self.radius**2
+        # Coefficients, a and the vector1.vector1 term of c only depend on the doorway so are precomputed
+        vx, vy = doorway.direction.x, doorway.direction.y
+        a = doorway.length_sq
+        b = 2 * (vx * dx1 + vy * dy1)
+        c = doorway.vector1_sq + (cx * cx + cy * cy) - 2 * (x1 * cx + y1 * cy) - r_sq
 
         # Discriminant
         # Case 2: If the discriminant is less than 0 there is no collision
-        disc = b**2 - 4 * a * c
+        disc = b * b - 4 * a * c
         if disc < 0:
             self.coverage = 0
-            logging.info(f"Smoke doesn't intersect doorway - {self.coverage=}")
+            if _DIAGNOSTICS is not None:
+                _DIAGNOSTICS.record_case(2, self)
             return
 
         sqrt_disc = math.sqrt(disc)
@@ -103,54 +422,277 @@ class Smoke():
         # If either solution for t is is not between 0 and 1, no collision - Case 3
         if not (0 <= t1 <= 1 or 0 <= t2 <= 1):
             self.coverage = 0
-            logging.info(
-                f"Smoke does not intersect the doorway at any point (would if doorway extended)")
+            if _DIAGNOSTICS is not None:
+                _DIAGNOSTICS.record_case(3, self)
             return
 
         # Case 4: If both solutions are equal, doorway is a tangent to the smoke
         elif t1 == t2:
             self.coverage = 0
-            logging.info(
-                f"Doorway is at a tangent to the smoke grenade - {self.coverage=}")
+            if _DIAGNOSTICS is not None:
+                _DIAGNOSTICS.record_case(4, self)
             return
 
         # Points of intersection
         # Case 5: There is a gap on both sides of the smoke so the coverage is the distance between the
         # intersection points
-        point_1 = self.doorway.vector1 + t1 * V
-        point_2 = self.doorway.vector1 + t2 * V
+        point_1 = (x1 + t1 * vx, y1 + t1 * vy)
+        point_2 = (x1 + t2 * vx, y1 + t2 * vy)
 
         # Case 6: One of the solutions for t is not between 0 and 1 meaning its a hypothetical intersection
         # if the doorway was extended to the other side of the circle. Therefore replace it with
         # the doorway coordinate that is inside the smoke.
+        case = 5
         if 0 <= t1 <= 1 and not 0 <= t2 <= 1:
-            point_2 = self.doorway.vector1 if d1_in_smoke else self.doorway.vector2
+            point_2 = tuple(doorway.vector1 if d1_in_smoke else doorway.vector2)
+            case = 6
         elif not 0 <= t1 <= 1 and 0 <= t2 <= 1:
-            point_1 = self.doorway.vector1 if d1_in_smoke else self.doorway.vector2
+            point_1 = tuple(doorway.vector1 if d1_in_smoke else doorway.vector2)
+            case = 6
 
         # Calculate the coverage in units for the smoke and percentage
-        coverage_in_units = point_1.distance_to(point_2)
-        self.coverage = (coverage_in_units / self.doorway.length) * 100
+        dx, dy = point_1[0] - point_2[0], point_1[1] - point_2[1]
+        coverage_in_units = math.sqrt(dx * dx + dy * dy)
+        self.coverage = (coverage_in_units / doorway.length) * 100
+        if _DIAGNOSTICS is not None:
+            _DIAGNOSTICS.record_case(case, self, point_1=point_1, point_2=point_2, t1=t1, t2=t2)
+
+
+class SmokeRow():
+    """Lightweight view of a single row in a SmokeTable. Exposes the same attributes and methods as a Smoke object,
+    reading from (and writing doorway/coverage to) the table's columns.
+    """
+    __slots__ = ("table", "index")
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __eq__(self, other):
+        return isinstance(other, SmokeRow) and self.table is other.table and self.index == other.index
+
+    def __hash__(self):
+        return hash((id(self.table), self.index))
+
+    def _category(self, column):
+        return self.table.categories[column][self.table.codes[column][self.index]]
+
+    @property
+    def demo_id(self):
+        return self._category("demo_id")
+
+    @property
+    def thrower(self):
+        return self._category("thrower")
+
+    @property
+    def team(self):
+        return self._category("team")
+
+    @property
+    def side(self):
+        return self._category("side")
 
-        logging.debug("Points of intersection:")
-        logging.debug(f"Point 1: {point_1} t1: {t1}")
-        logging.debug(f"Point 2: {point_2} t2: {t2}")
-        logging.debug(f"Coverage in units: {coverage_in_units}")
+    @property
+    def round_num(self):
+        return int(self.table.round_num[self.index])
 
-        logging.info(f"Doorway partially covered - {self.coverage=}")
+    @property
+    def time_thrown(self):
+        return secs_to_throw_time(int(self.table.throw_time[self.index]))
+
+    @property
+    def round_won(self):
+        return bool(self.table.round_won[self.index])
+
+    @property
+    def vector(self):
+        return Vector2(self.table.x[self.index], self.table.y[self.index])
+
+    @property
+    def z(self):
+        return float(self.table.z[self.index])
+
+    @property
+    def radius(self):
+        return self.table.radius
+
+    @property
+    def doorway(self):
+        return self.table.doorway[self.index]
+
+    @doorway.setter
+    def doorway(self, doorway):
+        self.table.doorway[self.index] = doorway
+
+    @property
+    def coverage(self):
+        coverage = self.table.coverage[self.index]
+        return None if np.isnan(coverage) else float(coverage)
+
+    @coverage.setter
+    def coverage(self, coverage):
+        self.table.coverage[self.index] = np.nan if coverage is None else coverage
+
+    __str__ = Smoke.__str__
+    in_game_draw_command = Smoke.in_game_draw_command
+    doorway_coord_in_smoke = Smoke.doorway_coord_in_smoke
+    distance_from_midpoint = Smoke.distance_from_midpoint
+    calculate_coverage = Smoke.calculate_coverage
+
+
+class SmokeTable():
+    """Columnar (struct-of-arrays) storage for a set of smokes. Coordinates are stored as NumPy arrays, the thrower,
+    team, side and demo ID as integer codes into a list of categories and the round number and throw time (in
+    seconds) as integers. Indexing or iterating the table gives SmokeRow views which behave like Smoke objects.
+    """
+    CATEGORICAL = CATEGORICAL
+
+    def __init__(self, x, y, z, round_num, throw_time, round_won, codes, categories, radius=None):
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.z = np.asarray(z, dtype=np.float64)
+        self.round_num = np.asarray(round_num, dtype=np.int16)
+        self.throw_time = np.asarray(throw_time, dtype=np.int16)
+        self.round_won = np.asarray(round_won, dtype=np.bool_)
+        self.codes = {column: np.asarray(codes[column], dtype=np.int32) for column in self.CATEGORICAL}
+        self.categories = {column: list(categories[column]) for column in self.CATEGORICAL}
+        self.radius = SETTINGS.smoke_radius if radius is None else radius
+
+        self.doorway = np.full(len(self.x), None, dtype=object)
+        self.coverage = np.full(len(self.x), np.nan)
+
+    @classmethod
+    def from_records(cls, records, radius=None):
+        """Builds a table from an iterable of dataset.json style smoke dictionaries.
+        """
+        records = records if isinstance(records, list) else list(records)
+        return cls.from_columns(*records_to_columns(records), radius)
+
+    @classmethod
+    def from_columns(cls, columns, codes, categories, radius=None):
+        """Builds a table from the column arrays used by the columnar dataset format.
+        """
+        return cls(columns["x"], columns["y"], columns["z"], columns["round_num"], columns["throw_time"],
+                   columns["round_won"], codes, categories, radius)
+
+    @classmethod
+    def load(cls, path=COLUMNAR_DATASET_DIR, mmap=False, radius=None):
+        """Loads a table from a columnar dataset directory, optionally memory-mapping the columns.
+        """
+        return cls.from_columns(*load_columns(path, mmap), radius)
+
+    def save(self, path=COLUMNAR_DATASET_DIR):
+        """Writes the table to a columnar dataset directory. Assigned doorways and coverages are not saved.
+        """
+        save_columns(path, self._numeric_columns(), self.codes, self.categories)
+
+    def append_to(self, path=COLUMNAR_DATASET_DIR):
+        """Appends the table's rows to an existing columnar dataset directory in place, only writing the new rows.
+        Assigned doorways and coverages are not saved.
+        """
+        append_columns(path, self._numeric_columns(), self.codes, self.categories)
+
+    def _numeric_columns(self):
+        return {"x": self.x, "y": self.y, "z": self.z, "round_num": self.round_num, "throw_time": self.throw_time,
+                "round_won": self.round_won}
+
+    @classmethod
+    def concatenate(cls, tables, radius=None):
+        """Joins several tables into one, merging their categories and remapping the codes. Assigned doorways and
+        coverages are carried over.
+        """
+        tables = list(tables)
+        if len(tables) == 0:
+            return cls.from_records([], radius)
+
+        lookups = {column: {} for column in cls.CATEGORICAL}
+        codes = {column: [] for column in cls.CATEGORICAL}
+        for table in tables:
+            for column in cls.CATEGORICAL:
+                lookup = lookups[column]
+                remap = np.array([lookup.setdefault(value, len(lookup)) for value in table.categories[column]],
+                                 dtype=np.int32)
+                codes[column].append(remap[table.codes[column]])
+
+        def join(column):
+            return np.concatenate([getattr(table, column) for table in tables])
+
+        joined = cls(join("x"), join("y"), join("z"), join("round_num"), join("throw_time"), join("round_won"),
+                     {column: np.concatenate(codes[column]) for column in cls.CATEGORICAL},
+                     {column: list(lookups[column]) for column in cls.CATEGORICAL}, radius)
+        joined.doorway = join("doorway")
+        joined.coverage = join("coverage")
+        return joined
+
+    def subset(self, selection):
+        """Returns a new table containing the rows picked out by a boolean mask, index array or slice. Categories
+        are shared with this table.
+        """
+        table = SmokeTable(self.x[selection], self.y[selection], self.z[selection], self.round_num[selection],
+                           self.throw_time[selection], self.round_won[selection],
+                           {column: codes[selection] for column, codes in self.codes.items()},
+                           self.categories, self.radius)
+        table.doorway = self.doorway[selection]
+        table.coverage = self.coverage[selection]
+        return table
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("SmokeTable index out of range")
+        return SmokeRow(self, index)
+
+    def __iter__(self):
+        return (SmokeRow(self, i) for i in range(len(self)))
+
+    @property
+    def centres(self) -> np.ndarray:
+        """(N, 2) array of the smoke (x, y) coordinates.
+        """
+        return np.column_stack((self.x, self.y))
+
+    def column(self, name) -> np.ndarray:
+        """Returns a categorical column decoded back into its values.
+        """
+        return np.asarray(self.categories[name], dtype=object)[self.codes[name]]
+
+    def mask(self, where) -> np.ndarray:
+        """Boolean mask of the smokes matching every key in where, as in CoverageStats. Keys are categorical columns
+        or round_num, each mapping to a value or a list/set of values.
+        """
+        mask = np.ones(len(self), dtype=np.bool_)
+        for key, values in where.items():
+            if isinstance(values, str) or not hasattr(values, "__iter__"):
+                values = [values]
+            if key == "round_num":
+                mask &= np.isin(self.round_num, list(values))
+                continue
+            lookup = {value: code for code, value in enumerate(self.categories[key])}
+            mask &= np.isin(self.codes[key], [lookup[value] for value in values if value in lookup])
+        return mask
+
+    def to_smokes(self):
+        """Converts the table into a list of independent Smoke objects.
+        """
+        return [Smoke(row.demo_id, row.thrower, row.team, row.side, row.round_num, row.time_thrown,
+                      row.round_won, float(self.x[i]), float(self.y[i]), row.z) for i, row in enumerate(self)]
 
 
 class Doorway():
-    def __init__(self, name, x1, y1, x2, y2, z, adjust_pw=True):
+    def __init__(self, name, x1, y1, x2, y2, z, adjust_pw=True, target_radius=None, z_tolerance=None):
         self.name = name
         self.z = z
 
         # Adds (or minuses) half a player width to each of the doorway coordinates
         if adjust_pw:
-            dx = ((x2 - x1) / (math.sqrt((x2 - x1)**2 + (y2 - y1)**2))) * \
-                (PLAYER_WIDTH / 2)
-            dy = ((y2 - y1) / (math.sqrt((x2 - x1)**2 + (y2 - y1)**2))) * \
-                (PLAYER_WIDTH / 2)
+            unit_length = math.sqrt((x2 - x1)**2 + (y2 - y1)**2)
+            dx = ((x2 - x1) / unit_length) * (PLAYER_WIDTH / 2)
+            dy = ((y2 - y1) / unit_length) * (PLAYER_WIDTH / 2)
             self.vector1 = Vector2(x1-dx, y1-dy)
             self.vector2 = Vector2(x2+dx, y2+dy)
         else:
@@ -158,14 +700,48 @@ class Doorway():
             self.vector2 = Vector2(x2, y2)
 
         self.midpoint = Vector2((x1 + x2) / 2, (y1 + y2) / 2)
-        self.target_radius = int(CONFIG["Data"]["detection_radius_units"])
-        self.z_tolerance = int(CONFIG["Data"]["height_tolerance_units"])
+        self.target_radius = SETTINGS.detection_radius if target_radius is None else target_radius
+        self.z_tolerance = SETTINGS.height_tolerance if z_tolerance is None else z_tolerance
         self.smokes = []
         self.length = self.vector1.distance_to(self.vector2)
 
+        # Constants used for every smoke checked against the doorway, see Smoke.calculate_coverage() and
+        # smoke_in_target_range(). They aren't updated if the attributes above are changed.
+        self.direction = self.vector2 - self.vector1
+        self.length_sq = self.direction.dot(self.direction)
+        self.vector1_sq = self.vector1.dot(self.vector1)
+        self.target_radius_sq = self.target_radius**2
+        self.z_min = self.z - self.z_tolerance
+        self.z_max = self.z + self.z_tolerance
+        self.bounds = (min(self.vector1.x, self.vector2.x), min(self.vector1.y, self.vector2.y),
+                       max(self.vector1.x, self.vector2.x), max(self.vector1.y, self.vector2.y))
+        self._expanded_bounds = {}
+
     def __str__(self):
         return f"Doorway({self.name.capitalize()})"
 
+    def expanded_bounds(self, radius):
+        """Bounding box (x_min, y_min, x_max, y_max) of the doorway expanded by a smoke radius, cached per radius.
+        """
+        bounds = self._expanded_bounds.get(radius)
+        if bounds is None:
+            x_min, y_min, x_max, y_max = self.bounds
+            bounds = self._expanded_bounds[radius] = (x_min - radius, y_min - radius, x_max + radius, y_max + radius)
+        return bounds
+
+    def may_cover(self, x, y, radius):
+        """Fast rejection test for the coverage calculation, False if a smoke centred at (x, y) can't cover any of
+        the doorway.
+        """
+        x_min, y_min, x_max, y_max = self.expanded_bounds(radius)
+        return x_min <= x <= x_max and y_min <= y <= y_max
+
+    def midpoint_distance_sq(self, x, y):
+        """Squared distance from a point to the doorway midpoint, for comparing distances without a square root.
+        """
+        dx, dy = x - self.midpoint.x, y - self.midpoint.y
+        return dx * dx + dy * dy
+
     def in_game_draw_command(self):
         """Generates a command that can be passed into the CS:GO developer console to draw two crosses in-game to show
         the doorway location.
@@ -178,19 +754,12 @@ class Doorway():
         """Checks if a smoke is within the target radius of the doorway. Target radius and z tolerance values are
         provided in the configuration file.
         """
-        logging.debug(f"Checking if {smoke} in range of {self.name}")
-
-        if point_within_circle(smoke.vector, self.midpoint, self.target_radius):
-            if smoke.z >= self.z - self.z_tolerance and smoke.z <= self.z + self.z_tolerance:
-                logging.debug("Smoke in target radius and height tolerance")
-                return True
-            else:
-                logging.debug(
-                    "Smoke in target radius and but NOT height tolerance skipping...")
-
-        else:
-            logging.debug("Smoke NOT within target radius, skipping...")
-        return False
+        centre = smoke.vector
+        in_radius = self.midpoint_distance_sq(centre.x, centre.y) < self.target_radius_sq
+        in_range = in_radius and self.z_min <= smoke.z <= self.z_max
+        if _DIAGNOSTICS is not None:
+            _DIAGNOSTICS.record_range_check(smoke, self, in_radius, in_range)
+        return in_range
 
     def coverage_stats(self):
         """Provides basic statistics about the coverage for the smokes assigned to the doorway.
@@ -199,13 +768,115 @@ class Doorway():
         return {"min": np.min(coverage_vals),
                 "mean": np.mean(coverage_vals),
                 "median": np.median(coverage_vals),
-                "max": np.mean(coverage_vals)}
+                "max": np.max(coverage_vals)}
+
+
+class DoorwayIndex():
+    """Uniform grid spatial index over the doorway midpoints. The cell size is at least the largest target radius,
+    so any doorway whose detection area contains a smoke is in the smoke's cell or one of its 8 neighbours.
+    """
+
+    def __init__(self, doorways, cell_size=None):
+        self.doorways = list(doorways)
+        self.cell_size = cell_size or max([d.target_radius for d in self.doorways], default=1)
+        self.cells = {}
+        for i, doorway in enumerate(self.doorways):
+            self.cells.setdefault(self._cell(doorway.midpoint.x, doorway.midpoint.y), []).append(i)
+
+    def _cell(self, x, y):
+        return (math.floor(x / self.cell_size), math.floor(y / self.cell_size))
+
+    def candidates(self, x, y):
+        """Returns the indexes of the doorways in the 3x3 block of cells around a point, in their original order.
+        """
+        cx, cy = self._cell(x, y)
+        indexes = []
+        for i in (cx - 1, cx, cx + 1):
+            for j in (cy - 1, cy, cy + 1):
+                indexes.extend(self.cells.get((i, j), ()))
+        indexes.sort()
+        return indexes
+
+    def doorways_in_range(self, smoke):
+        """Returns the doorways whose target radius and height tolerance contain the smoke. Equivalent to calling
+        Doorway.smoke_in_target_range() on every doorway, but only the nearby candidates are checked.
+        """
+        in_range = []
+        centre = smoke.vector
+        x, y, z = centre.x, centre.y, smoke.z
+        for i in self.candidates(x, y):
+            doorway = self.doorways[i]
+            # Height tolerance band is checked first as a cheap secondary filter
+            if not doorway.z_min <= z <= doorway.z_max:
+                continue
+            if doorway.midpoint_distance_sq(x, y) < doorway.target_radius_sq:
+                in_range.append(doorway)
+        return in_range
+
+
+class DoorwayGeometry():
+    """Precomputed, read-only arrays describing one map's doorways: the player width adjusted endpoints, lengths,
+    midpoints, heights, detection settings and the bounding box of each detection area. Built once per map and
+    shared between worker processes.
+    """
 
+    def __init__(self, doorways):
+        self.names = [doorway.name for doorway in doorways]
+        self.segments = doorway_segments(doorways)
+        self.lengths = np.array([doorway.length for doorway in doorways], dtype=np.float64)
+        self.midpoints = np.array([(d.midpoint.x, d.midpoint.y) for d in doorways], dtype=np.float64).reshape(-1, 2)
+        self.z = np.array([doorway.z for doorway in doorways], dtype=np.float64)
+        self.target_radius = np.array([doorway.target_radius for doorway in doorways], dtype=np.float64)
+        self.z_tolerance = np.array([doorway.z_tolerance for doorway in doorways], dtype=np.float64)
+        self.bounds = np.column_stack((self.midpoints - self.target_radius[:, None],
+                                       self.midpoints + self.target_radius[:, None]))
 
-def load_doorway_data():
+        for array in (self.segments, self.lengths, self.midpoints, self.z, self.target_radius, self.z_tolerance,
+                      self.bounds):
+            array.setflags(write=False)
+
+    def assign(self, x, y, z, chunk_size=4096):
+        """Vectorised form of the doorway assignment in assign_doorways(). Returns the index of the doorway each smoke
+        is assigned to, or -1 if it isn't in range of any. Smokes are processed in order of x coordinate so each
+        chunk only needs to be tested against the doorways whose detection area overlaps its x range.
+        """
+        assigned = np.full(len(x), -1, dtype=np.int32)
+        order = np.argsort(x, kind="stable")
+        for start in range(0, len(order), chunk_size):
+            rows = order[start:start + chunk_size]
+            cx, cy, cz = x[rows, None], y[rows, None], z[rows, None]
+            cols = np.flatnonzero((self.bounds[:, 0] <= cx[-1, 0]) & (self.bounds[:, 2] >= cx[0, 0]))
+            if len(cols) == 0:
+                continue
+
+            dx = cx - self.midpoints[cols, 0]
+            dy = cy - self.midpoints[cols, 1]
+            in_range = ((dx * dx + dy * dy < self.target_radius[cols]**2) &
+                        (cz >= self.z[cols] - self.z_tolerance[cols]) & (cz <= self.z[cols] + self.z_tolerance[cols]))
+
+            # Ties between doorways go to the closest midpoint, then the first doorway as np.argmin does. Squared
+            # distances give the same order without a square root.
+            distances = np.where(in_range, dx * dx + dy * dy, np.inf)
+            closest = cols[np.argmin(distances, axis=1)]
+            assigned[rows] = np.where(in_range.any(axis=1), closest, -1)
+        return assigned
+
+    def evaluate(self, x, y, z, radius):
+        """Assigns the smokes to doorways and calculates their coverage. Returns the assigned doorway indexes (-1 if
+        none) and the coverages (NaN if not assigned).
+        """
+        assigned = self.assign(x, y, z)
+        valid = assigned >= 0
+        coverage = np.full(len(x), np.nan)
+        coverage[valid] = paired_coverage(np.column_stack((x[valid], y[valid])), self.segments[assigned[valid]],
+                                          radius)
+        return assigned, coverage
+
+
+def load_doorway_data(path=DOORWAY_FILE, target_radius=None, z_tolerance=None):
     """Loads the doorway information from the json file and converts them to Doorway objects.
     """
-    entrances_file = open(DOORWAY_FILE)
+    entrances_file = open(path)
     entrances_data = json.load(entrances_file)
     doorways = []
 
@@ -216,14 +887,69 @@ def load_doorway_data():
                     y1=data["y1"],
                     x2=data["x2"],
                     y2=data["y2"],
-                    z=data["z"] - 64.093811))
+                    z=data["z"] - DOORWAY_Z_OFFSET,
+                    target_radius=target_radius,
+                    z_tolerance=z_tolerance))
     return doorways
 
 
-def load_smoke_data():
-    """Loads the smoke information from the json file and converts them to Smoke objects.
+class MapConfig():
+    """Settings for one map in the map registry, read from a [Map <name>] section of the config file. Detection
+    settings fall back to the [Data] section if the map doesn't override them.
     """
-    with open(DATASET_FILE, 'r') as f:
+
+    def __init__(self, name, doorway_file, smoke_radius, detection_radius, height_tolerance):
+        self.name = name
+        self.doorway_file = doorway_file
+        self.smoke_radius = smoke_radius
+        self.detection_radius = detection_radius
+        self.height_tolerance = height_tolerance
+
+    def load_doorways(self):
+        return load_doorway_data(self.doorway_file, self.detection_radius, self.height_tolerance)
+
+
+def load_map_registry(config=None):
+    """Returns a MapConfig for every [Map <name>] section in the config file (SETTINGS.config by default), keyed by
+    map name.
+    """
+    config = config or SETTINGS.config
+    maps = {}
+    for section in config.sections():
+        if not section.startswith("Map "):
+            continue
+        name = section[len("Map "):].strip()
+
+        def setting(key):
+            return config.getint(section, key, fallback=config.getint("Data", key))
+
+        maps[name] = MapConfig(name, config_path(config[section]["doorway_file"]), setting("smoke_radius_units"),
+                               setting("detection_radius_units"), setting("height_tolerance_units"))
+    return maps
+
+
+def map_from_demo_id(demo_id):
+    """Demo IDs end with the map played (e.g. ...-astralis-vs-faze-bo3-mirage), returns it as a map name.
+    """
+    return "de_" + demo_id.split("-")[-1].lower()
+
+
+def default_dataset_path():
+    """Returns the columnar dataset if one has been generated, otherwise the json dataset.
+    """
+    return COLUMNAR_DATASET_DIR if is_columnar_dataset(COLUMNAR_DATASET_DIR) else DATASET_FILE
+
+
+@instrumentation.timed("analysis.load_smoke_data")
+def load_smoke_data(path=None):
+    """Loads the smoke information from the dataset and converts them to Smoke objects. Reads the columnar dataset
+    if one exists, otherwise the json file.
+    """
+    path = path or default_dataset_path()
+    if is_columnar_dataset(path):
+        return SmokeTable.load(path).to_smokes()
+
+    with open(path, 'r') as f:
         dataset = json.load(f)
 
     smokes = []
@@ -242,39 +968,585 @@ def load_smoke_data():
     return smokes
 
 
-def assign_doorways(smokes, doorways):
+def iter_smoke_chunks(path=None, chunk_size=CHUNK_SIZE):
+    """Streams the dataset as a sequence of SmokeTables containing at most chunk_size smokes each. Columnar datasets
+    are memory-mapped and sliced, json datasets are decoded incrementally.
+    """
+    path = path or default_dataset_path()
+    if is_columnar_dataset(path):
+        table = SmokeTable.load(path, mmap=True)
+        for start in range(0, len(table), chunk_size):
+            yield table.subset(slice(start, start + chunk_size))
+        return
+
+    records = iter_smoke_records(path)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if len(chunk) == 0:
+            return
+        yield SmokeTable.from_records(chunk)
+
+
+def load_smoke_table(path=None, chunk_size=CHUNK_SIZE, mmap=False):
+    """Loads the smoke information into a columnar SmokeTable. Columnar datasets are read directly (optionally
+    memory-mapped), json files are streamed in chunks so the full json tree is never held in memory.
+    """
+    path = path or default_dataset_path()
+    if is_columnar_dataset(path):
+        return SmokeTable.load(path, mmap)
+    return SmokeTable.concatenate(iter_smoke_chunks(path, chunk_size))
+
+
+def convert_dataset(json_path=DATASET_FILE, columnar_path=COLUMNAR_DATASET_DIR):
+    """Converts an existing dataset.json file into the columnar dataset format.
+    """
+    logging.info(f"Converting [{json_path}] to columnar dataset [{columnar_path}]")
+    load_smoke_table(json_path).save(columnar_path)
+
+
+@instrumentation.timed("analysis.assign_doorways")
+def assign_doorways(smokes, doorways, index=None, attach=True, coverage=True):
     """Iterates through all of the smokes, assigns them to their doorway (or discards them), 
-    then calculates the coverage.
+    then calculates the coverage. Candidate doorways are looked up through a DoorwayIndex, one is built if not given.
+    If attach is False the smokes are not appended to Doorway.smokes, so the doorways hold no references to them.
+    If coverage is False the coverage is left to be calculated separately with calculate_coverages().
     """
     logging.info("Assigning Doorways...")
 
+    if index is None:
+        index = DoorwayIndex(doorways)
     valid_smokes = []
+    smoke_count = 0
 
     for smoke in smokes:
-        valid_doorways = [
-            doorway for doorway in doorways if doorway.smoke_in_target_range(smoke)]
+        smoke_count += 1
+        valid_doorways = index.doorways_in_range(smoke)
+        if _DIAGNOSTICS is not None:
+            _DIAGNOSTICS.record_assignment(smoke, valid_doorways)
+
         if len(valid_doorways) == 0:
-            logging.info(
-                f"{smoke} is not in range of any common doorway, skipping...")
             continue
         elif len(valid_doorways) == 1:
-            logging.info(
-                f"{smoke} in target zone of {valid_doorways[0].name}...")
             smoke.doorway = valid_doorways[0]
-            valid_doorways[0].smokes.append(smoke)
         else:
-            logging.info(
-                f"{smoke} in range of multiple doorways, using distance to doorway midpoints")
-            dist_to_mid = [smoke.distance_from_midpoint(
-                doorway) for doorway in valid_doorways]
-            smoke.doorway = valid_doorways[np.argmin(dist_to_mid)]
-            valid_doorways[np.argmin(dist_to_mid)].smokes.append(smoke)
-
-        smoke.calculate_coverage()
+            # In range of multiple doorways, uses the closest doorway midpoint (the first if tied)
+            centre = smoke.vector
+            smoke.doorway = min(valid_doorways, key=lambda d: d.midpoint_distance_sq(centre.x, centre.y))
+
+        if attach:
+            smoke.doorway.smokes.append(smoke)
         valid_smokes.append(smoke)
 
+    logging.info("%d of %d smokes in range of a doorway", len(valid_smokes), smoke_count)
+    instrumentation.count("analysis.smokes", smoke_count)
+    instrumentation.count("analysis.valid_smokes", len(valid_smokes))
+    if coverage:
+        calculate_coverages(valid_smokes)
     return valid_smokes
 
+
+def iter_assigned_chunks(doorways, path=None, chunk_size=CHUNK_SIZE):
+    """Streams the dataset in chunks, assigning doorways and calculating coverage for each chunk in turn. Yields the
+    list of valid smokes for each chunk, which are views into that chunk's SmokeTable. Smokes are not attached to
+    the doorways so peak memory is bounded by the chunk size rather than the dataset size.
+    """
+    index = DoorwayIndex(doorways)
+    for table in iter_smoke_chunks(path, chunk_size):
+        yield assign_doorways(table, doorways, index, attach=False)
+
+
+def file_fingerprint(path):
+    """Identifies the version of a file, or of every file in a directory (e.g. a columnar dataset), by size and
+    modification time.
+    """
+    if os.path.isdir(path):
+        return {file: file_fingerprint(os.path.join(path, file)) for file in sorted(os.listdir(path))}
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def coverage_cache_key(dataset_path, doorway_path):
+    """Hashes everything the assignment and coverage results depend on: the dataset, the doorway file and the
+    smoke radius, detection radius and height tolerance settings. The doorway file is small so its contents are
+    hashed, the dataset is identified by file_fingerprint().
+    """
+    with open(doorway_path, 'rb') as f:
+        doorway_hash = hashlib.sha256(f.read()).hexdigest()
+    fingerprint = {"version": COVERAGE_CACHE_VERSION,
+                   "dataset": file_fingerprint(dataset_path),
+                   "doorways": doorway_hash,
+                   "smoke_radius_units": SETTINGS.smoke_radius,
+                   "detection_radius_units": SETTINGS.detection_radius,
+                   "height_tolerance_units": SETTINGS.height_tolerance}
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+
+
+def _read_coverage_cache(cache_file, smoke_count):
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        with np.load(cache_file) as cached:
+            assigned, coverage = cached["doorway"], cached["coverage"]
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning(f"Unable to read coverage cache [{cache_file}]: {e}")
+        return None
+    if len(assigned) != smoke_count:
+        return None
+    # Marks the entry as recently used so it isn't evicted
+    os.utime(cache_file)
+    return assigned, coverage
+
+
+def _write_coverage_cache(cache_dir, cache_file, assigned, coverage):
+    """Writes the cache entry atomically, then removes all but the most recently used entries.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cache_file + ".tmp", 'wb') as f:
+        np.savez(f, doorway=assigned, coverage=coverage)
+    os.replace(cache_file + ".tmp", cache_file)
+
+    entries = sorted((os.path.join(cache_dir, file) for file in os.listdir(cache_dir) if file.endswith(".npz")),
+                     key=os.path.getmtime, reverse=True)
+    for entry in entries[COVERAGE_CACHE_ENTRIES:]:
+        os.remove(entry)
+
+
+def load_assigned_smokes(dataset_path=None, doorway_path=DOORWAY_FILE, cache_dir=COVERAGE_CACHE_DIR):
+    """Loads the smokes and doorways and assigns the doorways, as load_smoke_data(), load_doorway_data() and
+    assign_doorways() would, returning the smokes, doorways and valid smokes. The assigned doorway and coverage of
+    every smoke are cached on disk keyed by coverage_cache_key(), so they are only recomputed when the dataset,
+    doorway file or detection settings change.
+    """
+    dataset_path = dataset_path or default_dataset_path()
+    smokes = load_smoke_data(dataset_path)
+    doorways = load_doorway_data(doorway_path)
+    cache_file = os.path.join(cache_dir, f"{coverage_cache_key(dataset_path, doorway_path)}.npz")
+
+    cached = _read_coverage_cache(cache_file, len(smokes))
+    if cached is not None:
+        logging.info(f"Using cached doorway assignments [{cache_file}]")
+        assigned, coverage = cached
+        valid_smokes = []
+        for i in np.flatnonzero(assigned >= 0):
+            smoke = smokes[i]
+            smoke.doorway = doorways[assigned[i]]
+            smoke.coverage = coverage[i].item()
+            smoke.doorway.smokes.append(smoke)
+            valid_smokes.append(smoke)
+        return smokes, doorways, valid_smokes
+
+    valid_smokes = assign_doorways(smokes, doorways)
+    positions = {doorway: i for i, doorway in enumerate(doorways)}
+    assigned = np.fromiter((positions.get(smoke.doorway, -1) for smoke in smokes), dtype=np.int32,
+                           count=len(smokes))
+    coverage = np.fromiter((np.nan if smoke.coverage is None else smoke.coverage for smoke in smokes),
+                           dtype=np.float64, count=len(smokes))
+    _write_coverage_cache(cache_dir, cache_file, assigned, coverage)
+    return smokes, doorways, valid_smokes
+
+
+def doorway_positions(table, doorways):
+    """Returns the index into doorways of the doorway assigned to each smoke in a SmokeTable, -1 if it has none.
+    """
+    positions = {doorway: i for i, doorway in enumerate(doorways)}
+    return np.fromiter((positions.get(doorway, -1) for doorway in table.doorway), dtype=np.int32, count=len(table))
+
+
+def cache_table_assignments(table, doorways, dataset_path, doorway_path=DOORWAY_FILE, cache_dir=COVERAGE_CACHE_DIR,
+                            assigned=None):
+    """Writes the assigned doorways and coverages of a SmokeTable holding every smoke in dataset_path, assigned to
+    the doorways loaded from doorway_path, to the coverage cache so load_assigned_smokes() reads them rather than
+    recomputing them. assigned optionally gives the doorway_positions() of the table, if they are already known.
+    """
+    assigned = doorway_positions(table, doorways) if assigned is None else assigned
+    cache_file = os.path.join(cache_dir, f"{coverage_cache_key(dataset_path, doorway_path)}.npz")
+    _write_coverage_cache(cache_dir, cache_file, np.asarray(assigned, dtype=np.int32),
+                          np.asarray(table.coverage, dtype=np.float64))
+
+
+def load_table_assignments(table, doorways, dataset_path, doorway_path=DOORWAY_FILE, cache_dir=COVERAGE_CACHE_DIR):
+    """Fills in the doorway and coverage columns of a SmokeTable holding every smoke in dataset_path from the
+    coverage cache. Returns False, leaving the table unchanged, if the assignments aren't cached.
+    """
+    cache_file = os.path.join(cache_dir, f"{coverage_cache_key(dataset_path, doorway_path)}.npz")
+    cached = _read_coverage_cache(cache_file, len(table))
+    if cached is None:
+        return False
+    assigned, coverage = cached
+    valid = assigned >= 0
+    table.doorway = np.full(len(table), None, dtype=object)
+    table.doorway[valid] = np.asarray(doorways, dtype=object)[assigned[valid]]
+    table.coverage = coverage.astype(np.float64)
+    return True
+
+
+# Doorway geometry for every map, set once in each worker process by _init_map_worker()
+_WORKER_GEOMETRY = {}
+
+
+def _init_map_worker(geometries):
+    global _WORKER_GEOMETRY
+    _WORKER_GEOMETRY = geometries
+
+
+def _evaluate_partition(map_name, x, y, z, radius):
+    return _WORKER_GEOMETRY[map_name].evaluate(x, y, z, radius)
+
+
+def evaluate_maps(table, maps=None, workers=None):
+    """Partitions the smokes by the map they were thrown on, then assigns doorways and calculates coverage for each
+    map independently. Doorway geometry is precomputed once per map and, if workers is greater than 1, sent once to
+    each worker process, which then evaluate the partitions in parallel.
+
+    Fills in the table's doorway and coverage columns and returns each map's doorways, with the smokes assigned to
+    them in Doorway.smokes.
+    """
+    maps = maps or load_map_registry()
+    workers = SETTINGS.map_workers if workers is None else workers
+    doorways = {name: map_config.load_doorways() for name, map_config in maps.items()}
+    geometries = {name: DoorwayGeometry(map_doorways) for name, map_doorways in doorways.items()}
+
+    demo_maps = np.array([map_from_demo_id(demo_id) for demo_id in table.categories["demo_id"]], dtype=object)
+    smoke_maps = demo_maps[table.codes["demo_id"]] if len(demo_maps) else np.array([], dtype=object)
+    unknown = set(smoke_maps) - set(maps)
+    if unknown:
+        logging.warning(f"No map config for {sorted(unknown)}, skipping their smokes...")
+
+    partitions = {}
+    for name, map_config in maps.items():
+        rows = np.flatnonzero(smoke_maps == name)
+        for start in range(0, len(rows), CHUNK_SIZE):
+            chunk = rows[start:start + CHUNK_SIZE]
+            partitions[(name, start)] = (chunk, (name, table.x[chunk], table.y[chunk], table.z[chunk],
+                                                 map_config.smoke_radius))
+
+    if workers <= 1:
+        _init_map_worker(geometries)
+        results = {key: _evaluate_partition(*args) for key, (_, args) in partitions.items()}
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_map_worker,
+                                 initargs=(geometries,)) as executor:
+            futures = {key: executor.submit(_evaluate_partition, *args) for key, (_, args) in partitions.items()}
+            results = {key: future.result() for key, future in futures.items()}
+
+    for (name, start), (rows, _) in partitions.items():
+        assigned, coverage = results[(name, start)]
+        valid = assigned >= 0
+        table.coverage[rows] = coverage
+        for row, doorway_index in zip(rows[valid], assigned[valid]):
+            doorway = doorways[name][doorway_index]
+            table.doorway[row] = doorway
+            doorway.smokes.append(SmokeRow(table, row))
+    return doorways
+
+
+class CoverageStats():
+    """Group-by aggregation of smoke coverages. The group keys are encoded as integer codes once when the stats are
+    built, and the sort order for each grouping is built on first use and cached, so every group's statistics are
+    answered together with vectorised reductions rather than filtering the smokes once per group.
+    """
+    GROUP_KEYS = ("thrower", "team", "demo_id", "doorway", "side", "round_num")
+    SUCCESS_COVERAGE = 100
+
+    def __init__(self, coverage, codes, categories):
+        self.coverage = np.asarray(coverage, dtype=np.float64)
+        self.codes = {key: np.asarray(codes[key], dtype=np.int64) for key in self.GROUP_KEYS}
+        self.categories = {key: list(categories[key]) for key in self.GROUP_KEYS}
+        self._lookups = {key: {value: code for code, value in enumerate(values)}
+                         for key, values in self.categories.items()}
+        self._indexes = {}
+
+    @classmethod
+    def from_smokes(cls, smokes):
+        """Builds the stats from Smoke objects (or SmokeRow views), e.g. the valid smokes returned by
+        assign_doorways(). Smokes without a coverage are ignored.
+        """
+        smokes = [smoke for smoke in smokes if smoke.coverage is not None]
+        codes, categories = {}, {}
+        for key in cls.GROUP_KEYS:
+            lookup = {}
+            codes[key] = np.fromiter((lookup.setdefault(getattr(smoke, key), len(lookup)) for smoke in smokes),
+                                     dtype=np.int64, count=len(smokes))
+            categories[key] = list(lookup)
+        return cls([smoke.coverage for smoke in smokes], codes, categories)
+
+    @classmethod
+    def from_table(cls, table):
+        """Builds the stats from the smokes in a SmokeTable which have been assigned a doorway, reusing the table's
+        category codes.
+        """
+        valid = ~np.isnan(table.coverage) & (table.doorway != None)  # noqa: E711
+        codes = {key: table.codes[key][valid] for key in CATEGORICAL}
+        categories = {key: table.categories[key] for key in CATEGORICAL}
+
+        rounds, codes["round_num"] = np.unique(table.round_num[valid], return_inverse=True)
+        categories["round_num"] = rounds.tolist()
+
+        lookup = {}
+        codes["doorway"] = np.fromiter((lookup.setdefault(doorway, len(lookup)) for doorway in table.doorway[valid]),
+                                       dtype=np.int64, count=int(valid.sum()))
+        categories["doorway"] = list(lookup)
+        return cls(table.coverage[valid], codes, categories)
+
+    def extend(self, table):
+        """Adds the smokes in a SmokeTable which have been assigned a doorway, e.g. smokes appended to the dataset,
+        without rebuilding the stats for the existing smokes. New group values are given the next free codes, the
+        cached sort orders are dropped and rebuilt on the next query.
+        """
+        valid = ~np.isnan(table.coverage) & (table.doorway != None)  # noqa: E711
+        codes = {key: self._encode(key, table.categories[key], table.codes[key][valid]) for key in CATEGORICAL}
+        rounds, round_codes = np.unique(table.round_num[valid], return_inverse=True)
+        codes["round_num"] = self._encode("round_num", rounds.tolist(), round_codes)
+        doorways = table.doorway[valid]
+        codes["doorway"] = self._encode("doorway", doorways, np.arange(len(doorways)))
+
+        self.coverage = np.concatenate([self.coverage, table.coverage[valid]])
+        self.codes = {key: np.concatenate([self.codes[key], codes[key]]) for key in self.GROUP_KEYS}
+        self._indexes = {}
+
+    def _encode(self, key, values, codes):
+        """Maps codes into a list of values onto this stats' codes for the group key, adding any new values.
+        """
+        lookup = self._lookups[key]
+        remap = np.fromiter((lookup.setdefault(value, len(lookup)) for value in values), dtype=np.int64,
+                            count=len(values))
+        self.categories[key] = list(lookup)
+        return remap[codes]
+
+    def __len__(self):
+        return len(self.coverage)
+
+    def _index(self, by):
+        """Returns the row order sorted by group then coverage, the group of each sorted row and the label of each
+        group for a tuple of group keys.
+        """
+        if by not in self._indexes:
+            if len(by) == 0 or len(self) == 0:
+                group = np.zeros(len(self), dtype=np.int64)
+                labels = [()]
+            else:
+                shape = tuple(len(self.categories[key]) for key in by)
+                group = np.ravel_multi_index(tuple(self.codes[key] for key in by), shape)
+                keys, group = np.unique(group, return_inverse=True)
+                label_codes = np.unravel_index(keys, shape)
+                labels = list(zip(*(np.asarray(self.categories[key], dtype=object)[codes].tolist()
+                                    for key, codes in zip(by, label_codes))))
+            order = np.lexsort((self.coverage, group))
+            self._indexes[by] = (order, group[order], labels)
+        return self._indexes[by]
+
+    def _mask(self, where):
+        """Boolean mask of the smokes matching every key in where, each key maps to a value or a list/set of values.
+        """
+        mask = np.ones(len(self), dtype=np.bool_)
+        for key, values in where.items():
+            if isinstance(values, (str, Doorway)) or not hasattr(values, "__iter__"):
+                values = [values]
+            wanted = [self._lookups[key][value] for value in values if value in self._lookups[key]]
+            mask &= np.isin(self.codes[key], wanted)
+        return mask
+
+    @staticmethod
+    def _percentile(values, starts, counts, q):
+        # Linear interpolation between the closest ranks, matching np.percentile's default method
+        position = starts + (counts - 1) * q
+        lower = np.floor(position).astype(np.int64)
+        upper = np.ceil(position).astype(np.int64)
+        return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+    def group_stats(self, by, where=None, mask=None):
+        """Returns the count, success rate (percentage of smokes fully covering their doorway) and the min, mean,
+        median, max and interquartile range of the coverage for every group. by is a group key or a tuple of keys
+        from GROUP_KEYS, where optionally restricts the smokes used (see _mask()), as does mask, a boolean array over
+        the smokes in the order the stats were built from. Groups are keyed by their value, or a tuple of values if
+        by is a tuple, and groups with no matching smokes are left out.
+        """
+        single = isinstance(by, str)
+        by = (by,) if single else tuple(by)
+        order, group, labels = self._index(by)
+        if where or mask is not None:
+            selected = self._mask(where or {})
+            if mask is not None:
+                selected &= mask
+            kept = selected[order]
+            order, group = order[kept], group[kept]
+        if len(order) == 0:
+            return {}
+
+        groups, results = self.summarise(self.coverage[order], group)
+        stats = {}
+        for i, group_id in enumerate(groups):
+            label = labels[group_id][0] if single else labels[group_id]
+            stats[label] = {name: result[i].item() for name, result in results.items()}
+        return stats
+
+    @classmethod
+    def summarise(cls, values, group):
+        """Computes the statistics for every group of a non-empty array of coverages sorted by group and then by
+        coverage. Returns the ID of each group and a dictionary of arrays holding each statistic per group.
+        """
+        starts = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+        ends = np.r_[starts[1:], len(values)]
+        counts = ends - starts
+
+        results = {"count": counts,
+                   "success_rate": np.add.reduceat(values == cls.SUCCESS_COVERAGE, starts) / counts * 100,
+                   "min": values[starts],
+                   "mean": np.add.reduceat(values, starts) / counts,
+                   "median": cls._percentile(values, starts, counts, 0.5),
+                   "max": values[ends - 1],
+                   "iqr": (cls._percentile(values, starts, counts, 0.75) -
+                           cls._percentile(values, starts, counts, 0.25))}
+        return group[starts], results
+
+    def stats(self, where=None, mask=None):
+        """Returns the same statistics as group_stats() over all of the (optionally filtered) smokes, or None if no
+        smokes match.
+        """
+        return self.group_stats((), where, mask).get(())
+
+
+class CandidatePairs():
+    """Every (smoke, doorway) pair within the largest detection radius and height tolerance of a parameter sweep,
+    sorted by smoke, then distance to the doorway midpoint, then doorway. Any smaller detection radius and height
+    tolerance is a filter over these pairs, and the first remaining pair of each smoke is the doorway
+    assign_doorways() would choose.
+    """
+
+    def __init__(self, x, y, z, doorways, detection_radius, height_tolerance, chunk_size=4096):
+        geometry = DoorwayGeometry(doorways)
+        self.segments = geometry.segments
+        rows, cols, dist_sq = [], [], []
+
+        # Same x ordered chunking and overlap test as DoorwayGeometry.assign()
+        order = np.argsort(x, kind="stable")
+        min_x = geometry.midpoints[:, 0] - detection_radius
+        max_x = geometry.midpoints[:, 0] + detection_radius
+        for start in range(0, len(order), chunk_size):
+            chunk = order[start:start + chunk_size]
+            cx, cy, cz = x[chunk, None], y[chunk, None], z[chunk, None]
+            chunk_cols = np.flatnonzero((min_x <= cx[-1, 0]) & (max_x >= cx[0, 0]))
+            if len(chunk_cols) == 0:
+                continue
+
+            dx = cx - geometry.midpoints[chunk_cols, 0]
+            dy = cy - geometry.midpoints[chunk_cols, 1]
+            chunk_dist_sq = dx * dx + dy * dy
+            dz = geometry.z[chunk_cols]
+            in_range = ((chunk_dist_sq < detection_radius**2) &
+                        (cz >= dz - height_tolerance) & (cz <= dz + height_tolerance))
+            pair_rows, pair_cols = np.nonzero(in_range)
+            rows.append(chunk[pair_rows])
+            cols.append(chunk_cols[pair_cols])
+            dist_sq.append(chunk_dist_sq[pair_rows, pair_cols])
+
+        rows = np.concatenate(rows) if rows else np.array([], dtype=np.int64)
+        cols = np.concatenate(cols) if cols else np.array([], dtype=np.int64)
+        dist_sq = np.concatenate(dist_sq) if dist_sq else np.array([], dtype=np.float64)
+        pair_order = np.lexsort((cols, np.sqrt(dist_sq), rows))
+
+        self.rows = rows[pair_order]
+        self.cols = cols[pair_order]
+        self.dist_sq = dist_sq[pair_order]
+        self.smoke_z = z[self.rows]
+        self.doorway_z = geometry.z[self.cols]
+        self.centres = np.column_stack((x[self.rows], y[self.rows]))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def select(self, detection_radius, height_tolerance, subset=None):
+        """Returns the index of the pair each smoke is assigned to with the given detection settings, as positions
+        into subset if given or into all of the pairs otherwise.
+        """
+        subset = np.arange(len(self)) if subset is None else subset
+        doorway_z = self.doorway_z[subset]
+        smoke_z = self.smoke_z[subset]
+        kept = np.flatnonzero((self.dist_sq[subset] < detection_radius**2) &
+                              (smoke_z >= doorway_z - height_tolerance) & (smoke_z <= doorway_z + height_tolerance))
+        rows = self.rows[subset[kept]]
+        return kept[np.r_[True, rows[1:] != rows[:-1]]] if len(kept) else kept
+
+
+# Candidate pairs shared with each worker process by _init_sweep_worker()
+_WORKER_PAIRS = None
+
+
+def _init_sweep_worker(pairs):
+    global _WORKER_PAIRS
+    _WORKER_PAIRS = pairs
+
+
+def _sweep_task(smoke_radius, detection_radius, height_tolerances, doorway_names):
+    """Evaluates every height tolerance for one smoke radius and detection radius. The coverage of each candidate
+    pair within the detection radius is calculated once and shared between the height tolerances.
+    """
+    pairs = _WORKER_PAIRS
+    subset = np.flatnonzero(pairs.dist_sq < detection_radius**2)
+    coverage = paired_coverage(pairs.centres[subset], pairs.segments[pairs.cols[subset]], smoke_radius)
+
+    rows = []
+    for height_tolerance in height_tolerances:
+        selected = pairs.select(detection_radius, height_tolerance, subset)
+        values, assigned = coverage[selected], pairs.cols[subset[selected]]
+        parameters = {"smoke_radius": smoke_radius, "detection_radius": detection_radius,
+                      "height_tolerance": height_tolerance}
+        if len(values) == 0:
+            rows.append(dict(parameters, count=0))
+            continue
+
+        rows.extend(_stats_rows(parameters, np.sort(values), np.zeros(len(values), dtype=np.int64)))
+        if doorway_names is not None:
+            order = np.lexsort((values, assigned))
+            rows.extend(_stats_rows(parameters, values[order], assigned[order], doorway_names))
+    return rows
+
+
+def _stats_rows(parameters, values, group, doorway_names=None):
+    """Converts the statistics for each group of sorted coverages into sweep result rows.
+    """
+    groups, results = CoverageStats.summarise(values, group)
+    rows = []
+    for i, group_id in enumerate(groups):
+        row = dict(parameters) if doorway_names is None else dict(parameters, doorway=doorway_names[group_id])
+        row.update({name: result[i].item() for name, result in results.items()})
+        rows.append(row)
+    return rows
+
+
+def sweep_parameters(table, doorways, smoke_radii=None, detection_radii=None, height_tolerances=None,
+                     by_doorway=False, workers=None):
+    """Evaluates the doorway assignment and coverage of the same smokes for every combination of smoke radius,
+    detection radius and height tolerance, each defaulting to the current config value. table is a SmokeTable and
+    the doorways' own detection settings are ignored.
+
+    The candidate (smoke, doorway) pairs are found once at the largest detection radius and height tolerance, each
+    combination then filters them. Combinations are grouped by smoke radius and detection radius and, if workers is
+    greater than 1, evaluated in parallel. Returns a list of rows, one per combination holding the parameters, the
+    number of smokes assigned (count) and the coverage statistics from CoverageStats. If by_doorway is True there is
+    also a row for every doorway in each combination, with the doorway name in a doorway column.
+    """
+    smoke_radii = smoke_radii or [SETTINGS.smoke_radius]
+    detection_radii = detection_radii or [SETTINGS.detection_radius]
+    height_tolerances = height_tolerances or [SETTINGS.height_tolerance]
+    workers = SETTINGS.sweep_workers if workers is None else workers
+
+    pairs = CandidatePairs(table.x, table.y, table.z, doorways, max(detection_radii), max(height_tolerances))
+    logging.info(f"Sweeping {len(smoke_radii) * len(detection_radii) * len(height_tolerances)} parameter "
+                 f"combinations over {len(pairs)} candidate pairs")
+
+    doorway_names = [doorway.name for doorway in doorways] if by_doorway else None
+    tasks = [(smoke_radius, detection_radius, list(height_tolerances), doorway_names)
+             for smoke_radius in smoke_radii for detection_radius in detection_radii]
+    if workers <= 1:
+        _init_sweep_worker(pairs)
+        results = [_sweep_task(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_sweep_worker,
+                                 initargs=(pairs,)) as executor:
+            results = list(executor.map(_sweep_task, *zip(*tasks)))
+    return [row for rows in results for row in rows]
+
 # smokes = load_smoke_data()
 # doorways = load_doorway_data()
 # valid_smokes = assign_doorways(smokes, doorways)
@@ -1,5 +1,40 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
-from analysis import Doorway, Smoke
+from unittest import mock
+import numpy as np
+import analysis
+from analysis import (CoverageStats, Diagnostics, Doorway, DoorwayGeometry, DoorwayIndex, MapConfig, Settings, Smoke,
+                      SmokeTable, Vector2, assign_doorways, convert_dataset, coverage_matrix, doorway_segments,
+                      evaluate_maps, iter_assigned_chunks, iter_smoke_chunks, iter_smoke_records, load_assigned_smokes,
+                      load_doorway_data, load_smoke_data, load_smoke_table, paired_coverage, sweep_parameters)
+
+
+def synthetic_records(count, seed=0):
+    """Generates dataset.json style smoke records scattered around a handful of test doorways
+    """
+    rng = np.random.default_rng(seed)
+    return [{"demoID": f"demo-{rng.integers(5)}",
+             "throwerName": f"player-{rng.integers(20)}",
+             "throwerTeam": f"team-{rng.integers(4)}",
+             "throwerSide": str(rng.choice(["T", "CT"])),
+             "roundNum": int(rng.integers(1, 31)),
+             "throwTime": f"{rng.integers(0, 2):02d}:{rng.integers(0, 60):02d}",
+             "grenadeX": float(rng.uniform(-600, 600)),
+             "grenadeY": float(rng.uniform(-600, 600)),
+             "grenadeZ": float(rng.uniform(-60, 60)),
+             "roundWon": bool(rng.integers(2))} for _ in range(count)]
+
+
+def synthetic_doorways():
+    """Test doorways for the smokes generated by synthetic_records
+    """
+    return [Doorway("Test1", -300, -300, -200, -300, z=0),
+            Doorway("Test2", 0, 0, 0, 150, z=0),
+            Doorway("Test3", 300, 200, 380, 260, z=0)]
 
 
 class TestSmokeCoverage(unittest.TestCase):
@@ -107,5 +142,442 @@ class TestSmokeCoverage(unittest.TestCase):
         self.assertAlmostEqual(smoke.coverage, measured_coverage, delta=2)
 
 
+class TestBatchCoverage(unittest.TestCase):
+    """Cross-checks the vectorised coverage engine against the per-object Smoke.calculate_coverage()
+    """
+    CASES = [((200, 200), (125, 250), (275, 150), 1),
+             ((200, 200), (150, 10), (400, 110), 2),
+             ((200, 200), (100, 300), (25, 400), 3),
+             ((200, 200), (50, 72), (350, 72), 4),
+             ((200, 200), (75, 280), (300, 310), 5),
+             ((200, 200), (200, 200), (400, 250), 6)]
+
+    def test_cases_match_per_object(self):
+        """Each of the six documented cases gives the same coverage and is identified as the correct case
+        """
+        for s, d1, d2, case in self.CASES:
+            smoke = TestSmokeCoverage.setup(s, d1, d2)
+            coverage, cases = paired_coverage([s], [d1 + d2], smoke.radius, return_cases=True)
+            self.assertEqual(coverage[0], smoke.coverage)
+            self.assertEqual(cases[0], case)
+
+    def test_random_matrix_matches_per_object(self):
+        """Every smoke/doorway pair in a random (N, M) matrix matches the per-object calculation exactly
+        """
+        rng = np.random.default_rng(0)
+        centres = rng.uniform(-400, 400, size=(60, 2))
+        doorways = [Doorway("Test", *rng.uniform(-400, 400, size=4), z=0) for _ in range(15)]
+
+        matrix = coverage_matrix(centres, doorway_segments(doorways), 128)
+        self.assertEqual(matrix.shape, (60, 15))
+        for i, (x, y) in enumerate(centres):
+            for j, doorway in enumerate(doorways):
+                smoke = Smoke(None, None, None, None, None, None, None, x, y, 0)
+                smoke.doorway = doorway
+                smoke.calculate_coverage()
+                self.assertEqual(matrix[i, j], smoke.coverage)
+
+    def test_fast_rejection(self):
+        """Smokes rejected by the expanded bounding box have no coverage, the same as the full calculation
+        """
+        doorway = Doorway("Test", 0, 0, 300, 100, z=0, adjust_pw=False)
+        self.assertEqual((doorway.length_sq, doorway.bounds), (100000, (0, 0, 300, 100)))
+        self.assertEqual(doorway.expanded_bounds(128), (-128, -128, 428, 228))
+
+        rng = np.random.default_rng(2)
+        centres = rng.uniform(-600, 800, size=(500, 2))
+        expected = paired_coverage(centres, [[0, 0, 300, 100]] * 500, 128)
+        rejected = 0
+        for (x, y), coverage in zip(centres, expected):
+            smoke = Smoke(None, None, None, None, None, None, None, x, y, 0)
+            smoke.doorway = doorway
+            smoke.calculate_coverage()
+            self.assertEqual(smoke.coverage, coverage)
+            rejected += not doorway.may_cover(x, y, smoke.radius)
+        self.assertGreater(rejected, 0)
+
+
+class TestDiagnostics(unittest.TestCase):
+    """Tests the opt-in diagnostics count every case and that nothing is logged per smoke by default
+    """
+
+    def test_counts_cases_from_both_engines(self):
+        with Diagnostics(sample_every=1) as diagnostics:
+            with self.assertLogs("analysis.diagnostics", level="DEBUG") as logs:
+                for s, d1, d2, _ in TestBatchCoverage.CASES:
+                    TestSmokeCoverage.setup(s, d1, d2)
+        self.assertEqual(diagnostics.cases, {case: 1 for _, _, _, case in TestBatchCoverage.CASES})
+        self.assertEqual(len(logs.records), 6)
+
+        smokes = SmokeTable.from_records(synthetic_records(500)).to_smokes()
+        with Diagnostics(sample_every=100) as diagnostics:
+            valid_smokes = assign_doorways(smokes, synthetic_doorways())
+        _, cases = paired_coverage([(s.vector.x, s.vector.y) for s in valid_smokes],
+                                   doorway_segments([s.doorway for s in valid_smokes]), 128, return_cases=True)
+        self.assertEqual(diagnostics.cases, dict(zip(*np.unique(cases, return_counts=True))))
+        self.assertEqual(sum(diagnostics.assignments.values()), len(smokes))
+        self.assertEqual(len(valid_smokes), diagnostics.assignments["single"] + diagnostics.assignments["multiple"])
+
+    def test_disabled_by_default(self):
+        smokes = SmokeTable.from_records(synthetic_records(200)).to_smokes()
+        with self.assertNoLogs("analysis.diagnostics", level="DEBUG"):
+            valid_smokes = assign_doorways(smokes, synthetic_doorways())
+            for smoke in valid_smokes:
+                smoke.calculate_coverage()
+                smoke.doorway.smoke_in_target_range(smoke)
+
+
+class TestDoorwayIndex(unittest.TestCase):
+    """Tests the spatial index returns the same doorways as checking every doorway
+    """
+
+    def test_matches_full_scan(self):
+        rng = np.random.default_rng(1)
+        doorways = []
+        for i in range(40):
+            x, y = rng.uniform(-1500, 1500, size=2)
+            doorways.append(Doorway(f"Test{i}", x, y, x + 100, y, z=rng.uniform(-100, 100)))
+        index = DoorwayIndex(doorways)
+
+        for x, y, z in rng.uniform(-1500, 1500, size=(500, 3)) / [1, 1, 10]:
+            smoke = Smoke(None, None, None, None, None, None, None, x, y, z)
+            expected = [doorway for doorway in doorways if doorway.smoke_in_target_range(smoke)]
+            self.assertEqual(index.doorways_in_range(smoke), expected)
+
+
+class TestSmokeTable(unittest.TestCase):
+    """Tests the columnar SmokeTable behaves the same as a list of Smoke objects
+    """
+
+    def test_rows_match_records(self):
+        records = synthetic_records(50)
+        table = SmokeTable.from_records(records)
+        self.assertEqual(len(table), 50)
+        for row, record in zip(table, records):
+            self.assertEqual(row.demo_id, record["demoID"])
+            self.assertEqual(row.thrower, record["throwerName"])
+            self.assertEqual(row.team, record["throwerTeam"])
+            self.assertEqual(row.side, record["throwerSide"])
+            self.assertEqual(row.round_num, record["roundNum"])
+            self.assertEqual(row.time_thrown, record["throwTime"])
+            self.assertEqual(row.round_won, record["roundWon"])
+            self.assertEqual((row.vector.x, row.vector.y, row.z),
+                             (record["grenadeX"], record["grenadeY"], record["grenadeZ"]))
+            self.assertIsNone(row.coverage)
+
+    def test_assignment_matches_smoke_objects(self):
+        table = SmokeTable.from_records(synthetic_records(500))
+        smokes = table.to_smokes()
+        valid_rows = assign_doorways(table, synthetic_doorways())
+        valid_smokes = assign_doorways(smokes, synthetic_doorways())
+
+        self.assertGreater(len(valid_smokes), 0)
+        self.assertEqual([row.index for row in valid_rows], [smokes.index(s) for s in valid_smokes])
+        for row, smoke in zip(valid_rows, valid_smokes):
+            self.assertEqual(row.doorway.name, smoke.doorway.name)
+            self.assertEqual(row.coverage, smoke.coverage)
+
+
+class TestStreamingLoader(unittest.TestCase):
+    """Tests the streaming dataset reader gives the same smokes as loading the whole file
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, "dataset.json")
+        self.records = synthetic_records(300)
+        with open(self.path, 'w') as f:
+            json.dump(self.records, f, indent=2)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_records_match_json_load(self):
+        for buffer_size in (7, 100, 2**16):
+            self.assertEqual(list(iter_smoke_records(self.path, buffer_size)), self.records)
+
+    def test_chunked_table_matches_records(self):
+        table = load_smoke_table(self.path, chunk_size=64)
+        self.assertEqual(len(table), len(self.records))
+        self.assertEqual(list(table.column("thrower")), [r["throwerName"] for r in self.records])
+        self.assertEqual(list(table.x), [r["grenadeX"] for r in self.records])
+
+    def test_chunked_assignment_matches_full(self):
+        expected = assign_doorways(SmokeTable.from_records(self.records), synthetic_doorways())
+        streamed = [smoke for chunk in iter_assigned_chunks(synthetic_doorways(), self.path, chunk_size=64)
+                    for smoke in chunk]
+        self.assertEqual([(s.doorway.name, s.coverage) for s in streamed],
+                         [(s.doorway.name, s.coverage) for s in expected])
+
+
+class TestColumnarDataset(unittest.TestCase):
+    """Tests the binary columnar dataset round trips the json dataset
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.json_path = os.path.join(self.temp_dir.name, "dataset.json")
+        self.columnar_path = os.path.join(self.temp_dir.name, "dataset_columns")
+        self.records = synthetic_records(200)
+        with open(self.json_path, 'w') as f:
+            json.dump(self.records, f)
+        convert_dataset(self.json_path, self.columnar_path)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_load_smoke_data_matches_json(self):
+        def attributes(smokes):
+            return [(s.demo_id, s.thrower, s.team, s.side, s.round_num, s.time_thrown, s.round_won,
+                     s.vector.x, s.vector.y, s.z) for s in smokes]
+
+        self.assertEqual(attributes(load_smoke_data(self.columnar_path)), attributes(load_smoke_data(self.json_path)))
+
+    def test_memory_mapped_chunks(self):
+        table = load_smoke_table(self.columnar_path, mmap=True)
+        self.assertIsInstance(table.x.base, np.memmap)
+        chunks = list(iter_smoke_chunks(self.columnar_path, chunk_size=64))
+        self.assertEqual([len(chunk) for chunk in chunks], [64, 64, 64, 8])
+        self.assertEqual(list(SmokeTable.concatenate(chunks).column("demo_id")), [r["demoID"] for r in self.records])
+
+    def test_append_in_place(self):
+        new_records = synthetic_records(50, seed=1)
+        with mock.patch("dataset.os.replace", side_effect=OSError("Interrupted")):
+            with self.assertRaises(OSError):
+                SmokeTable.from_records(new_records).append_to(self.columnar_path)
+        # Rows from an unfinished append aren't read, and are replaced by the next append
+        self.assertEqual(len(load_smoke_table(self.columnar_path)), 200)
+        SmokeTable.from_records(new_records).append_to(self.columnar_path)
+
+        appended = load_smoke_table(self.columnar_path, mmap=True)
+        expected = SmokeTable.from_records(self.records + new_records)
+        self.assertEqual(appended.categories, expected.categories)
+        for column in ("x", "y", "z", "round_num", "throw_time", "round_won"):
+            np.testing.assert_array_equal(getattr(appended, column), getattr(expected, column))
+        for column, codes in expected.codes.items():
+            np.testing.assert_array_equal(appended.codes[column], codes)
+
+
+class TestCoverageStats(unittest.TestCase):
+    """Tests the grouped coverage statistics against filtering the smokes for each group
+    """
+
+    def setUp(self):
+        self.doorways = synthetic_doorways()
+        self.smokes = assign_doorways(SmokeTable.from_records(synthetic_records(3000)).to_smokes(), self.doorways)
+        self.stats = CoverageStats.from_smokes(self.smokes)
+
+    def naive_stats(self, smokes):
+        coverages = [smoke.coverage for smoke in smokes]
+        return {"count": len(coverages),
+                "success_rate": len([c for c in coverages if c == 100]) / len(coverages) * 100,
+                "min": np.min(coverages), "mean": np.mean(coverages), "median": np.median(coverages),
+                "max": np.max(coverages), "iqr": np.percentile(coverages, 75) - np.percentile(coverages, 25)}
+
+    def assertStatsEqual(self, stats, expected):
+        self.assertEqual(sorted(stats, key=str), sorted(expected, key=str))
+        for group in expected:
+            for name, value in expected[group].items():
+                self.assertAlmostEqual(stats[group][name], value, msg=f"{group} {name}")
+
+    def test_group_by_player(self):
+        expected = {player: self.naive_stats([s for s in self.smokes if s.thrower == player])
+                    for player in set(s.thrower for s in self.smokes)}
+        self.assertStatsEqual(self.stats.group_stats("thrower"), expected)
+
+    def test_filtered_multi_key_groups(self):
+        smokes = [s for s in self.smokes if s.demo_id == "demo-1" and s.side in ("T", "CT")]
+        expected = {(team, doorway): self.naive_stats([s for s in smokes if s.team == team and s.doorway is doorway])
+                    for team, doorway in set((s.team, s.doorway) for s in smokes)}
+        where = {"demo_id": "demo-1", "side": ["T", "CT"]}
+        self.assertStatsEqual(self.stats.group_stats(("team", "doorway"), where=where), expected)
+        self.assertEqual(self.stats.group_stats("team", where={"demo_id": "missing"}), {})
+
+    def test_overall_stats_and_doorway_stats(self):
+        self.assertStatsEqual({(): self.stats.stats()}, {(): self.naive_stats(self.smokes)})
+        for doorway in self.doorways:
+            expected = self.naive_stats(doorway.smokes)
+            self.assertEqual(doorway.coverage_stats(), {name: expected[name] for name in ("min", "mean", "median",
+                                                                                          "max")})
+
+    def test_from_table_matches_smokes(self):
+        table = SmokeTable.from_records(synthetic_records(3000))
+        assign_doorways(table, synthetic_doorways())
+        stats = CoverageStats.from_table(table)
+        self.assertEqual(len(stats), len(self.stats))
+        for by in ("round_num", ("side", "thrower")):
+            self.assertStatsEqual(stats.group_stats(by), self.stats.group_stats(by))
+        by_doorway = {doorway.name: value for doorway, value in stats.group_stats("doorway").items()}
+        self.assertStatsEqual(by_doorway, {doorway.name: value
+                                           for doorway, value in self.stats.group_stats("doorway").items()})
+
+
+class TestCoverageCache(unittest.TestCase):
+    """Tests assignment results are read from the cache until the dataset, doorway file or settings change
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.dataset_path = os.path.join(self.temp_dir.name, "dataset.json")
+        self.doorway_path = os.path.join(self.temp_dir.name, "doorways.json")
+        self.cache_dir = os.path.join(self.temp_dir.name, "coverage_cache")
+        with open(self.dataset_path, 'w') as f:
+            json.dump(synthetic_records(500), f)
+        self.write_doorways(150)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write_doorways(self, y2):
+        with open(self.doorway_path, 'w') as f:
+            json.dump({"a": {"x1": -300, "y1": -300, "x2": -200, "y2": -300, "z": 64.093811},
+                       "b": {"x1": 0, "y1": 0, "x2": 0, "y2": y2, "z": 64.093811}}, f)
+
+    def load(self):
+        with mock.patch("analysis.assign_doorways", side_effect=assign_doorways) as assign:
+            smokes, doorways, valid_smokes = load_assigned_smokes(self.dataset_path, self.doorway_path,
+                                                                  self.cache_dir)
+        results = [(s.doorway.name, s.coverage) for s in valid_smokes]
+        self.assertEqual(sum(len(doorway.smokes) for doorway in doorways), len(valid_smokes))
+        return results, assign.called
+
+    def test_cached_results_match(self):
+        first, computed = self.load()
+        self.assertTrue(computed)
+        cached, computed = self.load()
+        self.assertFalse(computed)
+        self.assertEqual(cached, first)
+
+    def test_changed_inputs_recomputed(self):
+        first, _ = self.load()
+        self.write_doorways(200)
+        changed, computed = self.load()
+        self.assertTrue(computed)
+        self.assertNotEqual(changed, first)
+
+        with mock.patch.object(analysis, "SETTINGS", Settings(smoke_radius=100)):
+            _, computed = self.load()
+        self.assertTrue(computed)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 3)
+
+
+class TestImport(unittest.TestCase):
+    """Tests importing analysis has no side effects and settings are only read from the config file when used
+    """
+
+    def test_import_has_no_side_effects(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(analysis.__file__)))
+            code = "import sys, analysis; print('pygame' in sys.modules, sorted(analysis.SETTINGS.__dict__))"
+            result = subprocess.run([sys.executable, "-c", code], cwd=temp_dir, env=env, capture_output=True,
+                                    text=True, check=True)
+            self.assertEqual(result.stdout.split(), ["False", "['config_file',", "'overrides']"])
+            self.assertEqual(os.listdir(temp_dir), [])
+
+    def test_settings(self):
+        self.assertEqual(Settings(smoke_radius=100).smoke_radius, 100)
+        smoke = Smoke("demo", "player", "team", "T", 1, "00:00", False, 0, 0, 0)
+        self.assertEqual(Settings().smoke_radius, smoke.radius)
+        with self.assertRaises(FileNotFoundError):
+            Settings(config_file="missing.ini").smoke_radius
+        with self.assertRaises(TypeError):
+            Settings(smoke_radii=100)
+
+    def test_vector(self):
+        a, b = Vector2(3, 4), Vector2(0, 0)
+        self.assertEqual(a.distance_to(b), 5)
+        self.assertEqual(a - b + a, 2 * a)
+        self.assertEqual(a.dot(Vector2(1, 2)), 11)
+        self.assertEqual(list(a * 0.5), [1.5, 2])
+
+
+class TestParameterSweep(unittest.TestCase):
+    """Tests every sweep combination matches assigning the doorways with those settings directly
+    """
+
+    def setUp(self):
+        self.table = SmokeTable.from_records(synthetic_records(2000))
+        self.grid = {"smoke_radii": [100, 128], "detection_radii": [150, 256], "height_tolerances": [20, 54]}
+
+    def expected(self, smoke_radius, detection_radius, height_tolerance):
+        doorways = [Doorway(d.name, d.vector1.x, d.vector1.y, d.vector2.x, d.vector2.y, d.z, adjust_pw=False,
+                            target_radius=detection_radius, z_tolerance=height_tolerance) for d in synthetic_doorways()]
+        assigned, coverage = DoorwayGeometry(doorways).evaluate(self.table.x, self.table.y, self.table.z,
+                                                                smoke_radius)
+        valid = assigned >= 0
+        return assigned[valid], coverage[valid]
+
+    def check(self, workers):
+        rows = sweep_parameters(self.table, synthetic_doorways(), by_doorway=True, workers=workers, **self.grid)
+        names = [doorway.name for doorway in synthetic_doorways()]
+        for smoke_radius in self.grid["smoke_radii"]:
+            for detection_radius in self.grid["detection_radii"]:
+                for height_tolerance in self.grid["height_tolerances"]:
+                    assigned, coverage = self.expected(smoke_radius, detection_radius, height_tolerance)
+                    matching = [row for row in rows if (row["smoke_radius"], row["detection_radius"],
+                                row["height_tolerance"]) == (smoke_radius, detection_radius, height_tolerance)]
+                    overall = [row for row in matching if "doorway" not in row]
+                    self.assertEqual(len(overall), 1)
+                    self.assertEqual(overall[0]["count"], len(coverage))
+                    self.assertAlmostEqual(overall[0]["mean"], np.mean(coverage))
+                    self.assertAlmostEqual(overall[0]["median"], np.median(coverage))
+
+                    by_doorway = {row["doorway"]: row for row in matching if "doorway" in row}
+                    for i, name in enumerate(names):
+                        if not np.any(assigned == i):
+                            self.assertNotIn(name, by_doorway)
+                            continue
+                        self.assertEqual(by_doorway[name]["count"], np.sum(assigned == i))
+                        self.assertAlmostEqual(by_doorway[name]["max"], np.max(coverage[assigned == i]))
+
+    def test_matches_direct_assignment(self):
+        self.check(workers=1)
+
+    def test_parallel_workers(self):
+        self.check(workers=2)
+
+
+class TestMultiMap(unittest.TestCase):
+    """Tests smokes are partitioned by map and evaluated against that map's doorways
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.maps = {}
+        doorway_sets = {"de_mirage": {"a": (-300, -300, -200, -300), "b": (0, 0, 0, 150)},
+                        "de_inferno": {"c": (0, 0, 0, 150), "d": (300, 200, 380, 260)}}
+        for map_name, doorways in doorway_sets.items():
+            path = os.path.join(self.temp_dir.name, f"{map_name}.json")
+            with open(path, 'w') as f:
+                json.dump({name: dict(zip(("x1", "y1", "x2", "y2"), coords), z=64.093811)
+                           for name, coords in doorways.items()}, f)
+            self.maps[map_name] = MapConfig(map_name, path, 128, 256, 54)
+
+        self.records = synthetic_records(600)
+        for i, record in enumerate(self.records):
+            record["demoID"] += "-mirage" if i % 3 else "-inferno"
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def expected(self, map_name):
+        smokes = [smoke for smoke in SmokeTable.from_records(self.records).to_smokes()
+                  if smoke.demo_id.endswith(map_name[3:])]
+        return [(s.doorway.name, s.coverage) for s in assign_doorways(smokes, load_doorway_data(
+            self.maps[map_name].doorway_file))]
+
+    def check(self, workers):
+        doorways = evaluate_maps(SmokeTable.from_records(self.records), self.maps, workers)
+        for map_name, map_doorways in doorways.items():
+            smokes = sorted((smoke for doorway in map_doorways for smoke in doorway.smokes), key=lambda s: s.index)
+            self.assertEqual([(s.doorway.name, s.coverage) for s in smokes], self.expected(map_name))
+
+    def test_matches_per_map_assignment(self):
+        self.check(workers=1)
+
+    def test_parallel_workers(self):
+        self.check(workers=2)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,427 @@
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+import numpy as np
+
+from analysis import (Diagnostics, Doorway, Smoke, SmokeTable, DoorwayIndex, assign_doorways, calculate_coverages,
+                      convert_dataset, load_doorway_data, load_smoke_data, load_smoke_table, map_from_demo_id)
+from clustering import MIN_CLUSTER_SMOKES, MIN_SMOKES, discover_doorways
+from dataset import RECORD_KEYS, save_columns, secs_to_throw_time
+
+# Approximate extent of de_mirage in game units
+MAP_BOUNDS = ((-3000, 1500), (-2600, 900))
+Z_BOUNDS = (-200, 0)
+
+MIRAGE_DOORWAY_FILE = os.path.join("data", "mirage_entrances.json")
+PIPELINE_RESULTS_DIR = os.path.join("data", "benchmarks")
+
+# Spread of clustered smokes around a doorway midpoint, roughly how far off a lineup a thrown smoke lands
+CLUSTER_SPREAD = 150
+CLUSTER_Z_SPREAD = 30
+
+
+def synthetic_doorways(count, seed=0):
+    """Generates doorways of 80-160 units with random midpoints and orientations inside the map bounds.
+    """
+    rng = np.random.default_rng(seed)
+    doorways = []
+    for i in range(count):
+        mx = rng.uniform(*MAP_BOUNDS[0])
+        my = rng.uniform(*MAP_BOUNDS[1])
+        half_length = rng.uniform(40, 80)
+        angle = rng.uniform(0, np.pi)
+        dx, dy = half_length * np.cos(angle), half_length * np.sin(angle)
+        doorways.append(Doorway(f"synthetic-{i}", mx - dx, my - dy, mx + dx, my + dy, rng.uniform(*Z_BOUNDS)))
+    return doorways
+
+
+def synthetic_smokes(count, seed=0):
+    """Generates smokes uniformly distributed inside the map bounds.
+    """
+    rng = np.random.default_rng(seed)
+    xs = rng.uniform(*MAP_BOUNDS[0], size=count)
+    ys = rng.uniform(*MAP_BOUNDS[1], size=count)
+    zs = rng.uniform(*Z_BOUNDS, size=count)
+    return [Smoke(None, None, None, None, None, None, None, x, y, z) for x, y, z in zip(xs, ys, zs)]
+
+
+def synthetic_records(count, seed=0, demos=250, players=650, teams=150):
+    """Generates dataset.json style smoke records with realistic numbers of distinct demos, players and teams.
+    """
+    rng = np.random.default_rng(seed)
+    xs = rng.uniform(*MAP_BOUNDS[0], size=count)
+    ys = rng.uniform(*MAP_BOUNDS[1], size=count)
+    zs = rng.uniform(*Z_BOUNDS, size=count)
+    demo_ids = rng.integers(demos, size=count)
+    player_ids = rng.integers(players, size=count)
+    throw_secs = rng.integers(0, 115, size=count)
+    return [{"demoID": f"event-{demo_ids[i]}-team-vs-team-bo3-mirage",
+             "throwerName": f"player-{player_ids[i]}",
+             "throwerTeam": f"team-{player_ids[i] % teams}",
+             "throwerSide": "T" if i % 2 else "CT",
+             "roundNum": int(i % 30 + 1),
+             "throwTime": f"{throw_secs[i] // 60:02d}:{throw_secs[i] % 60:02d}",
+             "grenadeX": float(xs[i]),
+             "grenadeY": float(ys[i]),
+             "grenadeZ": float(zs[i]),
+             "roundWon": bool(i % 3)} for i in range(count)]
+
+
+def benchmark_doorways(count, doorway_file=MIRAGE_DOORWAY_FILE):
+    """Returns the real Mirage doorways, topped up with synthetic doorways if count is larger, or the first count
+    Mirage doorways if it is smaller.
+    """
+    doorways = load_doorway_data(doorway_file)[:count]
+    return doorways + synthetic_doorways(count - len(doorways))
+
+
+def synthetic_columns(count, layout="uniform", doorways=None, seed=0, demos=250, players=650, teams=150):
+    """Generates the columns of a synthetic dataset without building a dictionary per smoke, so datasets of
+    millions of smokes can be generated. With the "uniform" layout smokes are spread across the map bounds, with
+    "clustered" they land around the midpoints (and heights) of the given doorways. Returns the same as
+    dataset.records_to_columns().
+    """
+    rng = np.random.default_rng(seed)
+    if layout == "uniform":
+        x = rng.uniform(*MAP_BOUNDS[0], size=count)
+        y = rng.uniform(*MAP_BOUNDS[1], size=count)
+        z = rng.uniform(*Z_BOUNDS, size=count)
+    elif layout == "clustered":
+        midpoints = np.array([(d.midpoint.x, d.midpoint.y, d.z) for d in doorways])
+        centres = midpoints[rng.integers(len(midpoints), size=count)]
+        x = centres[:, 0] + rng.normal(0, CLUSTER_SPREAD, size=count)
+        y = centres[:, 1] + rng.normal(0, CLUSTER_SPREAD, size=count)
+        z = centres[:, 2] + rng.normal(0, CLUSTER_Z_SPREAD, size=count)
+    else:
+        raise ValueError(f"Unknown smoke layout [{layout}]")
+
+    player_codes = rng.integers(players, size=count, dtype=np.int32)
+    columns = {"x": x, "y": y, "z": z,
+               "round_num": (np.arange(count) % 30 + 1).astype(np.int16),
+               "throw_time": rng.integers(0, 115, size=count, dtype=np.int16),
+               "round_won": np.arange(count) % 3 != 0}
+    codes = {"demo_id": rng.integers(demos, size=count, dtype=np.int32),
+             "thrower": player_codes,
+             "team": player_codes % teams,
+             "side": (np.arange(count) % 2).astype(np.int32)}
+    categories = {"demo_id": [f"event-{i}-team-vs-team-bo3-mirage" for i in range(demos)],
+                  "thrower": [f"player-{i}" for i in range(players)],
+                  "team": [f"team-{i}" for i in range(teams)],
+                  "side": ["CT", "T"]}
+    return columns, codes, categories
+
+
+def write_synthetic_dataset(path, columns, codes, categories, dataset_format="columnar", chunk_size=100_000):
+    """Writes synthetic columns as a columnar dataset directory or a dataset.json file. The json file is written a
+    chunk of records at a time.
+    """
+    if dataset_format == "columnar":
+        save_columns(path, columns, codes, categories)
+        return
+
+    with open(path, 'w') as f:
+        f.write("[")
+        for start in range(0, len(columns["x"]), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            values = {column: np.asarray(categories[column], dtype=object)[column_codes[chunk]].tolist()
+                      for column, column_codes in codes.items()}
+            values.update({column: array[chunk].tolist() for column, array in columns.items()})
+            values["throw_time"] = [secs_to_throw_time(secs) for secs in values["throw_time"]]
+            records = (json.dumps({RECORD_KEYS[column]: values[column][i] for column in RECORD_KEYS})
+                       for i in range(len(values["x"])))
+            f.write(("," if start else "") + ",".join(records))
+        f.write("]")
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_pipeline(smoke_counts=(10_000, 100_000, 1_000_000), doorway_counts=(11, 500),
+                       layouts=("uniform", "clustered"), dataset_format="columnar", memory=True,
+                       results_dir=PIPELINE_RESULTS_DIR):
+    """Times the load_smoke_data, assign_doorways and calculate_coverages stages of the analysis pipeline
+    separately over synthetic datasets, for every combination of smoke count (up to 10M), doorway count and smoke
+    layout. If memory is True the peak traced memory of each stage is recorded too, which slows the stages down.
+
+    Results are printed and written to a timestamped json file in results_dir along with the commit and
+    environment, so runs can be compared with compare_pipeline_results(). Returns the path of the results file.
+    """
+    results = []
+
+    def run_stage(key, stage, function, *args):
+        if memory:
+            result, elapsed, peak, _ = _measure(function, *args)
+        else:
+            start_time = time.perf_counter()
+            result = function(*args)
+            elapsed, peak = time.perf_counter() - start_time, None
+        results.append(dict(key, stage=stage, seconds=elapsed, peak_mb=None if peak is None else peak / 2**20))
+
+        peak_mb = "-" if peak is None else f"{peak / 2**20:.1f}"
+        print(f"{key['smokes']:>10} {key['doorways']:>9} {key['layout']:>10} {stage:>10} {elapsed:>9.3f} "
+              f"{peak_mb:>10}")
+        return result
+
+    print(f"{'Smokes':>10} {'Doorways':>9} {'Layout':>10} {'Stage':>10} {'Time (s)':>9} {'Peak (MB)':>10}")
+    for smoke_count in smoke_counts:
+        for doorway_count in doorway_counts:
+            for layout in layouts:
+                key = {"smokes": smoke_count, "doorways": doorway_count, "layout": layout, "format": dataset_format}
+                doorways = benchmark_doorways(doorway_count)
+                with tempfile.TemporaryDirectory() as temp_dir:
+                    path = os.path.join(temp_dir, "dataset_columns" if dataset_format == "columnar" else
+                                        "dataset.json")
+                    write_synthetic_dataset(path, *synthetic_columns(smoke_count, layout, doorways), dataset_format)
+
+                    smokes = run_stage(key, "load", load_smoke_data, path)
+                    valid_smokes = run_stage(key, "assign", partial(assign_doorways, doorways=doorways,
+                                                                    coverage=False), smokes)
+                    run_stage(key, "coverage", calculate_coverages, valid_smokes)
+                    results[-1]["valid_smokes"] = len(valid_smokes)
+                    del smokes, valid_smokes
+
+    report = {"timestamp": datetime.now().isoformat(timespec="seconds"),
+              "commit": _git_commit(),
+              "python": platform.python_version(),
+              "numpy": np.__version__,
+              "platform": platform.platform(),
+              "cpu_count": os.cpu_count(),
+              "memory_traced": memory,
+              "results": results}
+    os.makedirs(results_dir, exist_ok=True)
+    results_file = os.path.join(results_dir, f"pipeline-{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(results_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    return results_file
+
+
+def compare_pipeline_results(baseline_file, results_file):
+    """Prints the change in time and peak memory of every stage between two benchmark_pipeline() results files.
+    """
+    def load(path):
+        with open(path, 'r') as f:
+            report = json.load(f)
+        return {(r["smokes"], r["doorways"], r["layout"], r["format"], r["stage"]): r for r in report["results"]}
+
+    baseline, results = load(baseline_file), load(results_file)
+    print(f"{'Smokes':>10} {'Doorways':>9} {'Layout':>10} {'Stage':>10} {'Time':>14} {'Peak':>14}")
+    for key in sorted(baseline.keys() & results.keys()):
+        old, new = baseline[key], results[key]
+        time_change = f"{new['seconds'] / old['seconds']:.2f}x" if old["seconds"] else "-"
+        peak_change = (f"{new['peak_mb'] / old['peak_mb']:.2f}x" if old["peak_mb"] and new["peak_mb"] is not None
+                       else "-")
+        smoke_count, doorway_count, layout, _, stage = key
+        print(f"{smoke_count:>10} {doorway_count:>9} {layout:>10} {stage:>10} {time_change:>14} {peak_change:>14}")
+
+
+def _measure(function, *args):
+    """Runs a function and returns its result, the time taken, the peak traced memory during the call and the memory
+    still allocated once it returns (i.e. the size of the result).
+    """
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start_time
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak, retained
+
+
+def benchmark_smoke_storage(smoke_count=35000):
+    """Compares loading a dataset as a list of Smoke objects (load_smoke_data) against the columnar SmokeTable
+    (load_smoke_table), reporting load time, peak memory and the memory retained by the loaded smokes.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "dataset.json")
+        with open(path, 'w') as f:
+            json.dump(synthetic_records(smoke_count), f)
+
+        print(f"{'Loader':>18} {'Time (s)':>10} {'Peak (MB)':>10} {'Retained (MB)':>14}")
+        for loader in (load_smoke_data, load_smoke_table):
+            smokes, elapsed, peak, retained = _measure(loader, path)
+            print(f"{loader.__name__:>18} {elapsed:>10.3f} {peak / 2**20:>10.1f} {retained / 2**20:>14.1f}")
+            del smokes
+
+
+def _size_on_disk(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(path, file)) for file in os.listdir(path))
+
+
+def benchmark_dataset_formats(smoke_count=500000):
+    """Compares the file size and load time of the dataset.json file (written with indent=2 as the parser does)
+    against the columnar dataset, both read fully and memory-mapped.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        json_path = os.path.join(temp_dir, "dataset.json")
+        columnar_path = os.path.join(temp_dir, "dataset_columns")
+        with open(json_path, 'w') as f:
+            json.dump(synthetic_records(smoke_count), f, indent=2)
+        convert_dataset(json_path, columnar_path)
+
+        print(f"{'Format':>24} {'Size (MB)':>10} {'Load (s)':>10}")
+        loads = [("json (load_smoke_data)", json_path, lambda: load_smoke_data(json_path)),
+                 ("json (load_smoke_table)", json_path, lambda: load_smoke_table(json_path)),
+                 ("columnar", columnar_path, lambda: load_smoke_table(columnar_path)),
+                 ("columnar (mmap)", columnar_path, lambda: load_smoke_table(columnar_path, mmap=True))]
+        for name, path, load in loads:
+            start_time = time.perf_counter()
+            load()
+            elapsed = time.perf_counter() - start_time
+            print(f"{name:>24} {_size_on_disk(path) / 2**20:>10.1f} {elapsed:>10.3f}")
+
+
+def benchmark_extraction(demo_files):
+    """Compares the per-demo parse time and the size of awpy's json output for the full and lightweight smoke
+    extraction modes. Requires awpy and some real demo files.
+    """
+    import parser
+
+    print(f"{'Mode':>12} {'Demos':>6} {'Time/demo (s)':>14} {'Written/demo (MB)':>18}")
+    for lightweight in (False, True):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            start_time = time.perf_counter()
+            for demo_file in demo_files:
+                parser.extract_smokes(demo_file, lightweight=lightweight, outpath=temp_dir)
+            elapsed = time.perf_counter() - start_time
+            written = _size_on_disk(temp_dir)
+
+        mode = "lightweight" if lightweight else "full"
+        print(f"{mode:>12} {len(demo_files):>6} {elapsed / len(demo_files):>14.2f} "
+              f"{written / len(demo_files) / 2**20:>18.1f}")
+
+
+def benchmark_doorway_index(doorway_counts=(10, 50, 100, 500, 1000, 2000), smoke_count=5000):
+    """Compares the time taken to find the doorways in range of every smoke using a full scan over all doorways
+    against the DoorwayIndex grid lookup, as the number of doorways grows.
+    """
+    smokes = synthetic_smokes(smoke_count)
+    print(f"{'Doorways':>10} {'Scan (s)':>10} {'Index (s)':>10} {'Speedup':>10}")
+    for count in doorway_counts:
+        doorways = synthetic_doorways(count)
+
+        start_time = time.perf_counter()
+        scanned = [[d for d in doorways if d.smoke_in_target_range(s)] for s in smokes]
+        scan_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        index = DoorwayIndex(doorways)
+        indexed = [index.doorways_in_range(s) for s in smokes]
+        index_time = time.perf_counter() - start_time
+
+        assert scanned == indexed
+        print(f"{count:>10} {scan_time:>10.3f} {index_time:>10.3f} {scan_time / index_time:>9.1f}x")
+
+
+def benchmark_diagnostics(smoke_count=50000, doorway_count=100, sample_every=1000):
+    """Times doorway assignment and the per-object Smoke.calculate_coverage() with diagnostics off (the default) and
+    on, while the root logger writes everything down to DEBUG level to a file. With diagnostics off no per-smoke
+    log records are formatted so the logging level doesn't matter.
+    """
+    doorways = synthetic_doorways(doorway_count)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        handler = logging.FileHandler(os.path.join(temp_dir, "analysis.log"))
+        root = logging.getLogger()
+        previous_level = root.level
+        root.addHandler(handler)
+        root.setLevel(logging.DEBUG)
+        try:
+            print(f"{'Mode':>12} {'Assign (s)':>11} {'Coverage (s)':>13} {'Logged (KB)':>12}")
+            for mode in ("default", "diagnostics"):
+                smokes = synthetic_smokes(smoke_count)
+                for doorway in doorways:
+                    doorway.smokes = []
+                log_size = os.path.getsize(handler.baseFilename)
+
+                with Diagnostics(sample_every) if mode == "diagnostics" else contextlib.nullcontext():
+                    start_time = time.perf_counter()
+                    valid_smokes = assign_doorways(smokes, doorways)
+                    assign_time = time.perf_counter() - start_time
+
+                    start_time = time.perf_counter()
+                    for smoke in valid_smokes:
+                        smoke.calculate_coverage()
+                    coverage_time = time.perf_counter() - start_time
+
+                handler.flush()
+                logged = os.path.getsize(handler.baseFilename) - log_size
+                print(f"{mode:>12} {assign_time:>11.3f} {coverage_time:>13.3f} {logged / 2**10:>12.1f}")
+        finally:
+            root.removeHandler(handler)
+            root.setLevel(previous_level)
+            handler.close()
+
+
+def _subprocess_time(code, runs):
+    """Median wall-clock time of running a snippet in a fresh interpreter.
+    """
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    times = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], env=env, check=True, capture_output=True)
+        times.append(time.perf_counter() - start_time)
+    return statistics.median(times)
+
+
+def benchmark_import(runs=7, workers=4):
+    """Compares the time to import analysis in a fresh interpreter against the interpreter and numpy alone, then times
+    starting a spawn pool (as used on Windows and macOS) whose workers each run one task.
+    """
+    interpreter = _subprocess_time("pass", runs)
+    print(f"{'Import':>10} {'Time (s)':>10}")
+    for module in ("numpy", "analysis"):
+        print(f"{module:>10} {_subprocess_time(f'import {module}', runs) - interpreter:>10.3f}")
+
+    times = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            list(executor.map(map_from_demo_id, ["demo-mirage"] * workers))
+        times.append(time.perf_counter() - start_time)
+    print(f"Spawning {workers} workers: {statistics.median(times):.3f}s")
+
+
+def benchmark_clustering(smoke_counts=(35_000, 1_000_000, 5_000_000), spot_count=40):
+    """Times discover_doorways() on smokes landing around the Mirage doorways and spot_count synthetic landing spots
+    which aren't in the doorway file. The density thresholds are scaled with the number of smokes.
+    """
+    known = benchmark_doorways(11)
+    spots = synthetic_doorways(spot_count, seed=1)
+    print(f"{'Smokes':>10} {'Time (s)':>10} {'Candidates':>11}")
+    for smoke_count in smoke_counts:
+        table = SmokeTable.from_columns(*synthetic_columns(smoke_count, "clustered", known + spots))
+        start_time = time.perf_counter()
+        records, _ = discover_doorways(table, known, output_path=None,
+                                       min_smokes=max(MIN_SMOKES, smoke_count // 1000),
+                                       min_cluster_smokes=max(MIN_CLUSTER_SMOKES, smoke_count // 500))
+        elapsed = time.perf_counter() - start_time
+        print(f"{smoke_count:>10} {elapsed:>10.3f} {len(records):>11}")
+
+
+if __name__ == "__main__":
+    benchmark_smoke_storage()
+    benchmark_dataset_formats()
+    benchmark_doorway_index()
+    benchmark_diagnostics()
+    benchmark_pipeline()
+    benchmark_import()
+    benchmark_clustering()
@@ -0,0 +1,167 @@
+import json
+import logging
+import os
+import numpy as np
+
+import instrumentation
+from analysis import CHUNK_SIZE, DOORWAY_Z_OFFSET, PLAYER_WIDTH, DoorwayGeometry
+
+CANDIDATE_DOORWAY_FILE = os.path.join("data", "candidate_entrances.json")
+
+# Smokes are binned into cells CELL_SIZE units wide and HEIGHT_CELL_SIZE units high. A cell is dense if its 3x3x3
+# block of cells holds at least MIN_SMOKES smokes, connected dense cells form a cluster and clusters with fewer than
+# MIN_CLUSTER_SMOKES smokes are dropped.
+CELL_SIZE = 64
+HEIGHT_CELL_SIZE = 54
+MIN_SMOKES = 25
+MIN_CLUSTER_SMOKES = 50
+
+# Each cell's (x, y, z) index is packed into one int64 key using KEY_BITS per axis
+KEY_BITS = 21
+KEY_OFFSET = 1 << (KEY_BITS - 1)
+
+# Offsets to a cell's 26 neighbours (and itself) in key space
+NEIGHBOUR_OFFSETS = np.array([(dx << (2 * KEY_BITS)) + (dy << KEY_BITS) + dz
+                              for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)], dtype=np.int64)
+
+
+def cell_keys(x, y, z, cell_size=CELL_SIZE, height_cell_size=HEIGHT_CELL_SIZE):
+    """Packed key of the grid cell each smoke lands in.
+    """
+    cx = np.floor(np.asarray(x) / cell_size).astype(np.int64) + KEY_OFFSET
+    cy = np.floor(np.asarray(y) / cell_size).astype(np.int64) + KEY_OFFSET
+    cz = np.floor(np.asarray(z) / height_cell_size).astype(np.int64) + KEY_OFFSET
+    return (cx << (2 * KEY_BITS)) | (cy << KEY_BITS) | cz
+
+
+def _count_cells(x, y, z, cell_size, height_cell_size):
+    return np.unique(cell_keys(x, y, z, cell_size, height_cell_size), return_counts=True)
+
+
+def count_cells(x, y, z, cell_size=CELL_SIZE, height_cell_size=HEIGHT_CELL_SIZE, chunk_size=CHUNK_SIZE * 10):
+    """Counts the smokes in each occupied cell. The smokes are counted in chunks, so the cell keys of every smoke
+    aren't held at once, and the per-chunk counts are merged. Returns the sorted cell keys and their counts.
+    """
+    counted = [_count_cells(x[start:start + chunk_size], y[start:start + chunk_size], z[start:start + chunk_size],
+                            cell_size, height_cell_size) for start in range(0, len(x), chunk_size)]
+    if len(counted) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    keys, inverse = np.unique(np.concatenate([keys for keys, _ in counted]), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate([counts for _, counts in counted])).astype(np.int64)
+    return keys, counts
+
+
+def _neighbours(keys, offset):
+    """Index of the cell at an offset from each cell in the sorted keys, -1 if it isn't occupied.
+    """
+    shifted = keys + offset
+    positions = np.minimum(np.searchsorted(keys, shifted), len(keys) - 1)
+    return np.where(keys[positions] == shifted, positions, -1)
+
+
+def dense_cells(keys, counts, min_smokes=MIN_SMOKES):
+    """Boolean mask of the cells whose 3x3x3 block of cells holds at least min_smokes smokes.
+    """
+    block_counts = np.zeros(len(keys), dtype=np.int64)
+    for offset in NEIGHBOUR_OFFSETS:
+        neighbours = _neighbours(keys, offset)
+        block_counts += np.where(neighbours >= 0, counts[neighbours], 0)
+    return block_counts >= min_smokes
+
+
+def label_cells(keys, dense):
+    """Labels each connected group of dense cells (touching on a face, edge or corner) with the smallest index in the
+    group, non-dense cells are -1.
+    """
+    labels = np.where(dense, np.arange(len(keys)), -1)
+    dense_keys = keys[dense]
+    dense_index = np.flatnonzero(dense)
+    if len(dense_keys) == 0:
+        return labels
+
+    pairs = [(dense_index[found >= 0], dense_index[found[found >= 0]])
+             for found in (_neighbours(dense_keys, offset) for offset in NEIGHBOUR_OFFSETS if offset > 0)]
+    a = np.concatenate([pair[0] for pair in pairs])
+    b = np.concatenate([pair[1] for pair in pairs])
+
+    # Propagates the smallest label across every pair of neighbouring dense cells until nothing changes, pointer
+    # jumping (labels[labels]) collapses long chains
+    while True:
+        smallest = np.minimum(labels[a], labels[b])
+        updated = labels.copy()
+        np.minimum.at(updated, a, smallest)
+        np.minimum.at(updated, b, smallest)
+        updated[dense] = updated[updated[dense]]
+        if np.array_equal(updated, labels):
+            return labels
+        labels = updated
+
+
+@instrumentation.timed("clustering.cluster_smokes")
+def cluster_smokes(x, y, z, cell_size=CELL_SIZE, height_cell_size=HEIGHT_CELL_SIZE, min_smokes=MIN_SMOKES,
+                   min_cluster_smokes=MIN_CLUSTER_SMOKES, chunk_size=CHUNK_SIZE * 10):
+    """Grid based density clustering of smoke landing positions, an approximation of DBSCAN which only compares
+    cells rather than pairs of smokes so it runs in near-linear time. Returns the cluster of each smoke, numbered
+    from 0 in order of decreasing size, or -1 for smokes outside any cluster.
+    """
+    x, y, z = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64), np.asarray(z, dtype=np.float64)
+    keys, counts = count_cells(x, y, z, cell_size, height_cell_size, chunk_size)
+    cell_labels = label_cells(keys, dense_cells(keys, counts, min_smokes))
+
+    # Smokes take the label of their cell, then the clusters are renumbered by size
+    cells = np.searchsorted(keys, cell_keys(x, y, z, cell_size, height_cell_size))
+    labels = cell_labels[cells] if len(keys) else np.empty(0, dtype=np.int64)
+    clustered = labels >= 0
+    groups, inverse, sizes = np.unique(labels[clustered], return_inverse=True, return_counts=True)
+    order = np.lexsort((groups, -sizes))
+    ranks = np.full(len(groups), -1)
+    kept = order[sizes[order] >= min_cluster_smokes]
+    ranks[kept] = np.arange(len(kept))
+
+    result = np.full(len(x), -1, dtype=np.int64)
+    result[clustered] = ranks[inverse]
+    instrumentation.count("clustering.smokes", len(x))
+    instrumentation.count("clustering.clusters", len(kept))
+    return result
+
+
+def candidate_doorways(x, y, z, labels, prefix="cluster"):
+    """Converts each cluster into a candidate doorway record in the mirage_entrances.json format. The doorway is
+    centred on the cluster and runs along its longest axis for two standard deviations either side, with the height
+    of the median smoke. Records are named <prefix>-<n> in cluster order.
+    """
+    records = {}
+    for cluster in range(labels.max(initial=-1) + 1):
+        members = labels == cluster
+        points = np.column_stack((x[members], y[members]))
+        centre = points.mean(axis=0)
+        variances, axes = np.linalg.eigh(np.cov(points, rowvar=False))
+        half_length = max(2 * np.sqrt(max(variances[-1], 0)), PLAYER_WIDTH / 2)
+        x1, y1 = centre - axes[:, -1] * half_length
+        x2, y2 = centre + axes[:, -1] * half_length
+        records[f"{prefix}-{cluster}"] = {"x1": round(float(x1), 1), "y1": round(float(y1), 1),
+                                          "x2": round(float(x2), 1), "y2": round(float(y2), 1),
+                                          "z": round(float(np.median(z[members])) + DOORWAY_Z_OFFSET, 2)}
+    return records
+
+
+@instrumentation.timed("clustering.discover_doorways")
+def discover_doorways(table, doorways, output_path=CANDIDATE_DOORWAY_FILE, **cluster_settings):
+    """Clusters the smokes in a SmokeTable which aren't in range of any of the known doorways and writes a candidate
+    doorway for each cluster to output_path (unless it is None), in the same format as the doorway file. Returns the
+    candidate records and the cluster of each smoke (-1 for assigned or unclustered smokes).
+    """
+    assigned = DoorwayGeometry(doorways).assign(table.x, table.y, table.z) if doorways else np.full(len(table), -1)
+    unassigned = np.flatnonzero(assigned < 0)
+    labels = np.full(len(table), -1, dtype=np.int64)
+    labels[unassigned] = cluster_smokes(table.x[unassigned], table.y[unassigned], table.z[unassigned],
+                                        **cluster_settings)
+    records = candidate_doorways(table.x, table.y, table.z, labels)
+    logging.info("Found %d candidate doorways from %d unassigned smokes", len(records), len(unassigned))
+
+    if output_path is not None:
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        with open(output_path, 'w') as f:
+            json.dump(records, f, indent=4)
+    return records, labels
@@ -0,0 +1,80 @@
+import json
+import os
+import tempfile
+import unittest
+import numpy as np
+
+from analysis import SmokeTable, load_doorway_data
+from analysis_test import synthetic_records, synthetic_doorways
+from clustering import cluster_smokes, count_cells, discover_doorways
+
+# Landing spots the synthetic smokes are thrown at, well away from each other and the test doorways
+SPOTS = [(-1500, 900, -100), (1200, -1100, 0), (1500, 1500, -50)]
+
+
+def spot_smokes(count, spread=30, seed=0):
+    """Generates smokes scattered around each landing spot, with count smokes per spot
+    """
+    rng = np.random.default_rng(seed)
+    points = np.concatenate([np.column_stack((rng.normal(x, spread, count), rng.normal(y, spread * 3, count),
+                                              rng.normal(z, 5, count))) for x, y, z in SPOTS])
+    return points[:, 0], points[:, 1], points[:, 2]
+
+
+class TestClustering(unittest.TestCase):
+    """Tests dense landing spots are found among background smokes and written as candidate doorways
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_finds_landing_spots(self):
+        x, y, z = spot_smokes(300)
+        rng = np.random.default_rng(1)
+        noise = rng.uniform(-2000, 2000, size=(500, 3)) * [1, 1, 0.1]
+        x, y, z = np.concatenate((x, noise[:, 0])), np.concatenate((y, noise[:, 1])), np.concatenate((z, noise[:, 2]))
+
+        labels = cluster_smokes(x, y, z, min_smokes=20, min_cluster_smokes=100)
+        self.assertEqual(labels.max() + 1, len(SPOTS))
+        for cluster in range(len(SPOTS)):
+            centre = np.array([x[labels == cluster].mean(), y[labels == cluster].mean()])
+            self.assertLess(min(np.hypot(*(centre - spot[:2])) for spot in SPOTS), 20)
+            self.assertGreater(np.count_nonzero(labels == cluster), 250)
+        self.assertLess(np.count_nonzero(labels[900:] >= 0), 25)
+
+    def test_chunked_counts_match(self):
+        x, y, z = spot_smokes(200)
+        keys, counts = count_cells(x, y, z, chunk_size=len(x))
+        chunked_keys, chunked_counts = count_cells(x, y, z, chunk_size=97)
+        np.testing.assert_array_equal(keys, chunked_keys)
+        np.testing.assert_array_equal(counts, chunked_counts)
+        self.assertEqual(counts.sum(), len(x))
+
+    def test_candidate_doorways_file(self):
+        table = SmokeTable.from_records(synthetic_records(2000))
+        x, y, z = spot_smokes(200)
+        spots = SmokeTable.from_records([dict(synthetic_records(1)[0], grenadeX=float(sx), grenadeY=float(sy),
+                                              grenadeZ=float(sz)) for sx, sy, sz in zip(x, y, z)])
+        table = SmokeTable.concatenate([table, spots])
+
+        path = os.path.join(self.temp_dir.name, "candidates.json")
+        records, labels = discover_doorways(table, synthetic_doorways(), path, min_smokes=100, min_cluster_smokes=100)
+        self.assertEqual(sorted(records), ["cluster-0", "cluster-1", "cluster-2"])
+        self.assertTrue((labels[:2000] == -1).all())
+
+        with open(path, 'r') as f:
+            self.assertEqual(json.load(f), records)
+        doorways = load_doorway_data(path)
+        for doorway in doorways:
+            nearest = min(SPOTS, key=lambda spot: np.hypot(doorway.midpoint.x - spot[0], doorway.midpoint.y - spot[1]))
+            self.assertLess(np.hypot(doorway.midpoint.x - nearest[0], doorway.midpoint.y - nearest[1]), 50)
+            self.assertAlmostEqual(doorway.z, nearest[2], delta=2)
+            # The spots are spread further in y, so each doorway runs along the y axis
+            self.assertGreater(abs(doorway.vector2.y - doorway.vector1.y), abs(doorway.vector2.x - doorway.vector1.x))
+
+
+if __name__ == '__main__':
+    unittest.main()
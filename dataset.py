@@ -0,0 +1,203 @@
+import json
+import os
+import re
+import numpy as np
+
+# Locations of the json and columnar datasets, relative to the repository root
+DATASET_FILE = os.path.join("data", "dataset.json")
+COLUMNAR_DATASET_DIR = os.path.join("data", "dataset_columns")
+
+# Version of the columnar dataset layout, stored in the metadata file
+FORMAT_VERSION = 1
+METADATA_FILE = "metadata.json"
+
+# Columns stored as integer codes into a list of category values
+CATEGORICAL = ("demo_id", "thrower", "team", "side")
+
+# Columns stored directly as typed arrays
+NUMERIC = {"x": np.float64, "y": np.float64, "z": np.float64,
+           "round_num": np.int16, "throw_time": np.int16, "round_won": np.bool_}
+
+# Dataset json key for each column
+RECORD_KEYS = {"demo_id": "demoID", "thrower": "throwerName", "team": "throwerTeam", "side": "throwerSide",
+               "round_num": "roundNum", "throw_time": "throwTime", "round_won": "roundWon",
+               "x": "grenadeX", "y": "grenadeY", "z": "grenadeZ"}
+
+
+def throw_time_to_secs(time_string):
+    """Converts a "MM:SS" round clock time into seconds, returns -1 if the time is missing.
+    """
+    if not time_string:
+        return -1
+    minutes, seconds = time_string.split(":")
+    return int(minutes) * 60 + int(seconds)
+
+
+def secs_to_throw_time(secs):
+    """Converts seconds back into the "MM:SS" round clock format used by the dataset.
+    """
+    return None if secs < 0 else f"{secs // 60:02d}:{secs % 60:02d}"
+
+
+def iter_smoke_records(path, buffer_size=2**16):
+    """Incrementally reads the smoke dictionaries from a dataset json array one at a time, only ever holding a
+    buffer of the file and the current record in memory.
+    """
+    decoder = json.JSONDecoder()
+    separators = re.compile(r"[\s,]*")
+    with open(path, 'r') as f:
+        buffer, pos = "", 0
+        started = False
+
+        while True:
+            # Skips whitespace and the commas between records, reading more of the file when the buffer runs out
+            pos = separators.match(buffer, pos).end()
+            if pos == len(buffer):
+                chunk = f.read(buffer_size)
+                if not chunk:
+                    raise ValueError(f"Unexpected end of dataset file [{path}]")
+                buffer, pos = chunk, 0
+                continue
+
+            if not started:
+                if buffer[pos] != "[":
+                    raise ValueError(f"Dataset file [{path}] does not contain a json array")
+                started = True
+                pos += 1
+                continue
+
+            if buffer[pos] == "]":
+                return
+
+            try:
+                record, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Record is split across the buffer boundary
+                chunk = f.read(buffer_size)
+                if not chunk:
+                    raise
+                buffer, pos = buffer[pos:] + chunk, 0
+                continue
+
+            yield record
+            pos = end
+
+
+def records_to_columns(records):
+    """Converts a list of dataset.json style smoke dictionaries into typed column arrays. Returns the numeric
+    columns, the integer codes of the categorical columns and the category values for each code.
+    """
+    columns, codes, categories = {}, {}, {}
+    for column in CATEGORICAL:
+        values = [record[RECORD_KEYS[column]] for record in records]
+        # Dictionaries preserve insertion order so categories are ordered by first appearance
+        lookup = {value: code for code, value in enumerate(dict.fromkeys(values))}
+        codes[column] = np.fromiter((lookup[value] for value in values), dtype=np.int32, count=len(values))
+        categories[column] = list(lookup)
+
+    for column, dtype in NUMERIC.items():
+        values = (record[RECORD_KEYS[column]] for record in records)
+        if column == "throw_time":
+            values = map(throw_time_to_secs, values)
+        columns[column] = np.fromiter(values, dtype=dtype, count=len(records))
+    return columns, codes, categories
+
+
+def save_columns(path, columns, codes, categories):
+    """Writes the columns to a directory containing one .npy file per column and a metadata file holding the
+    category values. Every column can be memory-mapped when it is read back.
+    """
+    os.makedirs(path, exist_ok=True)
+    for column in NUMERIC:
+        np.save(os.path.join(path, f"{column}.npy"), np.asarray(columns[column], dtype=NUMERIC[column]))
+    for column in CATEGORICAL:
+        np.save(os.path.join(path, f"{column}.npy"), np.asarray(codes[column], dtype=np.int32))
+
+    metadata = {"version": FORMAT_VERSION,
+                "length": len(columns["x"]),
+                "categories": {column: list(categories[column]) for column in CATEGORICAL}}
+    with open(os.path.join(path, METADATA_FILE), 'w') as f:
+        json.dump(metadata, f)
+
+
+def load_columns(path, mmap=False):
+    """Reads a columnar dataset directory written by save_columns(). If mmap is True the column arrays are
+    memory-mapped read-only rather than read into memory.
+    """
+    with open(os.path.join(path, METADATA_FILE), 'r') as f:
+        metadata = json.load(f)
+    if metadata["version"] != FORMAT_VERSION:
+        raise ValueError(f"Unsupported columnar dataset version {metadata['version']} in [{path}]")
+
+    # The metadata is written last by append_columns(), so rows past its length are from an unfinished append
+    mmap_mode = 'r' if mmap else None
+    length = metadata["length"]
+    columns = {column: np.load(os.path.join(path, f"{column}.npy"), mmap_mode=mmap_mode)[:length]
+               for column in NUMERIC}
+    codes = {column: np.load(os.path.join(path, f"{column}.npy"), mmap_mode=mmap_mode)[:length]
+             for column in CATEGORICAL}
+    return columns, codes, metadata["categories"]
+
+
+# Functions reading and writing the header of each .npy format version
+NPY_HEADERS = {(1, 0): (np.lib.format.read_array_header_1_0, np.lib.format.write_array_header_1_0),
+               (2, 0): (np.lib.format.read_array_header_2_0, np.lib.format.write_array_header_2_0)}
+
+
+def _append_npy(file, values, length):
+    """Appends values to a one dimensional .npy file in place, keeping its first length values. The data is
+    written before the header, so a reader (or an interrupted append) never sees a length past the written data.
+    """
+    with open(file, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        read_header, write_header = NPY_HEADERS[version]
+        shape, fortran_order, dtype = read_header(f)
+        header_size = f.tell()
+        if len(shape) != 1 or shape[0] < length:
+            raise ValueError(f"Column file [{file}] holds {shape} values, expected at least {length}")
+
+        f.seek(header_size + length * dtype.itemsize)
+        f.truncate()
+        f.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+
+        # numpy leaves space in the header for the length to grow, so it can be rewritten in place
+        header = {"shape": (length + len(values),), "fortran_order": fortran_order,
+                  "descr": np.lib.format.dtype_to_descr(dtype)}
+        f.seek(0)
+        write_header(f, header)
+        if f.tell() != header_size:
+            raise ValueError(f"Column file [{file}] header can't be resized in place")
+
+
+def append_columns(path, columns, codes, categories):
+    """Appends rows, as returned by records_to_columns(), to a columnar dataset directory in place. The codes are
+    remapped onto the dataset's categories, adding any new category values after the existing ones, so the result
+    matches saving the concatenated rows. Only the new rows and the metadata file are written, the metadata last so
+    readers keep seeing the previous rows until the append is complete.
+    """
+    with open(os.path.join(path, METADATA_FILE), 'r') as f:
+        metadata = json.load(f)
+    if metadata["version"] != FORMAT_VERSION:
+        raise ValueError(f"Unsupported columnar dataset version {metadata['version']} in [{path}]")
+    length = metadata["length"]
+
+    for column in CATEGORICAL:
+        existing = metadata["categories"][column]
+        lookup = {value: code for code, value in enumerate(existing)}
+        remap = np.array([lookup.setdefault(value, len(lookup)) for value in categories[column]], dtype=np.int32)
+        metadata["categories"][column] = list(lookup)
+        _append_npy(os.path.join(path, f"{column}.npy"), remap[np.asarray(codes[column], dtype=np.int64)], length)
+    for column in NUMERIC:
+        _append_npy(os.path.join(path, f"{column}.npy"), columns[column], length)
+
+    metadata["length"] = length + len(columns["x"])
+    metadata_file = os.path.join(path, METADATA_FILE)
+    with open(metadata_file + ".tmp", 'w') as f:
+        json.dump(metadata, f)
+    os.replace(metadata_file + ".tmp", metadata_file)
+
+
+def is_columnar_dataset(path):
+    """Checks if a path is a columnar dataset directory rather than a json file.
+    """
+    return os.path.isfile(os.path.join(path, METADATA_FILE))
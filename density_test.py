@@ -0,0 +1,58 @@
+import math
+import unittest
+import numpy as np
+
+from density import GridDensity, bandwidth_factor
+
+
+def clustered_points(count, seed=0):
+    """Generates points clustered around a dozen centres, roughly like smokes thrown at common lineups
+    """
+    rng = np.random.default_rng(seed)
+    centres = rng.uniform(100, 900, size=(12, 2))
+    points = centres[rng.integers(len(centres), size=count)] + rng.normal(0, 40, size=(count, 2))
+    return points[:, 0], points[:, 1]
+
+
+def exact_kde(x, y, px, py):
+    """Evaluates the Gaussian KDE of (x, y) at each (px, py) directly, as scipy.stats.gaussian_kde does
+    """
+    covariance = np.cov(np.vstack((x, y))) * bandwidth_factor(len(x))**2
+    inverse = np.linalg.inv(covariance)
+    dx, dy = px[:, None] - x, py[:, None] - y
+    distance = inverse[0, 0] * dx * dx + 2 * inverse[0, 1] * dx * dy + inverse[1, 1] * dy * dy
+    return np.exp(-0.5 * distance).sum(axis=1) / (len(x) * 2 * math.pi * math.sqrt(np.linalg.det(covariance)))
+
+
+class TestGridDensity(unittest.TestCase):
+    """Tests the binned FFT density matches the exact KDE used for the heatmap colouring
+    """
+
+    def test_matches_exact_kde(self):
+        x, y = clustered_points(2000)
+        expected = exact_kde(x, y, x, y)
+        density = GridDensity(x, y).at(x, y)
+        self.assertLess(np.abs(density - expected).max(), 0.01 * expected.max())
+
+        def colour(z):
+            return (z - z.min()) / (z.max() - z.min())
+        self.assertLess(np.abs(colour(density) - colour(expected)).max(), 0.01)
+
+    def test_raster_integrates_to_one(self):
+        x, y = clustered_points(5000)
+        grid = GridDensity(x, y, grid_size=256, bw_adjust=0.35)
+        area = (grid.x[1] - grid.x[0]) * (grid.y[1] - grid.y[0])
+        self.assertAlmostEqual(grid.density.sum() * area, 1, places=2)
+        self.assertEqual(grid.density.shape, (256, 256))
+        self.assertEqual(grid.at([grid.x[0] - 1], [grid.y[0]]).tolist(), [0.0])
+
+    def test_bandwidth_methods(self):
+        self.assertEqual(bandwidth_factor(64), 0.5)
+        self.assertEqual(bandwidth_factor(64, "silverman"), 0.5)
+        self.assertEqual(bandwidth_factor(64, 0.2), 0.2)
+        with self.assertRaises(ValueError):
+            bandwidth_factor(64, "unknown")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+import contextlib
+import cProfile
+import functools
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+REPORT_DIR = "logs"
+
+# Number of functions (by cumulative time) kept from each stage's profile in the report
+PROFILE_FUNCTIONS = 25
+
+
+class Timer():
+    """Handle for a running stage, elapsed is the time since the stage started until it finishes.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.end = None
+
+    @property
+    def elapsed(self):
+        return (self.end or time.perf_counter()) - self.start
+
+
+class Instrumentation():
+    """Collects the wall-clock time of named stages, counters and optional cProfile captures for one run. Stages
+    can be timed from any thread, profiles are only captured for the stages named in profile (or every stage if it
+    is True) and only on the outermost profiled stage of a thread, as one thread can only run one profiler.
+    """
+
+    def __init__(self, name="run", profile=()):
+        self.name = name
+        self.profile = profile
+        self.started = datetime.now()
+        self._start = time.perf_counter()
+        self.stages = {}
+        self.counters = Counter()
+        self.profiles = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _profiled(self, name):
+        return (self.profile is True or name in self.profile) and not getattr(self._local, "profiling", False)
+
+    @contextlib.contextmanager
+    def stage(self, name, log=False):
+        """Times the body of a with block as one call of the named stage, yielding its Timer. If log is True the
+        time taken is logged once the stage finishes.
+        """
+        profiler = cProfile.Profile() if self._profiled(name) else None
+        if profiler is not None:
+            self._local.profiling = True
+            profiler.enable()
+        timer = Timer(name)
+        try:
+            yield timer
+        finally:
+            timer.end = time.perf_counter()
+            if profiler is not None:
+                profiler.disable()
+                self._local.profiling = False
+            self.record(name, timer.elapsed, profiler)
+            if log:
+                logging.info(f"Time taken to execute {name} - {timer.elapsed:.2f}s")
+
+    def record(self, name, seconds, profiler=None):
+        """Records one call of a stage timed elsewhere, e.g. in a worker process.
+        """
+        with self._lock:
+            stats = self.stages.setdefault(name, {"calls": 0, "total_seconds": 0.0, "min_seconds": seconds,
+                                                  "max_seconds": seconds})
+            stats["calls"] += 1
+            stats["total_seconds"] += seconds
+            stats["min_seconds"] = min(stats["min_seconds"], seconds)
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            if profiler is not None:
+                self.profiles.setdefault(name, []).append(profiler)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def _profile_summary(self, profilers):
+        stats = pstats.Stats(*profilers)
+        functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:PROFILE_FUNCTIONS]
+        return [{"function": f"{file}:{line}({function})", "calls": calls, "total_seconds": total,
+                 "cumulative_seconds": cumulative}
+                for (file, line, function), (_, calls, total, cumulative, _) in functions]
+
+    def report(self):
+        """Returns the run's stages, counters and profiles as a json serialisable dictionary.
+        """
+        with self._lock:
+            stages = {name: dict(stats, mean_seconds=stats["total_seconds"] / stats["calls"])
+                      for name, stats in self.stages.items()}
+            return {"run": self.name,
+                    "started": self.started.isoformat(timespec="seconds"),
+                    "wall_seconds": time.perf_counter() - self._start,
+                    "stages": stages,
+                    "counters": dict(self.counters),
+                    "profiles": {name: self._profile_summary(profilers)
+                                 for name, profilers in self.profiles.items()}}
+
+    def write_report(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        return path
+
+
+# Instrumentation that stages are recorded to, replaced for the duration of a run()
+_current = Instrumentation()
+
+
+def current():
+    return _current
+
+
+def stage(name, log=False):
+    return _current.stage(name, log)
+
+
+def record(name, seconds):
+    _current.record(name, seconds)
+
+
+def count(name, amount=1):
+    _current.count(name, amount)
+
+
+def timed(name, log=False):
+    """Decorator which times every call of a function as the named stage of the current run.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with _current.stage(name, log):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextlib.contextmanager
+def run(name, report_dir=REPORT_DIR, profile=()):
+    """Records every stage and counter inside the with block to a new Instrumentation, then writes its report to
+    <report_dir>/<name>-<timestamp>.json (unless report_dir is None). profile names the stages to capture with
+    cProfile, or True for all of them.
+    """
+    global _current
+    instrumentation, previous = Instrumentation(name, profile), _current
+    _current = instrumentation
+    try:
+        yield instrumentation
+    finally:
+        _current = previous
+        if report_dir is not None:
+            instrumentation.write_report(
+                os.path.join(report_dir, f"{name}-{instrumentation.started:%Y%m%d-%H%M%S}.json"))
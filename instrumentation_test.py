@@ -0,0 +1,85 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import instrumentation
+
+
+@instrumentation.timed("test.sleep")
+def sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def busy_work():
+    return sum(i * i for i in range(20000))
+
+
+class TestInstrumentation(unittest.TestCase):
+    """Tests stage timing, counters and profiles are recorded to the current run and written to its report
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def reports(self):
+        reports = []
+        for file in os.listdir(self.temp_dir.name):
+            with open(os.path.join(self.temp_dir.name, file), 'r') as f:
+                reports.append(json.load(f))
+        return reports
+
+    def test_stages_and_counters(self):
+        with instrumentation.run("test", report_dir=self.temp_dir.name) as run:
+            self.assertEqual(sleep(0.01), 0.01)
+            with instrumentation.stage("test.block") as timer:
+                sleep(0.02)
+            instrumentation.count("test.items", 3)
+            instrumentation.count("test.items")
+            instrumentation.record("test.worker", 1.5)
+        self.assertGreaterEqual(timer.elapsed, 0.02)
+        self.assertIsNot(instrumentation.current(), run)
+
+        report, = self.reports()
+        self.assertEqual(report["run"], "test")
+        self.assertEqual(report["stages"]["test.sleep"]["calls"], 2)
+        self.assertGreaterEqual(report["stages"]["test.sleep"]["total_seconds"], 0.03)
+        self.assertGreaterEqual(report["stages"]["test.block"]["total_seconds"],
+                                report["stages"]["test.sleep"]["max_seconds"])
+        self.assertEqual(report["stages"]["test.worker"]["mean_seconds"], 1.5)
+        self.assertEqual(report["counters"], {"test.items": 4})
+
+    def test_stages_from_threads(self):
+        with instrumentation.run("threads", report_dir=None) as run:
+            threads = [threading.Thread(target=sleep, args=(0.01,)) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(run.report()["stages"]["test.sleep"]["calls"], 8)
+        self.assertEqual(self.reports(), [])
+
+    def test_profiled_stages(self):
+        with instrumentation.run("profile", report_dir=self.temp_dir.name, profile=["test.profiled"]):
+            with instrumentation.stage("test.profiled"):
+                busy_work()
+                with instrumentation.stage("test.profiled"):
+                    busy_work()
+            with instrumentation.stage("test.unprofiled"):
+                busy_work()
+
+        report, = self.reports()
+        self.assertEqual(list(report["profiles"]), ["test.profiled"])
+        functions = {entry["function"].split("(")[-1].rstrip(")"): entry
+                     for entry in report["profiles"]["test.profiled"]}
+        self.assertEqual(functions["busy_work"]["calls"], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
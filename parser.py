@@ -2,42 +2,243 @@ import time
 import json
 import logging
 import os
+import tempfile
 
 from awpy.parser import DemoParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from configparser import ConfigParser
+from dataset import COLUMNAR_DATASET_DIR, DATASET_FILE, records_to_columns, save_columns
 
-logging.basicConfig(level=logging.INFO, filename='logs//parser.log',
-                    filemode='w', format='%(name)s - %(levelname)s - %(message)s')
+import instrumentation
 
 # Read config.ini file
 config = ConfigParser()
-config.read("data\\config.ini")
+config.read(os.path.join("data", "config.ini"))
 
-DEMO_DIR = config["Data"]["demo_directory"] + "\\mirage_demos"
-DATASET_FILE = "data\\dataset.json"
+# Directory the scraper extracts the demos of every target map to
+DEMO_DIR = os.path.join(config["Data"]["demo_directory"], "demos")
+PARSER_WORKERS = config.getint("Parser", "workers", fallback=1)
 
+# Per-demo cache of extracted smokes, the manifest records which demo file (and version of it) each shard came from
+SMOKE_CACHE_DIR = os.path.join(config["Data"]["demo_directory"], "smoke_cache")
+MANIFEST_FILE = "manifest.json"
 
-def generate_dataset():
-    logging.info(f"Generating .json Dataset...")
+# Settings which change the extracted smokes, cached shards are reparsed if any of these change
+PARSER_SETTINGS = {"parse_rate": 128, "extraction_version": 1}
+
+# Lightweight extraction skips the per-frame player data and doesn't keep awpy's json output, the extracted smokes
+# are identical so this isn't part of PARSER_SETTINGS
+LIGHTWEIGHT_EXTRACTION = config.getboolean("Parser", "lightweight", fallback=True)
+
+LOG_FILE = os.path.join("logs", "parser.log")
+
+
+def configure_logging(path=LOG_FILE, level=logging.INFO):
+    """Writes the parser log to a file, creating its directory. Not done on import so that importing the module (e.g.
+    in a worker process, the scraper or the demo watcher) leaves their logging alone.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    logging.basicConfig(level=level, filename=path, filemode='w', format='%(name)s - %(levelname)s - %(message)s')
+
+
+@instrumentation.timed("parser.generate_dataset", log=True)
+def generate_dataset(write_json=True, workers=PARSER_WORKERS, incremental=True):
+    """Extracts the smokes from every demo and writes them to the columnar dataset, and optionally to the
+    dataset.json file as well. Demos are parsed in parallel across the given number of worker processes and
+    combined in demo ID order, demos which fail to parse are logged and left out. If incremental is True only new
+    or changed demos are parsed, the rest are read from the smoke cache.
+    """
+    logging.info(f"Generating Dataset...")
     dataset = []
 
-    for file in os.listdir(DEMO_DIR):
-        if file.endswith(".dem"):
+    # Sorting by file name orders the demos by demo ID so the dataset is the same however many workers are used
+    demo_files = sorted(os.path.join(DEMO_DIR, file) for file in os.listdir(DEMO_DIR) if file.endswith(".dem"))
+    if incremental:
+        extracted, failed = extract_incremental(demo_files, workers)
+    else:
+        extracted, failed = parse_demos(demo_files, workers)
+    for demo_file in demo_files:
+        if demo_file in extracted:
+            dataset += extracted[demo_file]
+
+    if failed:
+        logging.warning(f"{len(failed)} of {len(demo_files)} demos failed to parse: {sorted(failed)}")
+
+    logging.info(f"Writing columnar dataset to [{COLUMNAR_DATASET_DIR}]")
+    save_columns(COLUMNAR_DATASET_DIR, *records_to_columns(dataset))
+
+    if write_json:
+        with open(DATASET_FILE, 'w') as f:
+            json.dump(dataset, f, indent=2)
+
+
+def extract_demo(demo_file):
+    """Wrapper around extract_smokes() used by parse_demos() and the demo watcher, in or out of worker processes.
+    Returns the error message instead of raising so a single corrupt demo does not abort the other demos. Also
+    returns the time taken, as stages timed in a worker process are not recorded by the main process.
+    """
+    with instrumentation.stage("parser.extract_smokes") as timer:
+        try:
+            smokes, error = extract_smokes(demo_file), None
+        except Exception as e:
+            smokes, error = None, f"{type(e).__name__}: {e}"
+    return smokes, error, timer.elapsed
+
+
+def parse_demos(demo_files, workers=1):
+    """Extracts the smokes from each demo file, using a pool of worker processes if workers is greater than 1.
+    Returns a dictionary of the smokes extracted from each demo file, and a dictionary of the error message for
+    each demo file that failed.
+    """
+    extracted, failed = {}, {}
+
+    def record(demo_file, smokes, error, elapsed=None):
+        if error is None:
+            logging.info(f"Extracted {len(smokes)} smokes from {demo_file}")
+            extracted[demo_file] = smokes
+            instrumentation.count("parser.demos_parsed")
+            instrumentation.count("parser.smokes_extracted", len(smokes))
+        else:
+            logging.error(f"Failed to extract smokes from {demo_file} - {error}")
+            failed[demo_file] = error
+            instrumentation.count("parser.demos_failed")
+        if elapsed is not None:
+            instrumentation.record("parser.extract_smokes", elapsed)
+
+    if workers <= 1:
+        for demo_file in demo_files:
+            logging.info(f"Extracting smokes from {demo_file}")
+            # Timed as a stage of this process by extract_demo()
+            smokes, error, _ = extract_demo(demo_file)
+            record(demo_file, smokes, error)
+        return extracted, failed
+
+    logging.info(f"Extracting smokes from {len(demo_files)} demos using {workers} worker processes")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(extract_demo, demo_file): demo_file for demo_file in demo_files}
+        for future in as_completed(futures):
+            try:
+                record(futures[future], *future.result())
+            except Exception as e:
+                # The worker process itself died (e.g. killed or out of memory)
+                record(futures[future], None, f"{type(e).__name__}: {e}")
+    return extracted, failed
+
+
+def demo_fingerprint(demo_file):
+    """Identifies the version of a demo file and the settings it would be parsed with.
+    """
+    stat = os.stat(demo_file)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "settings": dict(PARSER_SETTINGS)}
+
+
+def load_manifest(cache_dir=SMOKE_CACHE_DIR):
+    manifest_path = os.path.join(cache_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def _write_json_atomic(path, data):
+    """Writes to a temporary file and then replaces the target so an interrupted run never leaves a partial file.
+    """
+    with open(path + ".tmp", 'w') as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+
+def update_smoke_cache(manifest, parsed, failed, fingerprints, cache_dir=SMOKE_CACHE_DIR):
+    """Writes the smokes parsed from each demo to its shard in the cache directory and records it in the manifest,
+    demos which failed to parse are removed from the manifest. The manifest is updated in place and written.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    for demo_file, smokes in parsed.items():
+        shard = os.path.basename(demo_file).replace(".dem", ".json")
+        _write_json_atomic(os.path.join(cache_dir, shard), smokes)
+        manifest[demo_file] = {"fingerprint": fingerprints[demo_file], "shard": shard}
+    for demo_file in failed:
+        manifest.pop(demo_file, None)
+    _write_json_atomic(os.path.join(cache_dir, MANIFEST_FILE), manifest)
+
+
+def load_shard(manifest, demo_file, cache_dir=SMOKE_CACHE_DIR):
+    """Reads the cached smokes of a demo file recorded in the manifest.
+    """
+    with open(os.path.join(cache_dir, manifest[demo_file]["shard"]), 'r') as f:
+        return json.load(f)
+
+
+def extract_incremental(demo_files, workers=1, cache_dir=SMOKE_CACHE_DIR):
+    """Extracts the smokes from each demo file, only parsing demos which are new or have changed since they were
+    last cached. Each demo's smokes are stored as a separate shard in the cache directory and the manifest maps the
+    demo file to its shard and fingerprint. Returns the same as parse_demos().
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest = load_manifest(cache_dir)
+
+    fingerprints = {demo_file: demo_fingerprint(demo_file) for demo_file in demo_files}
+    stale = [demo_file for demo_file in demo_files
+             if demo_file not in manifest or manifest[demo_file]["fingerprint"] != fingerprints[demo_file]]
+    logging.info(f"{len(demo_files) - len(stale)} demos cached, {len(stale)} new or changed demos to parse")
+    instrumentation.count("parser.demos_cached", len(demo_files) - len(stale))
+
+    parsed, failed = parse_demos(stale, workers)
+    update_smoke_cache(manifest, parsed, failed, fingerprints, cache_dir)
+
+    extracted = {}
+    for demo_file in demo_files:
+        if demo_file in parsed:
+            extracted[demo_file] = parsed[demo_file]
+        elif demo_file in manifest:
+            extracted[demo_file] = load_shard(manifest, demo_file, cache_dir)
+    return extracted, failed
+
+
+@instrumentation.timed("parser.parse_queue", log=True)
+def parse_queue(demo_queue, workers=PARSER_WORKERS, cache_dir=SMOKE_CACHE_DIR):
+    """Extracts the smokes from each demo file put on demo_queue (e.g. by scraper.ArchiveExtractor) as it arrives,
+    until None is taken from the queue. Demos already waiting on the queue are parsed together as a batch by
+    extract_incremental(), so demos in the smoke cache aren't parsed again. Returns the same as parse_demos().
+    """
+    extracted, failed = {}, {}
+    while True:
+        batch = [demo_queue.get()]
+        while batch[-1] is not None and not demo_queue.empty():
+            batch.append(demo_queue.get())
+
+        demo_files = [demo_file for demo_file in batch if demo_file is not None]
+        if demo_files:
+            batch_extracted, batch_failed = extract_incremental(demo_files, workers, cache_dir)
+            extracted.update(batch_extracted)
+            failed.update(batch_failed)
+        if batch[-1] is None:
+            return extracted, failed
+
 
-            logging.info(f"Extracting smokes from {file}")
+def extract_smokes(demo_file, lightweight=LIGHTWEIGHT_EXTRACTION, outpath=None):
+    """Parses a demo file with awpy and extracts the smokes thrown in it.
 
-            smokes = extract_smokes(DEMO_DIR + "\\" + file)
-            dataset += smokes
+    The full parse writes the whole parsed demo (including every frame) to a json file in the demo directory. The
+    lightweight parse skips the frames, which are the bulk of the parse time and output, and writes awpy's json
+    output to a temporary directory which is deleted once it has been read. If outpath is given the json output is
+    written (and kept) there in either mode.
+    """
+    demo_id = os.path.basename(demo_file).replace(".dem", "")
+    if not lightweight:
+        demo_parser = DemoParser(
+            demofile=demo_file, demo_id=demo_id, parse_rate=PARSER_SETTINGS["parse_rate"], outpath=outpath or DEMO_DIR)
+        return smokes_from_demo(demo_parser.parse(), demo_id)
 
-    with open(DATASET_FILE, 'w') as f:
-        json.dump(dataset, f, indent=2)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        demo_parser = DemoParser(demofile=demo_file, demo_id=demo_id, parse_rate=PARSER_SETTINGS["parse_rate"],
+                                 parse_frames=False, parse_kill_frames=False, outpath=outpath or temp_dir)
+        return smokes_from_demo(demo_parser.parse(), demo_id)
 
 
-def extract_smokes(demo_file):
-    demo_id = demo_file.split("\\")[-1].replace(".dem", "")
-    demo_parser = DemoParser(
-        demofile=demo_file, demo_id=demo_id, parse_rate=128, outpath=DEMO_DIR)
-    demo = demo_parser.parse()
+def smokes_from_demo(demo, demo_id):
+    """Extracts the smoke grenade information from a demo parsed by awpy.
+    """
     extracted_smokes = []
     for r in demo["gameRounds"]:
         if not r["isWarmup"]:
@@ -59,4 +260,6 @@ def extract_smokes(demo_file):
     return extracted_smokes
 
 
-# generate_dataset()
+if __name__ == "__main__":
+    configure_logging()
+    generate_dataset()
@@ -0,0 +1,237 @@
+import functools
+import json
+import multiprocessing
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import analysis
+import parser
+from analysis_test import synthetic_records
+
+
+def fake_extract_smokes(demo_file):
+    """Stands in for the awpy parse, returns one smoke per demo and fails for demos named corrupt
+    """
+    if "corrupt" in demo_file:
+        raise ValueError("Demo file is corrupt")
+    return [{"demoID": demo_file.replace(".dem", "")}]
+
+
+def fake_demo_smokes(demo_file):
+    """Stands in for the awpy parse with a set of synthetic smokes per demo, the first demo takes the longest so the
+    demos finish out of order when parsed in parallel
+    """
+    name = os.path.basename(demo_file).replace(".dem", "")
+    if name == "demo-a":
+        time.sleep(0.2)
+    return [dict(record, demoID=name) for record in synthetic_records(20, seed=ord(name[-1]))]
+
+
+def parsed_demo():
+    """Minimal awpy parse output with a warmup round and a live round
+    """
+    smoke = {"grenadeType": "Smoke Grenade", "throwerName": "karrigan", "throwerTeam": "FaZe Clan",
+             "throwerSide": "T", "throwClockTime": "01:54", "grenadeX": -224.5, "grenadeY": -503.5625,
+             "grenadeZ": -165.875}
+    flash = dict(smoke, grenadeType="Flashbang")
+    return {"gameRounds": [{"isWarmup": True, "roundNum": 0, "winningSide": "CT", "grenades": [smoke]},
+                           {"isWarmup": False, "roundNum": 5, "winningSide": "CT", "grenades": [smoke, flash]}]}
+
+
+class TestExtractSmokes(unittest.TestCase):
+    """Tests smoke extraction from the awpy output in both parse modes
+    """
+
+    def test_smokes_from_demo(self):
+        smokes = parser.smokes_from_demo(parsed_demo(), "demo")
+        self.assertEqual(smokes, [{"demoID": "demo", "throwerName": "karrigan", "throwerTeam": "FaZe Clan",
+                                   "throwerSide": "T", "roundNum": 5, "throwTime": "01:54", "grenadeX": -224.5,
+                                   "grenadeY": -503.5625, "grenadeZ": -165.875, "roundWon": False}])
+
+    @mock.patch("parser.DemoParser")
+    def test_lightweight_skips_frames_and_output(self, demo_parser):
+        demo_parser.return_value.parse.return_value = parsed_demo()
+        smokes = parser.extract_smokes("demo.dem", lightweight=True)
+
+        kwargs = demo_parser.call_args.kwargs
+        self.assertFalse(kwargs["parse_frames"])
+        self.assertFalse(os.path.exists(kwargs["outpath"]))
+        self.assertEqual(smokes, parser.smokes_from_demo(parsed_demo(), "demo"))
+
+    @mock.patch("parser.DemoParser")
+    def test_demo_id_from_file_name(self, demo_parser):
+        demo_parser.return_value.parse.return_value = parsed_demo()
+        smokes = parser.extract_smokes(os.path.join("demos", "mirage_demos", "12345-a-vs-b.dem"))
+
+        self.assertEqual(demo_parser.call_args.kwargs["demo_id"], "12345-a-vs-b")
+        self.assertEqual({smoke["demoID"] for smoke in smokes}, {"12345-a-vs-b"})
+
+
+class TestDatasetPaths(unittest.TestCase):
+    """Tests the parser writes the datasets where the analysis reads them
+    """
+
+    def test_same_dataset_paths(self):
+        self.assertEqual(parser.COLUMNAR_DATASET_DIR, analysis.COLUMNAR_DATASET_DIR)
+        self.assertEqual(parser.DATASET_FILE, analysis.DATASET_FILE)
+        self.assertEqual(os.path.dirname(parser.COLUMNAR_DATASET_DIR), "data")
+
+
+class TestLogging(unittest.TestCase):
+    """Tests importing the parser leaves the logging to the program importing it
+    """
+
+    def test_import_has_no_handlers(self):
+        code = "import logging, parser; assert not logging.getLogger().handlers, logging.getLogger().handlers"
+        result = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+
+class TestParseDemos(unittest.TestCase):
+    """Tests demos are extracted independently so a failure doesn't abort the run
+    """
+
+    @mock.patch("parser.extract_smokes", side_effect=fake_extract_smokes)
+    def test_failed_demo_is_isolated(self, _):
+        demo_files = ["a.dem", "corrupt.dem", "b.dem"]
+        extracted, failed = parser.parse_demos(demo_files, workers=1)
+
+        self.assertEqual(sorted(extracted), ["a.dem", "b.dem"])
+        self.assertEqual(extracted["b.dem"], [{"demoID": "b"}])
+        self.assertEqual(list(failed), ["corrupt.dem"])
+        self.assertIn("Demo file is corrupt", failed["corrupt.dem"])
+
+
+@unittest.skipUnless("fork" in multiprocessing.get_all_start_methods(), "Stubbed parse needs forked workers")
+class TestParallelDataset(unittest.TestCase):
+    """Tests the dataset built by parallel workers holds the same smokes, in the same order, as a serial build
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.demo_dir = os.path.join(self.temp_dir.name, "demos")
+        os.makedirs(self.demo_dir)
+        for name in ("demo-c", "demo-a", "demo-d", "demo-b"):
+            with open(os.path.join(self.demo_dir, f"{name}.dem"), 'wb') as f:
+                f.write(b"demo")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    @staticmethod
+    def forked_workers():
+        # The stubbed parse is only seen by worker processes forked from this one
+        executor = functools.partial(parser.ProcessPoolExecutor, mp_context=multiprocessing.get_context("fork"))
+        return mock.patch("parser.ProcessPoolExecutor", executor)
+
+    def generate_dataset(self, workers):
+        """Builds the dataset with the given number of workers, returns the json records and the columnar table
+        """
+        json_path = os.path.join(self.temp_dir.name, f"dataset-{workers}.json")
+        columnar_path = os.path.join(self.temp_dir.name, f"dataset_columns-{workers}")
+        with mock.patch("parser.extract_smokes", side_effect=fake_demo_smokes), self.forked_workers(), \
+                mock.patch.multiple("parser", DEMO_DIR=self.demo_dir, DATASET_FILE=json_path,
+                                    COLUMNAR_DATASET_DIR=columnar_path):
+            parser.generate_dataset(workers=workers, incremental=False)
+        with open(json_path, 'r') as f:
+            return json.load(f), analysis.SmokeTable.load(columnar_path)
+
+    def test_parallel_matches_serial(self):
+        serial_records, serial_table = self.generate_dataset(workers=1)
+        parallel_records, parallel_table = self.generate_dataset(workers=2)
+
+        self.assertEqual(len(serial_records), 80)
+        self.assertEqual(parallel_records, serial_records)
+        self.assertEqual([record["demoID"] for record in serial_records[::20]],
+                         ["demo-a", "demo-b", "demo-c", "demo-d"])
+        self.assertEqual(parallel_table.categories, serial_table.categories)
+        for column in ("x", "y", "z", "round_num", "throw_time", "round_won"):
+            self.assertEqual(getattr(parallel_table, column).tolist(), getattr(serial_table, column).tolist())
+
+    def test_parse_demos_parallel_matches_serial(self):
+        demo_files = sorted(os.path.join(self.demo_dir, file) for file in os.listdir(self.demo_dir))
+        with mock.patch("parser.extract_smokes", side_effect=fake_demo_smokes):
+            serial, _ = parser.parse_demos(demo_files, workers=1)
+            with self.forked_workers():
+                parallel, failed = parser.parse_demos(demo_files, workers=2)
+
+        self.assertEqual(failed, {})
+        self.assertEqual(parallel, serial)
+        # Demos are recorded as they finish, the slowest demo last
+        self.assertEqual(list(parallel)[-1], demo_files[0])
+
+
+class TestIncrementalExtraction(unittest.TestCase):
+    """Tests only new or changed demos are reparsed and the rest come from the cache
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.temp_dir.name, "cache")
+        self.demo_files = []
+        for name in ("a.dem", "b.dem"):
+            self.demo_files.append(os.path.join(self.temp_dir.name, name))
+            self.write_demo(self.demo_files[-1], b"demo")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    @staticmethod
+    def write_demo(path, contents):
+        with open(path, 'wb') as f:
+            f.write(contents)
+
+    def extract(self):
+        with mock.patch("parser.extract_smokes", side_effect=fake_extract_smokes) as extract_smokes:
+            extracted, failed = parser.extract_incremental(self.demo_files, workers=1, cache_dir=self.cache_dir)
+        parsed = sorted(os.path.basename(call.args[0]) for call in extract_smokes.call_args_list)
+        return extracted, parsed
+
+    def test_only_changed_demos_reparsed(self):
+        first, parsed = self.extract()
+        self.assertEqual(parsed, ["a.dem", "b.dem"])
+
+        cached, parsed = self.extract()
+        self.assertEqual(parsed, [])
+        self.assertEqual(cached, first)
+
+        self.write_demo(self.demo_files[1], b"changed demo")
+        self.demo_files.append(os.path.join(self.temp_dir.name, "c.dem"))
+        self.write_demo(self.demo_files[-1], b"demo")
+        extracted, parsed = self.extract()
+        self.assertEqual(parsed, ["b.dem", "c.dem"])
+        self.assertEqual(list(extracted), self.demo_files)
+
+    def test_parse_queue(self):
+        demo_queue = queue.Queue()
+        for demo_file in self.demo_files + [None]:
+            demo_queue.put(demo_file)
+        with mock.patch("parser.extract_smokes", side_effect=fake_extract_smokes) as extract_smokes:
+            extracted, failed = parser.parse_queue(demo_queue, workers=1, cache_dir=self.cache_dir)
+        self.assertEqual(extract_smokes.call_count, 2)
+        self.assertEqual((list(extracted), failed), (self.demo_files, {}))
+
+        # Demos put on the queue again are read from the cache
+        demo_queue.put(self.demo_files[0])
+        demo_queue.put(None)
+        with mock.patch("parser.extract_smokes", side_effect=fake_extract_smokes) as extract_smokes:
+            cached, _ = parser.parse_queue(demo_queue, workers=1, cache_dir=self.cache_dir)
+        self.assertFalse(extract_smokes.called)
+        self.assertEqual(cached, {self.demo_files[0]: extracted[self.demo_files[0]]})
+
+    def test_settings_change_invalidates_cache(self):
+        self.extract()
+        with mock.patch.dict(parser.PARSER_SETTINGS, {"parse_rate": 64}):
+            _, parsed = self.extract()
+        self.assertEqual(parsed, ["a.dem", "b.dem"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,30 +2,50 @@ from selenium import webdriver
 from selenium.webdriver.common.by import By
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from configparser import ConfigParser
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlparse
+import urllib.request
 import logging
 import json
 import patoolib
+import queue
 import shutil
+import threading
+
+import instrumentation
 
 EVENTS = []
 HLTV_BASE_URL = "https://www.hltv.org/"
 
 # Reads config file to find directory of demo files
 config = ConfigParser()
-config.read("data\\config.ini")
+config.read(os.path.join("data", "config.ini"))
 
 # TODO: change to use os.path.join
 DEMO_DIR = config["Data"]["demo_directory"]
 
 ARCHIVE_DIR = DEMO_DIR + "\\archives"
-EXTRACTED_DIR = DEMO_DIR + "\\mirage_demos"
+# Demos of every target map are extracted to the same directory, which the parser reads
+EXTRACTED_DIR = os.path.join(DEMO_DIR, "demos")
 
 METADATA_DIR = DEMO_DIR + "\\metadata"
 DEMO_ID_FILE = METADATA_DIR + "\\saved_match_ids.json"
 RESULTS_URL_FILE = METADATA_DIR + "\\results_urls.json"
 MATCH_URL_FILE = METADATA_DIR + "\\match_urls.json"
 
+EXTRACTED_ARCHIVES_FILE = METADATA_DIR + "\\extracted_archives.json"
+MATCH_MAPS_FILE = METADATA_DIR + "\\match_maps.json"
+
+DOWNLOAD_WORKERS = config.getint("Scraper", "download_workers", fallback=4)
+EXTRACT_WORKERS = config.getint("Scraper", "extract_workers", fallback=2)
+MAP_CHECK_WORKERS = config.getint("Scraper", "map_check_workers", fallback=3)
+# Maps with a [Map de_<name>] section in the config file, only these demos are kept when extracting
+TARGET_MAPS = tuple(section.split("_", 1)[-1].lower()
+                    for section in config.sections() if section.startswith("Map ")) or ("mirage",)
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"
+
 logging.basicConfig(level=logging.INFO, filename='logs//scraper.log',
                     filemode='w', format='%(name)s - %(levelname)s - %(message)s')
 
@@ -45,12 +65,12 @@ def init_driver(download_path=ARCHIVE_DIR, headless=True):
     return webdriver.Chrome(options=options)
 
 
+@instrumentation.timed("scraper.get_results_page_urls", log=True)
 def get_results_page_urls():
     ''' Returns all results page URLs for regional, international & major LANs between 20/02/2020 & 10/4/2022 due
         to dataset constraints'''
 
     logging.info("Collecting results page URLS... ")
-    start_time = time.time()
 
     if os.path.exists(RESULTS_URL_FILE):
         logging.info(
@@ -89,25 +109,25 @@ def get_results_page_urls():
         logging.info(
             f"Saving all results page URLs to file [{RESULTS_URL_FILE}]")
         logging.info(f"Number of events found - {len(results_urls)}")
-        logging.info(
-            f"Time taken to execute - {time.time() - start_time:.2f}s")
+        instrumentation.count("scraper.results_pages", len(results_urls))
         return results_urls
 
 
-def get_match_urls(results_pages):
+@instrumentation.timed("scraper.get_match_urls", log=True)
+def get_match_urls(results_pages, workers=MAP_CHECK_WORKERS, driver_factory=init_driver,
+                   match_url_file=MATCH_URL_FILE, match_maps_file=MATCH_MAPS_FILE, target_maps=TARGET_MAPS):
     '''
-    Returns the all HLTV match URLs found on an events results page if the match involved mirage.
+    Returns the all HLTV match URLs found on an events results page if one of the target maps was played.
     '''
     logging.info("Collecting match page URLS... ")
-    start_time = time.time()
 
-    if os.path.exists(MATCH_URL_FILE):
+    if os.path.exists(match_url_file):
         logging.info(
-            f"Match URLs already collected returning data from file [{MATCH_URL_FILE}]")
-        with open(MATCH_URL_FILE, 'r') as f:
+            f"Match URLs already collected returning data from file [{match_url_file}]")
+        with open(match_url_file, 'r') as f:
             return json.load(f)
     else:
-        driver = init_driver()
+        driver = driver_factory()
         match_urls = {}
 
         for results_page in results_pages:
@@ -126,36 +146,87 @@ def get_match_urls(results_pages):
                 logging.info(f"Adding URL for MATCH_ID - {match_id}")
                 match_urls[match_id] = match_url
 
-            # Checks the list of maps played on each url and deletes it from the dictionary if de_mirage wasn't played.
-            matches_to_delete = []
-            for match_id, url in match_urls.items():
-                driver.get(url)
-                played_maps = [elm.text for elm in driver.find_elements(
-                    by=By.XPATH, value="//div[@class='played']/div/div[@class='mapname']")]
-
-                if "Mirage" not in played_maps:
-                    matches_to_delete.append(match_id)
-                    logging.info(
-                        f"Deleting URL for MATCH_ID - {match_id} as de_mirage was not played")
-
-            for id in matches_to_delete:
-                del match_urls[id]
-
         driver.quit()
 
+        # Checks the list of maps played for each match once, and deletes it from the dictionary if none of the
+        # target maps were played.
+        played_maps, fetches = get_played_maps(match_urls, workers, driver_factory, match_maps_file)
+        logging.info(f"Match pages fetched - {fetches} ({len(match_urls) - fetches} loaded from cache)")
+        instrumentation.count("scraper.match_pages_fetched", fetches)
+
+        unchecked = [match_id for match_id in match_urls if match_id not in played_maps]
+        for match_id in list(match_urls):
+            if match_id in played_maps and not any(map_name.lower() in target_maps
+                                                   for map_name in played_maps[match_id]):
+                logging.info(
+                    f"Deleting URL for MATCH_ID - {match_id} as none of {list(target_maps)} were played")
+                del match_urls[match_id]
+
+        if unchecked:
+            # Not saved so the next run retries the failed matches, the rest are cached in the match maps file
+            logging.warning(f"Played maps could not be checked for MATCH_IDs - {unchecked}")
+            return {match_id: url for match_id, url in match_urls.items() if match_id not in unchecked}
+
         # Saves all match urls to file
-        with open(MATCH_URL_FILE, 'w') as f:
+        with open(match_url_file, 'w') as f:
             json.dump(match_urls, f, indent=2)
 
         logging.info(
-            f"Saving all match URLs to file [{MATCH_URL_FILE}]")
+            f"Saving all match URLs to file [{match_url_file}]")
 
         logging.info(f"Number of matches found - {len(match_urls.keys())}")
-        logging.info(
-            f"Time taken to execute - {time.time() - start_time:.2f}s")
+        instrumentation.count("scraper.matches_found", len(match_urls))
         return match_urls
 
 
+def get_played_maps(match_urls, workers=MAP_CHECK_WORKERS, driver_factory=init_driver,
+                    match_maps_file=MATCH_MAPS_FILE):
+    '''
+    Returns the maps played in each match, loading each match page at most once. Pages are loaded concurrently by
+    a small pool of drivers (one per worker thread) and the result for each match is saved to the match maps file
+    as it arrives, so an interrupted run doesn't repeat page loads. Also returns the number of pages loaded.
+    '''
+    played_maps = {}
+    if os.path.exists(match_maps_file):
+        with open(match_maps_file, 'r') as f:
+            played_maps = json.load(f)
+    pending = {match_id: url for match_id, url in match_urls.items() if match_id not in played_maps}
+    if not pending:
+        return played_maps, 0
+
+    local = threading.local()
+    drivers = []
+    drivers_lock = threading.Lock()
+
+    def check(url):
+        if not hasattr(local, "driver"):
+            local.driver = driver_factory()
+            with drivers_lock:
+                drivers.append(local.driver)
+        local.driver.get(url)
+        return [elm.text for elm in local.driver.find_elements(
+            by=By.XPATH, value="//div[@class='played']/div/div[@class='mapname']")]
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(check, url): match_id for match_id, url in pending.items()}
+            for future in as_completed(futures):
+                match_id = futures[future]
+                try:
+                    played_maps[match_id] = future.result()
+                except Exception as e:
+                    logging.error(f"Failed to check maps for MATCH_ID - {match_id} - {type(e).__name__}: {e}")
+                    continue
+                with open(match_maps_file + ".tmp", 'w') as f:
+                    json.dump(played_maps, f, indent=2)
+                os.replace(match_maps_file + ".tmp", match_maps_file)
+    finally:
+        for driver in drivers:
+            driver.quit()
+    return played_maps, len(pending)
+
+
+@instrumentation.timed("scraper.download_demos", log=True)
 def download_demos(match_urls):
     '''
     Downloads a demo file from a match page into the demo directory inside a folder named after the event.
@@ -181,6 +252,7 @@ def download_demos(match_urls):
 
             logging.info(f"Downloading DEMO_ID - {demo_id}")
             download_wait(DEMO_DIR)
+            instrumentation.count("scraper.demos_downloaded")
             downloaded_demo_ids.append(demo_id)
             with open(DEMO_ID_FILE, 'w') as f:
                 json.dump(downloaded_demo_ids, f, indent=2)
@@ -204,33 +276,273 @@ def download_wait(path_to_downloads):
     logging.info("Download finished")
 
 
-def extract_demos():
-    logging.info("Extracting .rar files...")
-    if len(os.listdir(EXTRACTED_DIR)) != 0:
-        logging.info(
-            "Previously Extracted demos found. Please clear directory or continue.")
-    else:
-        for file in os.listdir(ARCHIVE_DIR):
+class _DemoLinkParser(HTMLParser):
+    '''
+    Finds the href of the link containing the 'GOTV Demo' text on a match page.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.demo_href = None
+        self._href = None
+        self._text = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "a":
+            self._href = dict(attrs).get("href")
+            self._text = []
+
+    def handle_data(self, data):
+        if self._href is not None:
+            self._text.append(data)
+
+    def handle_endtag(self, tag):
+        if tag == "a" and self._href is not None:
+            if self.demo_href is None and "GOTV Demo" in "".join(self._text):
+                self.demo_href = self._href
+            self._href = None
+
+
+def _open_url(url):
+    return urllib.request.urlopen(urllib.request.Request(url, headers={"User-Agent": USER_AGENT}), timeout=60)
+
+
+def find_demo_url(match_url):
+    '''
+    Fetches a match page and returns the absolute URL of its GOTV demo download.
+    '''
+    with _open_url(match_url) as response:
+        page = response.read().decode(response.headers.get_content_charset() or "utf-8", errors="replace")
+    link_parser = _DemoLinkParser()
+    link_parser.feed(page)
+    if link_parser.demo_href is None:
+        raise ValueError(f"No GOTV demo link found on [{match_url}]")
+    return urljoin(match_url, link_parser.demo_href)
+
+
+def download_file(url, download_dir, default_name):
+    '''
+    Streams a file into the download directory. The data is written to a .part file which is renamed once the
+    download is complete, so the presence of the final file means that download has finished.
+    '''
+    with _open_url(url) as response:
+        file_name = response.headers.get_filename() or os.path.basename(urlparse(response.geturl()).path)
+        file_name = os.path.basename(file_name or default_name)
+        if not os.path.splitext(file_name)[1]:
+            file_name = default_name
+        path = os.path.join(download_dir, file_name)
+        with open(path + ".part", 'wb') as f:
+            shutil.copyfileobj(response, f, 2**20)
+    os.replace(path + ".part", path)
+    return path
+
+
+@instrumentation.timed("scraper.download_demos_concurrent", log=True)
+def download_demos_concurrent(match_urls, max_workers=DOWNLOAD_WORKERS, download_dir=ARCHIVE_DIR,
+                              demo_id_file=DEMO_ID_FILE, on_complete=None):
+    '''
+    Downloads the demos for each match directly over HTTP, with up to max_workers downloads running at once. Each
+    download's completion is detected individually and its match ID is saved to the demo ID file straight away so
+    an interrupted run resumes where it left off. on_complete(demo_id, path) is called for each finished download.
+    Failed downloads are logged and retried on the next run.
+    '''
+    logging.info(f"Downloading demos using {max_workers} concurrent downloads...")
+    os.makedirs(download_dir, exist_ok=True)
+
+    downloaded_demo_ids = []
+    if os.path.exists(demo_id_file):
+        logging.info(f"Demo ID file exists at [{demo_id_file}], loading ")
+        with open(demo_id_file, 'r') as f:
+            downloaded_demo_ids = json.load(f)
+
+    pending = {demo_id: url for demo_id, url in match_urls.items() if demo_id not in downloaded_demo_ids}
+    logging.info(f"{len(match_urls) - len(pending)} demos already downloaded, {len(pending)} to download")
+
+    def download(demo_id, url):
+        logging.info(f"Downloading DEMO_ID - {demo_id}")
+        return download_file(find_demo_url(url), download_dir, f"{demo_id}.rar")
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(download, demo_id, url): demo_id for demo_id, url in pending.items()}
+        for future in as_completed(futures):
+            demo_id = futures[future]
+            try:
+                path = future.result()
+            except Exception as e:
+                logging.error(f"Download failed for DEMO_ID - {demo_id} - {type(e).__name__}: {e}")
+                failed.append(demo_id)
+                continue
+
+            logging.info(f"Download finished for DEMO_ID - {demo_id} [{path}]")
+            # Completed downloads are handled on this thread so the demo ID file is only written by one thread
+            downloaded_demo_ids.append(demo_id)
+            with open(demo_id_file + ".tmp", 'w') as f:
+                json.dump(downloaded_demo_ids, f, indent=2)
+            os.replace(demo_id_file + ".tmp", demo_id_file)
+            if on_complete is not None:
+                on_complete(demo_id, path)
+
+    logging.info(f"{len(pending) - len(failed)} demos downloaded, {len(failed)} failed")
+    instrumentation.count("scraper.demos_downloaded", len(pending) - len(failed))
+    instrumentation.count("scraper.download_failures", len(failed))
+    return failed
+
+
+@instrumentation.timed("scraper.extract_archive")
+def extract_archive(archive_path, extracted_dir=EXTRACTED_DIR, target_maps=TARGET_MAPS):
+    '''
+    Extracts a demo archive into a temporary folder next to it, renames each demo to <archive name>-<map>.dem and
+    moves the demos for the target maps into the extracted directory. Returns the paths of the moved demos.
+    '''
+    archive_name = os.path.basename(archive_path).split(".")[0]
+    temp_dir = os.path.join(os.path.dirname(archive_path), archive_name)
+    os.makedirs(temp_dir, exist_ok=True)
+    demos = []
+    try:
+        patoolib.extract_archive(archive_path, outdir=temp_dir, verbosity=-1)
+        for file in os.listdir(temp_dir):
+            if not file.endswith(".dem"):
+                continue
+            map_played = file.replace(".dem", "").split("-")[-1]
+            if map_played.lower() in target_maps:
+                new_path = os.path.join(extracted_dir, archive_name + "-" + map_played + ".dem")
+                os.replace(os.path.join(temp_dir, file), new_path)
+                demos.append(new_path)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return demos
+
+
+class ArchiveExtractor():
+    '''
+    Extracts demo archives in a pool of worker threads as they are submitted, so extraction can overlap with
+    downloading. Extracted archives are recorded in a metadata file and skipped if submitted again. The path of
+    each extracted demo is put on demo_queue (if given) as soon as it is available, followed by None once the
+    extractor is closed.
+    '''
+
+    def __init__(self, workers=EXTRACT_WORKERS, extracted_dir=EXTRACTED_DIR, metadata_file=EXTRACTED_ARCHIVES_FILE,
+                 demo_queue=None, target_maps=TARGET_MAPS):
+        self.extracted_dir = extracted_dir
+        self.metadata_file = metadata_file
+        self.demo_queue = demo_queue
+        self.target_maps = target_maps
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.demos = []
+        self.failed = []
+
+        self.extracted_archives = []
+        if os.path.exists(metadata_file):
+            with open(metadata_file, 'r') as f:
+                self.extracted_archives = json.load(f)
+        self.submitted = set(self.extracted_archives)
+        os.makedirs(extracted_dir, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, archive_path):
+        archive = os.path.basename(archive_path)
+        if archive in self.submitted:
+            logging.info(f"Archive {archive} already extracted - Skipping...")
+            return
+        self.submitted.add(archive)
+        self.executor.submit(self._extract, archive_path)
+
+    def submit_directory(self, archive_dir):
+        '''
+        Submits every archive in a directory, e.g. archives downloaded by an earlier run but never extracted.
+        '''
+        if not os.path.isdir(archive_dir):
+            return
+        for file in sorted(os.listdir(archive_dir)):
             if file.endswith(".rar"):
-                temp_dir = ARCHIVE_DIR + "\\" + file.split(".")[0]
-                os.mkdir(temp_dir)
-                patoolib.extract_archive(
-                    ARCHIVE_DIR + "\\" + file, outdir=temp_dir, verbosity=-1)
-                for file in os.listdir(temp_dir):
-                    file_name = file.replace(".dem", "")
-                    map_played = file_name.split("-")[-1]
-                    archive_name = temp_dir.split("\\")[-1]
-                    new_file_name = archive_name + "-" + map_played + ".dem"
-                    os.rename(temp_dir + "\\" + file,
-                              temp_dir + "\\" + new_file_name)
-
-                    if map_played.lower() == "mirage":
-                        os.replace(temp_dir + "\\" + new_file_name,
-                                   EXTRACTED_DIR + "\\" + new_file_name)
-                shutil.rmtree(temp_dir)
-
-                logging.info(f"Extraction of {file} Complete")
-        logging.info(f"Demo file extraction complete")
+                self.submit(os.path.join(archive_dir, file))
+
+    def _extract(self, archive_path):
+        archive = os.path.basename(archive_path)
+        try:
+            demos = extract_archive(archive_path, self.extracted_dir, self.target_maps)
+        except Exception as e:
+            logging.error(f"Extraction of {archive} failed - {type(e).__name__}: {e}")
+            with self.lock:
+                self.failed.append(archive)
+            return
+
+        instrumentation.count("scraper.archives_extracted")
+        instrumentation.count("scraper.demos_extracted", len(demos))
+        with self.lock:
+            self.extracted_archives.append(archive)
+            self.demos += demos
+            with open(self.metadata_file + ".tmp", 'w') as f:
+                json.dump(self.extracted_archives, f, indent=2)
+            os.replace(self.metadata_file + ".tmp", self.metadata_file)
+        if self.demo_queue is not None:
+            for demo in demos:
+                self.demo_queue.put(demo)
+        logging.info(f"Extraction of {archive} Complete - {len(demos)} demos kept")
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.demo_queue is not None:
+            self.demo_queue.put(None)
+
+
+@instrumentation.timed("scraper.extract_demos", log=True)
+def extract_demos(workers=EXTRACT_WORKERS, demo_queue=None):
+    '''
+    Extracts every downloaded archive that hasn't already been extracted, keeping only the target map demos.
+    '''
+    logging.info("Extracting .rar files...")
+    with ArchiveExtractor(workers, demo_queue=demo_queue) as extractor:
+        extractor.submit_directory(ARCHIVE_DIR)
+    logging.info(f"Demo file extraction complete - {len(extractor.demos)} demos extracted")
+    return extractor.demos
+
+
+def download_and_extract(match_urls, download_workers=DOWNLOAD_WORKERS, extract_workers=EXTRACT_WORKERS,
+                         demo_queue=None, download_dir=ARCHIVE_DIR, demo_id_file=DEMO_ID_FILE,
+                         extracted_dir=EXTRACTED_DIR, metadata_file=EXTRACTED_ARCHIVES_FILE):
+    '''
+    Pipelines the download and extraction stages. Each archive is handed to the extraction pool as soon as its
+    download completes and each extracted demo is put on demo_queue for the parser. Archives left unextracted by a
+    previous run are extracted as well. Returns the extracted demos and the match IDs whose download failed.
+    '''
+    with ArchiveExtractor(extract_workers, extracted_dir, metadata_file, demo_queue) as extractor:
+        extractor.submit_directory(download_dir)
+        failed = download_demos_concurrent(match_urls, download_workers, download_dir, demo_id_file,
+                                           on_complete=lambda demo_id, path: extractor.submit(path))
+    return extractor.demos, failed
+
+
+@instrumentation.timed("scraper.download_extract_parse", log=True)
+def download_extract_parse(match_urls, download_workers=DOWNLOAD_WORKERS, extract_workers=EXTRACT_WORKERS,
+                           parser_workers=None, download_dir=ARCHIVE_DIR, demo_id_file=DEMO_ID_FILE,
+                           extracted_dir=EXTRACTED_DIR, metadata_file=EXTRACTED_ARCHIVES_FILE, smoke_cache_dir=None):
+    '''
+    Runs download_and_extract() with the parser consuming its demo queue in a separate thread, so demos are parsed
+    into the smoke cache while later archives are still downloading and extracting. parser_workers and
+    smoke_cache_dir default to the parser's settings. Returns the smokes extracted from each demo, the error of
+    each demo which failed to parse and the match IDs whose download failed.
+    '''
+    # Imported here as the parser needs awpy, which isn't needed to only download demos
+    import parser
+
+    demo_queue = queue.Queue()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        parsing = executor.submit(parser.parse_queue, demo_queue,
+                                  parser.PARSER_WORKERS if parser_workers is None else parser_workers,
+                                  smoke_cache_dir or parser.SMOKE_CACHE_DIR)
+        # The extractor puts None on the queue when it closes, even if downloading fails, which stops the parser
+        _, failed_downloads = download_and_extract(match_urls, download_workers, extract_workers, demo_queue,
+                                                   download_dir, demo_id_file, extracted_dir, metadata_file)
+        extracted, failed = parsing.result()
+    return extracted, failed, failed_downloads
 
 
 # results_urls = get_results_page_urls()
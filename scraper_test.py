@@ -0,0 +1,265 @@
+import json
+import os
+import queue
+import re
+import tempfile
+import threading
+import unittest
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import instrumentation
+import parser
+import scraper
+
+
+# Matches listed on each event's results page of the mock HLTV site
+EVENT_MATCHES = {"1": ["10", "11", "12"], "2": ["20", "21"], "3": ["30", "31", "32", "33"]}
+
+
+def played_maps(match_id):
+    """Maps played in a mock match, Mirage is played in every match with an even ID
+    """
+    return ["Mirage", "Inferno"] if int(match_id) % 2 == 0 else ["Nuke", "Dust2"]
+
+
+class MockHLTVHandler(BaseHTTPRequestHandler):
+    """Local stand-in for HLTV serving results pages, match pages with the maps played and a GOTV demo link, and
+    fake demo archives. Match 404 has no demo available.
+    """
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        parts = self.path.strip("/").split("/")
+        if parts[0].startswith("results?event="):
+            links = "".join(f'<div class="result-con"><a href="/matches/{match_id}/team-vs-team">Result</a></div>'
+                            for match_id in EVENT_MATCHES[parts[0].split("=")[-1]])
+            self.respond(f"<html><body>{links}</body></html>".encode(), {"Content-Type": "text/html"})
+        elif parts[0] == "matches" and parts[1] != "404":
+            maps = "".join(f'<div class="played"><div><div class="mapname">{map_name}</div></div></div>'
+                           for map_name in (played_maps(parts[1]) if parts[1].isdigit() else []))
+            body = (f'<html><body>{maps}<a href="/download/demo/{parts[1]}">'
+                    f'<div class="stream-box">GOTV Demo</div></a></body></html>').encode()
+            self.respond(body, {"Content-Type": "text/html; charset=utf-8"})
+        elif parts[0] == "download":
+            body = f"fake archive {parts[2]}".encode()
+            self.respond(body, {"Content-Disposition": f'attachment; filename="event-{parts[2]}.rar"'})
+        else:
+            self.send_error(404)
+
+    def respond(self, body, headers):
+        self.send_response(200)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MockHLTVTestCase(unittest.TestCase):
+    """Starts the mock HLTV server and a temporary demo directory for each test
+    """
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), MockHLTVHandler)
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.download_dir = os.path.join(self.temp_dir.name, "archives")
+        self.demo_id_file = os.path.join(self.temp_dir.name, "saved_match_ids.json")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.temp_dir.cleanup()
+
+    def match_urls(self, match_ids):
+        return {match_id: f"{self.base_url}/matches/{match_id}/team-vs-team" for match_id in match_ids}
+
+
+class TestConcurrentDownloads(MockHLTVTestCase):
+    """Tests the concurrent demo downloader against the mock HLTV server
+    """
+
+    def download(self, match_ids, on_complete=None):
+        return scraper.download_demos_concurrent(self.match_urls(match_ids), max_workers=3,
+                                                 download_dir=self.download_dir, demo_id_file=self.demo_id_file,
+                                                 on_complete=on_complete)
+
+    def test_downloads_all_demos(self):
+        completed = {}
+        with instrumentation.run("scraper", report_dir=None) as run:
+            failed = self.download(["1", "2", "3", "404"], on_complete=completed.__setitem__)
+        self.assertEqual(run.report()["stages"]["scraper.download_demos_concurrent"]["calls"], 1)
+
+        self.assertEqual(failed, ["404"])
+        self.assertEqual(sorted(os.listdir(self.download_dir)), ["event-1.rar", "event-2.rar", "event-3.rar"])
+        self.assertEqual(completed["2"], os.path.join(self.download_dir, "event-2.rar"))
+        with open(completed["2"], 'rb') as f:
+            self.assertEqual(f.read(), b"fake archive 2")
+        with open(self.demo_id_file, 'r') as f:
+            self.assertEqual(sorted(json.load(f)), ["1", "2", "3"])
+
+    def test_resumes_from_saved_ids(self):
+        self.download(["1", "2"])
+        self.server.requests.clear()
+        self.download(["1", "2", "3"])
+        self.assertEqual(sorted(self.server.requests), ["/download/demo/3", "/matches/3/team-vs-team"])
+
+
+def fake_extract_archive(archive, outdir, verbosity):
+    """Stands in for patoolib, 'extracts' a mirage and an inferno demo from every archive
+    """
+    for map_name in ("mirage", "inferno"):
+        with open(os.path.join(outdir, f"team-vs-team-m1-{map_name}.dem"), 'w') as f:
+            f.write(archive)
+
+
+@mock.patch("scraper.patoolib.extract_archive", side_effect=fake_extract_archive)
+class TestDownloadExtractPipeline(MockHLTVTestCase):
+    """Tests archives are extracted as they download and the demos are fed onto the parser queue
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.extracted_dir = os.path.join(self.temp_dir.name, "demos")
+        self.metadata_file = os.path.join(self.temp_dir.name, "extracted_archives.json")
+        self.demo_queue = queue.Queue()
+
+    def run_pipeline(self, match_ids):
+        return scraper.download_and_extract(self.match_urls(match_ids), download_workers=2, extract_workers=2,
+                                            demo_queue=self.demo_queue, download_dir=self.download_dir,
+                                            demo_id_file=self.demo_id_file, extracted_dir=self.extracted_dir,
+                                            metadata_file=self.metadata_file)
+
+    def queued_demos(self):
+        demos = []
+        while (demo := self.demo_queue.get_nowait()) is not None:
+            demos.append(os.path.basename(demo))
+        return sorted(demos)
+
+    def test_only_target_map_demos_kept(self, extract_archive):
+        demos, failed = self.run_pipeline(["1", "2"])
+        self.assertEqual(failed, [])
+        self.assertEqual(sorted(os.listdir(self.extracted_dir)), ["event-1-mirage.dem", "event-2-mirage.dem"])
+        self.assertEqual(self.queued_demos(), ["event-1-mirage.dem", "event-2-mirage.dem"])
+        self.assertEqual(sorted(demos), [os.path.join(self.extracted_dir, "event-1-mirage.dem"),
+                                         os.path.join(self.extracted_dir, "event-2-mirage.dem")])
+
+    def test_extracted_archives_skipped(self, extract_archive):
+        self.run_pipeline(["1", "2"])
+        self.queued_demos()
+        extract_archive.reset_mock()
+
+        demos, _ = self.run_pipeline(["1", "2", "3"])
+        self.assertEqual([os.path.basename(call.args[0]) for call in extract_archive.call_args_list], ["event-3.rar"])
+        self.assertEqual(self.queued_demos(), ["event-3-mirage.dem"])
+        with open(self.metadata_file, 'r') as f:
+            self.assertEqual(sorted(json.load(f)), ["event-1.rar", "event-2.rar", "event-3.rar"])
+
+
+@mock.patch("scraper.patoolib.extract_archive", side_effect=fake_extract_archive)
+class TestDownloadExtractParsePipeline(MockHLTVTestCase):
+    """Tests demos are parsed into the smoke cache as they come off the extraction queue
+    """
+
+    def test_demos_parsed(self, extract_archive):
+        extracted_dir = os.path.join(self.temp_dir.name, "demos")
+        smoke_cache_dir = os.path.join(self.temp_dir.name, "smoke_cache")
+        with mock.patch("parser.extract_smokes", side_effect=lambda demo_file: [{"demoID": demo_file}]):
+            extracted, failed, failed_downloads = scraper.download_extract_parse(
+                self.match_urls(["1", "2"]), download_workers=2, extract_workers=2, parser_workers=1,
+                download_dir=self.download_dir, demo_id_file=self.demo_id_file, extracted_dir=extracted_dir,
+                metadata_file=os.path.join(self.temp_dir.name, "extracted_archives.json"),
+                smoke_cache_dir=smoke_cache_dir)
+
+        demos = [os.path.join(extracted_dir, f"event-{event}-mirage.dem") for event in ("1", "2")]
+        self.assertEqual((failed, failed_downloads), ({}, []))
+        self.assertEqual(extracted, {demo: [{"demoID": demo}] for demo in demos})
+        self.assertEqual(sorted(parser.load_manifest(smoke_cache_dir)), demos)
+
+
+class FakeElement():
+    def __init__(self, text, href=None):
+        self.text = text
+        self.href = href
+
+    def get_attribute(self, name):
+        return self.href
+
+
+class FakeDriver():
+    """Minimal stand-in for the Selenium driver which loads pages from the mock HLTV server over HTTP and answers
+    the two XPath queries used by get_match_urls()
+    """
+
+    def __init__(self):
+        self.url = None
+        self.page = ""
+
+    def get(self, url):
+        self.url = url
+        with urllib.request.urlopen(url) as response:
+            self.page = response.read().decode()
+
+    def find_elements(self, by, value):
+        if "result-con" in value:
+            return [FakeElement("Result", urllib.parse.urljoin(self.url, href))
+                    for href in re.findall(r'<div class="result-con"><a href="([^"]+)"', self.page)]
+        return [FakeElement(name) for name in re.findall(r'<div class="mapname">([^<]+)</div>', self.page)]
+
+    def quit(self):
+        pass
+
+
+class TestMatchUrls(MockHLTVTestCase):
+    """Tests each match page is loaded once when filtering matches by map, and not again on a resumed run
+    """
+
+    def get_match_urls(self, target_maps=("mirage",)):
+        return scraper.get_match_urls([f"{self.base_url}/results?event={event}" for event in EVENT_MATCHES],
+                                      workers=3, driver_factory=FakeDriver,
+                                      match_url_file=os.path.join(self.temp_dir.name, "match_urls.json"),
+                                      match_maps_file=os.path.join(self.temp_dir.name, "match_maps.json"),
+                                      target_maps=target_maps)
+
+    def match_page_fetches(self):
+        return len([path for path in self.server.requests if path.startswith("/matches/")])
+
+    def test_each_match_page_loaded_once(self):
+        match_urls = self.get_match_urls()
+        self.assertEqual(sorted(match_urls), ["10", "12", "20", "30", "32"])
+        self.assertEqual(match_urls["20"], f"{self.base_url}/matches/20/team-vs-team")
+
+        # The previous implementation re-checked every remaining Mirage match after each event, loading
+        # 3 + 4 + 7 = 14 match pages for these 9 matches
+        matches = [match_id for event in EVENT_MATCHES.values() for match_id in event]
+        self.assertEqual(self.match_page_fetches(), len(matches))
+        self.assertLess(self.match_page_fetches(), 14)
+
+    def test_matches_filtered_by_target_maps(self):
+        # Nuke is only played in the matches with an odd ID
+        self.assertEqual(sorted(self.get_match_urls(target_maps=("nuke",))), ["11", "21", "31", "33"])
+
+    def test_matches_of_any_target_map(self):
+        match_urls = self.get_match_urls(target_maps=("mirage", "dust2"))
+        self.assertEqual(sorted(match_urls), sorted(match_id for event in EVENT_MATCHES.values() for match_id in event))
+
+    def test_interrupted_run_resumes_from_cache(self):
+        with open(os.path.join(self.temp_dir.name, "match_maps.json"), 'w') as f:
+            json.dump({"10": ["Mirage"], "11": ["Nuke"], "12": ["Mirage"]}, f)
+
+        match_urls = self.get_match_urls()
+        self.assertEqual(sorted(match_urls), ["10", "12", "20", "30", "32"])
+        self.assertEqual(self.match_page_fetches(), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
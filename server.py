@@ -0,0 +1,260 @@
+import json
+import logging
+import threading
+import time
+import urllib.parse
+from collections import deque
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+import instrumentation
+from analysis import (COVERAGE_CACHE_DIR, DOORWAY_FILE, SETTINGS, CoverageStats, assign_doorways, configure_logging,
+                      default_dataset_path, file_fingerprint, load_doorway_data, load_smoke_table,
+                      load_table_assignments)
+from dataset import throw_time_to_secs
+
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+
+# Seconds between checks of the dataset and doorway files for changes
+RELOAD_INTERVAL = 2.0
+
+# Latencies of the most recent queries kept per endpoint for the metrics
+LATENCY_WINDOW = 10_000
+
+
+class QueryError(ValueError):
+    """Raised for a query with invalid parameters, returned to the client as a 400 response.
+    """
+
+
+class DatasetState():
+    """Snapshot of the analysed dataset: the smokes as a SmokeTable assigned to the doorways, with the coverage
+    statistics and throw times indexed for querying. A new snapshot is built on reload and swapped in whole, so a
+    query always sees one consistent version. Assignments are read from the coverage cache when it holds them (e.g.
+    written by the demo watcher), otherwise they are computed.
+    """
+
+    def __init__(self, dataset_path, doorway_path, cache_dir=COVERAGE_CACHE_DIR):
+        self.dataset_path = dataset_path
+        self.doorway_path = doorway_path
+        self.fingerprint = self.current_fingerprint(dataset_path, doorway_path)
+        self.loaded_at = datetime.now()
+
+        start_time = time.perf_counter()
+        self.table = load_smoke_table(dataset_path)
+        self.doorways = load_doorway_data(doorway_path)
+        if not load_table_assignments(self.table, self.doorways, dataset_path, doorway_path, cache_dir):
+            assign_doorways(self.table, self.doorways, attach=False)
+        self.stats = CoverageStats.from_table(self.table)
+        valid = ~np.isnan(self.table.coverage) & (self.table.doorway != None)  # noqa: E711
+        self.throw_time = self.table.throw_time[valid]
+        self.doorway_names = {doorway.name: doorway for doorway in self.doorways}
+        self.load_seconds = time.perf_counter() - start_time
+
+    @staticmethod
+    def current_fingerprint(dataset_path, doorway_path):
+        return {"dataset": file_fingerprint(dataset_path), "doorways": file_fingerprint(doorway_path)}
+
+    def coverage(self, params):
+        """Answers a coverage query. params maps query parameters to lists of values (as from urllib.parse.parse_qs):
+        any of the CoverageStats.GROUP_KEYS to filter on (several values match any of them), time_from and time_to
+        to restrict the round clock time ("MM:SS" or seconds) and by to group the results by one or more group keys.
+        """
+        unknown = set(params) - set(CoverageStats.GROUP_KEYS) - {"time_from", "time_to", "by"}
+        if unknown:
+            raise QueryError(f"Unknown query parameters {sorted(unknown)}")
+
+        where = {}
+        for key in CoverageStats.GROUP_KEYS:
+            if key not in params:
+                continue
+            values = params[key]
+            if key == "doorway":
+                values = [self.doorway_names[name] for name in values if name in self.doorway_names]
+            elif key == "round_num":
+                values = [self._integer(key, value) for value in values]
+            where[key] = values
+
+        mask = None
+        if "time_from" in params:
+            mask = self.throw_time >= self._seconds(params["time_from"][0])
+        if "time_to" in params:
+            before = self.throw_time <= self._seconds(params["time_to"][0])
+            mask = before if mask is None else mask & before
+
+        by = tuple(key for value in params.get("by", []) for key in value.split(",") if key)
+        unknown = set(by) - set(CoverageStats.GROUP_KEYS)
+        if unknown:
+            raise QueryError(f"Unknown group keys {sorted(unknown)}")
+        if not by:
+            return {"stats": self.stats.stats(where, mask)}
+
+        groups = self.stats.group_stats(by, where, mask)
+        return {"by": list(by),
+                "groups": [dict(stats, key=[self._label(value) for value in label]) for label, stats in groups.items()]}
+
+    @staticmethod
+    def _label(value):
+        return value.name if hasattr(value, "name") else value
+
+    @staticmethod
+    def _integer(key, value):
+        try:
+            return int(value)
+        except ValueError:
+            raise QueryError(f"{key} must be an integer, not [{value}]")
+
+    @classmethod
+    def _seconds(cls, value):
+        if ":" in value:
+            try:
+                return throw_time_to_secs(value)
+            except ValueError:
+                raise QueryError(f"Invalid time [{value}]")
+        return cls._integer("time", value)
+
+    def summary(self):
+        return {"dataset": self.dataset_path,
+                "doorway_file": self.doorway_path,
+                "smokes": len(self.table),
+                "assigned_smokes": len(self.stats),
+                "loaded_at": self.loaded_at.isoformat(timespec="seconds"),
+                "load_seconds": self.load_seconds}
+
+
+class LatencyMetrics():
+    """Per-endpoint request counts, errors and latency percentiles over the most recent window of requests.
+    """
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self._latencies = {}
+        self._counts = {}
+        self._errors = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, error=False):
+        with self._lock:
+            self._latencies.setdefault(endpoint, deque(maxlen=self.window)).append(seconds)
+            self._counts[endpoint] = self._counts.get(endpoint, 0) + 1
+            self._errors[endpoint] = self._errors.get(endpoint, 0) + error
+        instrumentation.record(f"server.{endpoint}", seconds)
+
+    def report(self):
+        with self._lock:
+            report = {}
+            for endpoint, latencies in self._latencies.items():
+                milliseconds = np.array(latencies) * 1000
+                p50, p95, p99 = np.percentile(milliseconds, [50, 95, 99])
+                report[endpoint] = {"requests": self._counts[endpoint], "errors": self._errors[endpoint],
+                                    "mean_ms": milliseconds.mean(), "p50_ms": p50, "p95_ms": p95, "p99_ms": p99,
+                                    "max_ms": milliseconds.max()}
+            return report
+
+
+class QueryServer(ThreadingHTTPServer):
+    """HTTP server answering coverage queries from a DatasetState held in memory. A background thread checks the
+    dataset and doorway files every reload_interval seconds and reloads the state when either changes, queries
+    keep being answered from the previous state while the new one loads.
+
+    Endpoints: /coverage (see DatasetState.coverage()), /metrics for the per-endpoint latencies and /status for the
+    loaded dataset.
+    """
+    daemon_threads = True
+
+    def __init__(self, address=(SERVER_HOST, SERVER_PORT), dataset_path=None, doorway_path=DOORWAY_FILE,
+                 reload_interval=RELOAD_INTERVAL):
+        self.dataset_path = dataset_path or default_dataset_path()
+        self.doorway_path = doorway_path
+        self.reload_interval = reload_interval
+        self.state = DatasetState(self.dataset_path, self.doorway_path)
+        self.metrics = LatencyMetrics()
+        self.reloads = 0
+        self._stopped = threading.Event()
+        self._watcher = threading.Thread(target=self._watch, daemon=True)
+        super().__init__(address, QueryHandler)
+        self._watcher.start()
+        logging.info("Serving %d smokes on %s:%d", len(self.state.table), *self.server_address[:2])
+
+    def _watch(self):
+        while not self._stopped.wait(self.reload_interval):
+            self.reload_if_changed()
+
+    def reload_if_changed(self):
+        """Reloads the state if the dataset or doorway file has changed since it was loaded, returns True if it did.
+        A failed reload is logged and the current state kept.
+        """
+        try:
+            if DatasetState.current_fingerprint(self.dataset_path, self.doorway_path) == self.state.fingerprint:
+                return False
+            state = DatasetState(self.dataset_path, self.doorway_path)
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Unable to reload dataset [{self.dataset_path}]: {e}")
+            return False
+        self.state = state
+        self.reloads += 1
+        logging.info("Reloaded %d smokes in %.2fs", len(state.table), state.load_seconds)
+        return True
+
+    def server_close(self):
+        self._stopped.set()
+        super().server_close()
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        start_time = time.perf_counter()
+        url = urllib.parse.urlsplit(self.path)
+        endpoint = url.path.strip("/") or "status"
+        status, body = 200, None
+        try:
+            if endpoint == "coverage":
+                body = self.server.state.coverage(urllib.parse.parse_qs(url.query))
+            elif endpoint == "metrics":
+                body = self.server.metrics.report()
+            elif endpoint == "status":
+                body = dict(self.server.state.summary(), reloads=self.server.reloads)
+            else:
+                status, body = 404, {"error": f"Unknown endpoint [{endpoint}]"}
+        except QueryError as e:
+            status, body = 400, {"error": str(e)}
+
+        elapsed = time.perf_counter() - start_time
+        if status != 404:
+            self.server.metrics.record(endpoint, elapsed, error=status != 200)
+        if isinstance(body, dict) and endpoint == "coverage":
+            body["latency_ms"] = elapsed * 1000
+        self.respond(status, body)
+
+    def respond(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+
+def serve(host=None, port=None, dataset_path=None, doorway_path=DOORWAY_FILE, reload_interval=None):
+    """Runs the query server until interrupted. The host, port and reload interval default to the [Server] section
+    of the config file.
+    """
+    config = SETTINGS.config
+    host = host or config.get("Server", "host", fallback=SERVER_HOST)
+    port = port or config.getint("Server", "port", fallback=SERVER_PORT)
+    reload_interval = reload_interval or config.getfloat("Server", "reload_interval", fallback=RELOAD_INTERVAL)
+    with QueryServer((host, port), dataset_path, doorway_path, reload_interval) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    configure_logging()
+    serve()
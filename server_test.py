@@ -0,0 +1,109 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+import urllib.error
+import urllib.parse
+import urllib.request
+import numpy as np
+
+from analysis import CoverageStats, assign_doorways, load_doorway_data, load_smoke_table
+from analysis_test import synthetic_records
+from server import QueryServer
+
+
+class TestQueryServer(unittest.TestCase):
+    """Tests coverage queries are answered from the dataset held in memory and the dataset is reloaded when its file
+    changes
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.dataset_path = os.path.join(self.temp_dir.name, "dataset.json")
+        self.doorway_path = os.path.join(self.temp_dir.name, "doorways.json")
+        self.write_dataset(synthetic_records(2000))
+        with open(self.doorway_path, 'w') as f:
+            json.dump({"a": {"x1": -300, "y1": -300, "x2": -200, "y2": -300, "z": 64.093811},
+                       "b": {"x1": 0, "y1": 0, "x2": 0, "y2": 150, "z": 64.093811}}, f)
+
+        # A long reload interval so the test controls when the files are checked
+        self.server = QueryServer(("127.0.0.1", 0), self.dataset_path, self.doorway_path, reload_interval=60)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.temp_dir.cleanup()
+
+    def write_dataset(self, records):
+        with open(self.dataset_path, 'w') as f:
+            json.dump(records, f)
+
+    def get(self, endpoint, params=()):
+        url = f"{self.base_url}/{endpoint}?{urllib.parse.urlencode(params)}"
+        with urllib.request.urlopen(url) as response:
+            return json.load(response)
+
+    def expected_stats(self):
+        table = load_smoke_table(self.dataset_path)
+        doorways = load_doorway_data(self.doorway_path)
+        assign_doorways(table, doorways, attach=False)
+        valid = ~np.isnan(table.coverage) & (table.doorway != None)  # noqa: E711
+        return CoverageStats.from_table(table), table.throw_time[valid], {d.name: d for d in doorways}
+
+    def test_filtered_queries(self):
+        stats, throw_time, doorways = self.expected_stats()
+        self.assertEqual(self.get("coverage")["stats"], stats.stats())
+
+        params = [("thrower", "player-1"), ("thrower", "player-2"), ("side", "T")]
+        self.assertEqual(self.get("coverage", params)["stats"],
+                         stats.stats({"thrower": ["player-1", "player-2"], "side": "T"}))
+
+        in_window = (throw_time >= 15) & (throw_time <= 60)
+        response = self.get("coverage", [("doorway", "b"), ("time_from", "00:15"), ("time_to", "60"),
+                                         ("by", "team,side")])
+        expected = stats.group_stats(("team", "side"), {"doorway": doorways["b"]}, in_window)
+        self.assertEqual({tuple(group.pop("key")): group for group in response["groups"]}, expected)
+        self.assertGreaterEqual(response["latency_ms"], 0)
+
+        self.assertIsNone(self.get("coverage", {"demo_id": "no-such-demo"})["stats"])
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            self.get("coverage", {"by": "colour"})
+        self.assertEqual(context.exception.code, 400)
+        context.exception.close()
+
+    def test_reload(self):
+        self.assertFalse(self.server.reload_if_changed())
+        self.write_dataset(synthetic_records(500, seed=1))
+        os.utime(self.dataset_path, ns=(0, 0))
+        self.assertTrue(self.server.reload_if_changed())
+
+        stats, _, _ = self.expected_stats()
+        self.assertEqual(self.get("coverage")["stats"], stats.stats())
+        status = self.get("status")
+        self.assertEqual((status["smokes"], status["reloads"]), (500, 1))
+
+        # A dataset which fails to load leaves the current one in place
+        with open(self.dataset_path, 'w') as f:
+            f.write("[{")
+        self.assertFalse(self.server.reload_if_changed())
+        self.assertEqual(self.get("status")["smokes"], 500)
+
+    def test_metrics(self):
+        for _ in range(5):
+            self.get("coverage", {"side": "CT"})
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            self.get("coverage", {"round_num": "first"})
+        context.exception.close()
+
+        metrics = self.get("metrics")["coverage"]
+        self.assertEqual((metrics["requests"], metrics["errors"]), (6, 1))
+        self.assertLessEqual(metrics["p50_ms"], metrics["p99_ms"])
+        self.assertLessEqual(metrics["p99_ms"], metrics["max_ms"])
+
+
+if __name__ == '__main__':
+    unittest.main()
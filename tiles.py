@@ -0,0 +1,288 @@
+import hashlib
+import json
+import logging
+import os
+import numpy as np
+
+import instrumentation
+from density import GridDensity
+
+TILE_CACHE_DIR = os.path.join("data", "tile_cache")
+
+# Rasters are recomputed if this changes, bump it when a layer is drawn differently. Only the most recently used
+# entries are kept.
+TILE_CACHE_VERSION = 1
+TILE_CACHE_ENTRIES = 256
+
+# Radar images are RADAR_SIZE pixels square, each zoom level doubles the raster resolution from BASE_RESOLUTION
+RADAR_SIZE = 1024
+BASE_RESOLUTION = 256
+ZOOM_LEVELS = (0, 1, 2)
+
+# Bandwidth adjustment of the heatmap density and the fraction of its maximum below which it isn't drawn, as used
+# by the notebook heatmaps
+HEATMAP_BW_ADJUST = 0.35
+DENSITY_THRESHOLD = 0.05
+
+# Doorway overlay line width and detection circle outline width, in radar pixels
+DOORWAY_LINE_WIDTH = 8
+DETECTION_LINE_WIDTH = 3
+
+
+def transform_positions(map_name, x, y, map_data=None):
+    """Vectorised form of awpy's position_transform(), converts arrays of in-game x and y coordinates to radar image
+    pixel coordinates. map_data defaults to awpy's MAP_DATA.
+    """
+    if map_data is None:
+        from awpy.data import MAP_DATA
+        map_data = MAP_DATA
+    radar = map_data[map_name]
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    return (x - radar["pos_x"]) / radar["scale"], (radar["pos_y"] - y) / radar["scale"]
+
+
+def resolution(zoom):
+    return BASE_RESOLUTION << zoom
+
+
+def filter_key(where=None):
+    """Canonical form of a filter (see SmokeTable.mask()), so the same filter always maps to the same tiles.
+    """
+    where = where or {}
+    canonical = {}
+    for key, values in where.items():
+        if isinstance(values, str) or not hasattr(values, "__iter__"):
+            values = [values]
+        canonical[key] = sorted(values, key=str)
+    return json.dumps(canonical, sort_keys=True, default=str)
+
+
+def _pixel_indexes(px, py, size):
+    """Flat raster index of each radar pixel coordinate at a resolution, -1 if it is off the radar.
+    """
+    scale = size / RADAR_SIZE
+    ix = np.floor(px * scale).astype(np.int64)
+    iy = np.floor(py * scale).astype(np.int64)
+    inside = (ix >= 0) & (ix < size) & (iy >= 0) & (iy < size)
+    return np.where(inside, iy * size + ix, -1)
+
+
+def density_raster(px, py, size, bw_adjust=HEATMAP_BW_ADJUST):
+    """Smoke density at the centre of every pixel of a size x size raster covering the radar, row 0 at the top.
+    """
+    if len(px) < 2:
+        return np.zeros((size, size))
+    half_pixel = RADAR_SIZE / size / 2
+    bounds = ((half_pixel, RADAR_SIZE - half_pixel),) * 2
+    return GridDensity(px, py, grid_size=size, bounds=bounds, bw_adjust=bw_adjust).density
+
+
+def coverage_raster(px, py, coverage, size):
+    """Mean coverage of the smokes landing in each pixel, NaN for pixels without any assigned smokes.
+    """
+    valid = ~np.isnan(coverage)
+    pixels = _pixel_indexes(px[valid], py[valid], size)
+    on_radar = pixels >= 0
+    counts = np.bincount(pixels[on_radar], minlength=size * size)
+    totals = np.bincount(pixels[on_radar], weights=coverage[valid][on_radar], minlength=size * size)
+    with np.errstate(invalid="ignore"):
+        return (totals / counts).reshape(size, size)
+
+
+def _segment_distance(px, py, x1, y1, x2, y2):
+    vx, vy = x2 - x1, y2 - y1
+    t = np.clip(((px - x1) * vx + (py - y1) * vy) / max(vx * vx + vy * vy, 1e-12), 0, 1)
+    dx, dy = px - (x1 + t * vx), py - (y1 + t * vy)
+    return np.sqrt(dx * dx + dy * dy)
+
+
+def overlay_raster(segments, circles, size):
+    """Opacity (0-1) of the doorway overlay at every pixel: a line along each (x1, y1, x2, y2) segment and the
+    outline of each (x, y, radius) detection circle, all in radar pixels.
+    """
+    centres = (np.arange(size) + 0.5) * (RADAR_SIZE / size)
+    px, py = np.meshgrid(centres, centres)
+    alpha = np.zeros((size, size))
+    for x, y, radius in circles:
+        ring = np.abs(np.sqrt((px - x)**2 + (py - y)**2) - radius) <= DETECTION_LINE_WIDTH / 2
+        alpha = np.maximum(alpha, ring * 0.5)
+    for x1, y1, x2, y2 in segments:
+        alpha = np.maximum(alpha, _segment_distance(px, py, x1, y1, x2, y2) <= DOORWAY_LINE_WIDTH / 2)
+    return alpha
+
+
+def default_cmap(kind):
+    """Colour map used for a layer when none is given, matching the notebook's colours. Requires matplotlib.
+    """
+    from matplotlib import colormaps
+    from matplotlib.colors import LinearSegmentedColormap, ListedColormap
+    if kind == "density":
+        return colormaps["turbo"]
+    if kind == "coverage":
+        return LinearSegmentedColormap.from_list("", ["#FF5151", "#FFC881", "#73FA7E"])
+    return ListedColormap(["#ff7575"])
+
+
+def colourise(raster, cmap, alpha=1.0, vmin=None, vmax=None):
+    """Maps a raster through a colour map (a callable such as a matplotlib colormap taking values from 0 to 1) to an
+    RGBA image. NaN pixels are transparent.
+    """
+    vmin = np.nanmin(raster) if vmin is None else vmin
+    vmax = np.nanmax(raster) if vmax is None else vmax
+    with np.errstate(invalid="ignore", divide="ignore"):
+        normalised = np.clip((raster - vmin) / (vmax - vmin), 0, 1)
+    rgba = np.array(cmap(np.nan_to_num(normalised)), dtype=np.float64)
+    rgba[..., 3] = np.where(np.isnan(raster), 0, rgba[..., 3] * alpha)
+    return rgba
+
+
+def composite(layers):
+    """Composites RGBA images (bottom layer first) with the alpha "over" operator.
+    """
+    layers = list(layers)
+    out_rgb = np.zeros(layers[0].shape[:2] + (3,))
+    out_alpha = np.zeros(layers[0].shape[:2])
+    for layer in layers:
+        alpha = layer[..., 3]
+        new_alpha = alpha + out_alpha * (1 - alpha)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            out_rgb = np.where(new_alpha[..., None] > 0,
+                               (layer[..., :3] * alpha[..., None] +
+                                out_rgb * (out_alpha * (1 - alpha))[..., None]) / new_alpha[..., None], 0)
+        out_alpha = new_alpha
+    return np.dstack((out_rgb, out_alpha))
+
+
+class TileCache():
+    """Rasters stored on disk as .npy files named by the hash of everything they depend on. Reading an entry marks it
+    as recently used, and only the max_entries most recently used entries are kept.
+    """
+
+    def __init__(self, cache_dir=TILE_CACHE_DIR, max_entries=TILE_CACHE_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+
+    def path(self, key):
+        digest = hashlib.sha256(json.dumps(dict(key, version=TILE_CACHE_VERSION), sort_keys=True).encode())
+        return os.path.join(self.cache_dir, f"{digest.hexdigest()}.npy")
+
+    def get(self, key, compute):
+        """Returns the cached raster for a key (a json serialisable dictionary), or computes and caches it.
+        """
+        path = self.path(key)
+        if os.path.exists(path):
+            try:
+                raster = np.load(path)
+                os.utime(path)
+                instrumentation.count("tiles.hits")
+                return raster
+            except (OSError, ValueError) as e:
+                logging.warning(f"Unable to read tile [{path}]: {e}")
+
+        instrumentation.count("tiles.misses")
+        raster = compute()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(path + ".tmp", 'wb') as f:
+            np.save(f, raster)
+        os.replace(path + ".tmp", path)
+        self.evict()
+        return raster
+
+    def evict(self):
+        entries = sorted((os.path.join(self.cache_dir, file) for file in os.listdir(self.cache_dir)
+                          if file.endswith(".npy")), key=os.path.getmtime, reverse=True)
+        for entry in entries[self.max_entries:]:
+            os.remove(entry)
+
+
+class MapTiles():
+    """Density, coverage and doorway overlay rasters for one map's smokes (a SmokeTable, with coverages if the
+    coverage layer is used) at each zoom level and filter, cached in a TileCache. The coordinates are transformed to
+    radar pixels once. dataset_key identifies the smokes in the cache keys (e.g. coverage_cache_key()), by default
+    the table's columns are hashed.
+    """
+    LAYERS = ("density", "coverage", "doorways")
+
+    def __init__(self, table, map_name, doorways=(), cache=None, map_data=None, dataset_key=None):
+        self.table = table
+        self.map_name = map_name
+        self.doorways = list(doorways)
+        self.cache = cache or TileCache()
+        if map_data is None:
+            from awpy.data import MAP_DATA
+            map_data = MAP_DATA
+        self.scale = map_data[map_name]["scale"]
+        self.px, self.py = transform_positions(map_name, table.x, table.y, map_data)
+        self.dataset_key = dataset_key or self._hash_table()
+
+        segments = np.array([(d.vector1.x, d.vector1.y, d.vector2.x, d.vector2.y) for d in self.doorways],
+                            dtype=np.float64).reshape(-1, 4)
+        x1, y1 = transform_positions(map_name, segments[:, 0], segments[:, 1], map_data)
+        x2, y2 = transform_positions(map_name, segments[:, 2], segments[:, 3], map_data)
+        self.segments = np.column_stack((x1, y1, x2, y2))
+        mx, my = transform_positions(map_name, [d.midpoint.x for d in self.doorways],
+                                     [d.midpoint.y for d in self.doorways], map_data)
+        self.circles = np.column_stack((mx, my, [d.target_radius / self.scale for d in self.doorways]))
+
+    def _hash_table(self):
+        digest = hashlib.sha256()
+        for array in (self.table.x, self.table.y, self.table.coverage, *self.table.codes.values()):
+            digest.update(np.ascontiguousarray(array).tobytes())
+        digest.update(json.dumps(self.table.categories, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def layer(self, kind, zoom=0, where=None):
+        """Returns the named raster (see LAYERS) at a zoom level for the smokes matching a filter.
+        """
+        size = resolution(zoom)
+        if kind == "doorways":
+            key = {"layer": kind, "map": self.map_name, "size": size,
+                   "segments": self.segments.round(3).tolist(), "circles": self.circles.round(3).tolist()}
+            return self.cache.get(key, lambda: overlay_raster(self.segments, self.circles, size))
+
+        key = {"layer": kind, "map": self.map_name, "size": size, "filter": filter_key(where),
+               "dataset": self.dataset_key}
+        if kind == "density":
+            def compute():
+                selection = self.table.mask(where or {})
+                return density_raster(self.px[selection], self.py[selection], size)
+        elif kind == "coverage":
+            def compute():
+                selection = self.table.mask(where or {})
+                return coverage_raster(self.px[selection], self.py[selection], self.table.coverage[selection], size)
+        else:
+            raise ValueError(f"Unknown layer [{kind}]")
+        return self.cache.get(key, compute)
+
+    def render(self, zoom=0, where=None, layers=("density", "doorways"), cmaps=None, alphas=None):
+        """Composites the cached layers into one RGBA image covering the radar (row 0 at the top), e.g. for
+        plt.imshow(image, extent=(0, 1024, 1024, 0)). cmaps gives each layer's colour map, by default turbo for the
+        density, red to green for the coverage and the doorway colour for the overlay. Densities below
+        DENSITY_THRESHOLD of the maximum are left transparent, as in the notebook heatmaps.
+        """
+        cmaps = cmaps or {}
+        alphas = dict({"density": 0.5, "coverage": 0.8, "doorways": 1.0}, **(alphas or {}))
+        images = []
+        for kind in layers:
+            raster = self.layer(kind, zoom, where)
+            cmap = cmaps.get(kind) or default_cmap(kind)
+            if kind == "density":
+                visible = np.where(raster >= DENSITY_THRESHOLD * raster.max(), raster, np.nan)
+                images.append(colourise(visible, cmap, alphas[kind], 0))
+            elif kind == "coverage":
+                images.append(colourise(raster, cmap, alphas[kind], 0, 100))
+            else:
+                image = np.empty(raster.shape + (4,))
+                image[...] = cmap(1.0)
+                image[..., 3] = raster * alphas[kind]
+                images.append(image)
+        return composite(images)
+
+    def warm(self, zooms=ZOOM_LEVELS, filters=(None,), layers=LAYERS):
+        """Precomputes the layers at every zoom level for each filter.
+        """
+        for where in filters:
+            for zoom in zooms:
+                for kind in layers:
+                    self.layer(kind, zoom, where)
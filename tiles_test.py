@@ -0,0 +1,86 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+
+import instrumentation
+from analysis import SmokeTable, assign_doorways
+from analysis_test import synthetic_records, synthetic_doorways
+from tiles import MapTiles, TileCache, composite, filter_key, transform_positions
+
+# Radar position and scale of the test map, in the format of awpy's MAP_DATA
+MAP_DATA = {"de_test": {"pos_x": -700, "pos_y": 700, "scale": 1.4}}
+
+
+def grey(values):
+    values = np.asarray(values, dtype=np.float64)
+    return np.stack((values, values, values, np.ones_like(values)), axis=-1)
+
+
+CMAPS = {"density": grey, "coverage": grey, "doorways": grey}
+
+
+class TestMapTiles(unittest.TestCase):
+    """Tests rasters are computed once per map, zoom and filter and served from the disk cache afterwards
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.table = SmokeTable.from_records(synthetic_records(2000))
+        assign_doorways(self.table, synthetic_doorways())
+        self.cache = TileCache(self.temp_dir.name, max_entries=6)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def tiles(self):
+        return MapTiles(self.table, "de_test", synthetic_doorways(), self.cache, MAP_DATA)
+
+    def test_transform_matches_position_transform(self):
+        x, y = transform_positions("de_test", self.table.x, self.table.y, MAP_DATA)
+        for i in range(0, len(self.table), 97):
+            self.assertEqual(x[i], (self.table.x[i] - -700) / 1.4)
+            self.assertEqual(y[i], (700 - self.table.y[i]) / 1.4)
+
+    def test_layers_cached(self):
+        where = {"side": "T", "thrower": ["player-1", "player-2"]}
+        with instrumentation.run("tiles", report_dir=None) as run:
+            first = self.tiles().render(zoom=1, where=where, layers=MapTiles.LAYERS, cmaps=CMAPS)
+            second = self.tiles().render(zoom=1, where=dict(reversed(list(where.items()))),
+                                         layers=MapTiles.LAYERS, cmaps=CMAPS)
+        self.assertEqual(first.shape, (512, 512, 4))
+        np.testing.assert_array_equal(first, second)
+        self.assertEqual(run.report()["counters"], {"tiles.misses": 3, "tiles.hits": 3})
+        self.assertNotEqual(filter_key(where), filter_key({"side": "T"}))
+
+    def test_coverage_layer(self):
+        tiles = self.tiles()
+        raster = tiles.layer("coverage", zoom=0, where={"side": "CT"})
+        mask = self.table.mask({"side": "CT"}) & ~np.isnan(self.table.coverage)
+        pixels = set(zip((tiles.px[mask] // 4).astype(int), (tiles.py[mask] // 4).astype(int)))
+        self.assertEqual(np.count_nonzero(~np.isnan(raster)), len(pixels))
+        self.assertAlmostEqual(np.nanmax(raster), np.max(self.table.coverage[mask]))
+
+    def test_least_recently_used_evicted(self):
+        tiles = self.tiles()
+        tiles.warm(zooms=(0, 1), filters=({"side": "T"},))
+        self.assertEqual(len(os.listdir(self.temp_dir.name)), 6)
+        with instrumentation.run("tiles", report_dir=None) as run:
+            tiles.layer("density", zoom=0, where={"side": "T"})
+            tiles.layer("density", zoom=2, where={"side": "T"})
+            self.assertEqual(len(os.listdir(self.temp_dir.name)), 6)
+            tiles.layer("density", zoom=0, where={"side": "T"})
+            tiles.layer("coverage", zoom=0, where={"side": "T"})
+        self.assertEqual(run.report()["counters"], {"tiles.hits": 2, "tiles.misses": 2})
+
+    def test_composite(self):
+        red = np.zeros((1, 1, 4))
+        red[..., 0], red[..., 3] = 1, 1
+        blue = np.zeros((1, 1, 4))
+        blue[..., 2], blue[..., 3] = 1, 0.5
+        np.testing.assert_allclose(composite([red, blue])[0, 0], [0.5, 0, 0.5, 1])
+        np.testing.assert_allclose(composite([blue, np.zeros((1, 1, 4))])[0, 0], [0, 0, 1, 0.5])
+
+
+if __name__ == '__main__':
+    unittest.main()
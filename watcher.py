@@ -0,0 +1,218 @@
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+import numpy as np
+
+import instrumentation
+import parser
+from analysis import (COLUMNAR_DATASET_DIR, COVERAGE_CACHE_DIR, DOORWAY_FILE, CoverageStats, SmokeTable,
+                      assign_doorways, cache_table_assignments, configure_logging, doorway_positions,
+                      load_doorway_data, load_table_assignments)
+from dataset import is_columnar_dataset
+
+# Seconds between scans of the demo directory, a demo is only parsed once it is unchanged between two scans so
+# demos which are still being downloaded or extracted are left alone
+POLL_INTERVAL = parser.config.getfloat("Watcher", "poll_interval", fallback=10.0)
+WATCHER_WORKERS = parser.config.getint("Watcher", "workers", fallback=parser.PARSER_WORKERS)
+
+# Most demos being parsed at once (by default twice the number of workers), the rest wait in the demo directory
+# until a worker is free so a burst of new demos is never all queued in memory
+MAX_PENDING = parser.config.getint("Watcher", "max_pending", fallback=0) or None
+
+
+def demo_id(demo_file):
+    return os.path.basename(demo_file).replace(".dem", "")
+
+
+class DemoWatcher():
+    """Watches the demo directory and adds the smokes from each new demo to the columnar dataset as it appears.
+
+    New demos are parsed by a fixed pool of worker processes (inline if workers is 1), with at most max_pending
+    demos parsed at once. Only the new smokes are assigned to the doorways and scored. Their rows are appended to
+    the dataset files in place and added to the coverage stats, neither is rebuilt for the existing smokes. The
+    coverage cache entry is the exception: it is keyed by the dataset's fingerprint, so a new entry holding the
+    assignments of the whole dataset (from memory, nothing is rescored) is written after each append, which lets
+    load_assigned_smokes() and the query server skip recomputing them. Demos already in the dataset are skipped,
+    changes to them aren't picked up (run parser.generate_dataset() to rebuild the dataset). Parsed smokes are also
+    stored in the parser's smoke cache, so a demo parsed before a restart isn't parsed again.
+    """
+
+    def __init__(self, demo_dir=parser.DEMO_DIR, dataset_path=COLUMNAR_DATASET_DIR, doorway_path=DOORWAY_FILE,
+                 smoke_cache_dir=parser.SMOKE_CACHE_DIR, coverage_cache_dir=COVERAGE_CACHE_DIR,
+                 workers=WATCHER_WORKERS, max_pending=MAX_PENDING):
+        self.demo_dir = demo_dir
+        self.dataset_path = dataset_path
+        self.doorway_path = doorway_path
+        self.smoke_cache_dir = smoke_cache_dir
+        self.coverage_cache_dir = coverage_cache_dir
+        self.workers = workers
+        self.max_pending = max_pending or max(workers, 1) * 2
+
+        self.doorways = load_doorway_data(doorway_path)
+        if is_columnar_dataset(dataset_path):
+            self.table = SmokeTable.load(dataset_path)
+            cached = load_table_assignments(self.table, self.doorways, dataset_path, doorway_path, coverage_cache_dir)
+            if not cached:
+                assign_doorways(self.table, self.doorways, attach=False)
+        else:
+            self.table, cached = SmokeTable.from_records([]), True
+        # Index of each smoke's doorway, extended by each append so the coverage cache is written without remapping
+        # the existing smokes
+        self.assigned = doorway_positions(self.table, self.doorways)
+        if not cached:
+            cache_table_assignments(self.table, self.doorways, dataset_path, doorway_path, coverage_cache_dir,
+                                    self.assigned)
+        self.manifest = parser.load_manifest(smoke_cache_dir)
+        self._stats = None
+
+        # Demos already ingested (or which failed to parse) with their fingerprint, the fingerprint of every other
+        # demo at the last scan and the demos being parsed
+        dataset_demos = set(self.table.categories["demo_id"])
+        self.ingested = {demo_file: None for demo_file in self._demo_files() if demo_id(demo_file) in dataset_demos}
+        self._seen = {}
+        self._pending = {}
+        self._executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    def _demo_files(self):
+        return sorted(os.path.join(self.demo_dir, file) for file in os.listdir(self.demo_dir)
+                      if file.endswith(".dem"))
+
+    @property
+    def stats(self):
+        """CoverageStats over the whole dataset, built from the assignments on first use and extended by each append.
+        """
+        if self._stats is None:
+            self._stats = CoverageStats.from_table(self.table)
+        return self._stats
+
+    def scan(self):
+        """Returns the demos which are new and unchanged since the last scan, in demo ID order.
+        """
+        ready = []
+        seen = {}
+        for demo_file in self._demo_files():
+            if demo_file in self.ingested or demo_file in self._pending:
+                continue
+            try:
+                seen[demo_file] = parser.demo_fingerprint(demo_file)
+            except OSError:
+                # Removed since the directory was listed
+                continue
+            if self._seen.get(demo_file) == seen[demo_file]:
+                ready.append(demo_file)
+        self._seen = seen
+        return ready
+
+    def poll(self):
+        """Scans the demo directory once, starts parsing new demos while fewer than max_pending are being parsed
+        and appends the smokes from every demo which has finished parsing. Returns the number of smokes appended.
+        """
+        parsed, failed = {}, {}
+        for demo_file in self.scan():
+            fingerprint = self._seen[demo_file]
+            if self.manifest.get(demo_file, {}).get("fingerprint") == fingerprint:
+                parsed[demo_file] = parser.load_shard(self.manifest, demo_file, self.smoke_cache_dir)
+                self.ingested[demo_file] = fingerprint
+            elif len(self._pending) < self.max_pending:
+                self._pending[demo_file] = (fingerprint, self._submit(demo_file))
+
+        done = {demo_file: future for demo_file, (_, future) in self._pending.items() if future.done()}
+        new = {}
+        for demo_file, future in done.items():
+            fingerprint, _ = self._pending.pop(demo_file)
+            self.ingested[demo_file] = fingerprint
+            try:
+                smokes, error, elapsed = future.result()
+            except Exception as e:
+                # The worker process itself died (e.g. killed or out of memory)
+                smokes, error, elapsed = None, f"{type(e).__name__}: {e}", None
+            if elapsed is not None:
+                instrumentation.record("parser.extract_smokes", elapsed)
+            if error is None:
+                logging.info(f"Extracted {len(smokes)} smokes from {demo_file}")
+                new[demo_file] = smokes
+            else:
+                logging.error(f"Failed to extract smokes from {demo_file} - {error}")
+                failed[demo_file] = error
+                instrumentation.count("watcher.demos_failed")
+
+        if new or failed:
+            parser.update_smoke_cache(self.manifest, new, failed, {demo_file: self.ingested[demo_file]
+                                                                   for demo_file in new}, self.smoke_cache_dir)
+        parsed.update(new)
+        return self.append([smoke for demo_file in sorted(parsed) for smoke in parsed[demo_file]])
+
+    def _submit(self, demo_file):
+        if self._executor is not None:
+            return self._executor.submit(parser.extract_demo, demo_file)
+
+        # Parsed inline and timed as a stage of this process by extract_demo(), wrapped in a completed future so
+        # both cases are collected the same way
+        smokes, error, _ = parser.extract_demo(demo_file)
+        future = Future()
+        future.set_result((smokes, error, None))
+        return future
+
+    @instrumentation.timed("watcher.append")
+    def append(self, records):
+        """Assigns and scores the new smokes, appends them to the dataset and the coverage stats and writes the
+        coverage cache entry for the grown dataset. Returns the number of smokes appended.
+        """
+        if len(records) == 0:
+            return 0
+        new = SmokeTable.from_records(records)
+        assign_doorways(new, self.doorways, attach=False)
+        self.table = SmokeTable.concatenate([self.table, new])
+        self.assigned = np.concatenate([self.assigned, doorway_positions(new, self.doorways)])
+        if self._stats is not None:
+            self._stats.extend(new)
+        self._save(new)
+
+        instrumentation.count("watcher.demos_ingested", len({record["demoID"] for record in records}))
+        instrumentation.count("watcher.smokes_appended", len(records))
+        logging.info(f"Appended {len(records)} smokes, the dataset now holds {len(self.table)}")
+        return len(records)
+
+    def _save(self, new):
+        """Appends the new smokes to the dataset files, or writes the dataset to a temporary directory and swaps it
+        in if there isn't one yet, then caches the assignments of the whole dataset.
+        """
+        if is_columnar_dataset(self.dataset_path):
+            new.append_to(self.dataset_path)
+        else:
+            temp_path = self.dataset_path + ".tmp"
+            shutil.rmtree(temp_path, ignore_errors=True)
+            self.table.save(temp_path)
+            shutil.rmtree(self.dataset_path, ignore_errors=True)
+            os.replace(temp_path, self.dataset_path)
+        cache_table_assignments(self.table, self.doorways, self.dataset_path, self.doorway_path,
+                                self.coverage_cache_dir, self.assigned)
+
+    def run(self, poll_interval=POLL_INTERVAL):
+        """Polls the demo directory until interrupted. Waits for the next demo to finish parsing, or the poll
+        interval, whichever is sooner.
+        """
+        logging.info(f"Watching [{self.demo_dir}] for new demos, {len(self.table)} smokes in the dataset")
+        try:
+            while True:
+                self.poll()
+                futures = [future for _, future in self._pending.values()]
+                if futures:
+                    wait(futures, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                else:
+                    time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+
+
+if __name__ == "__main__":
+    configure_logging()
+    DemoWatcher().run()
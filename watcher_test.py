@@ -0,0 +1,135 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+
+from analysis import CoverageStats, SmokeTable, assign_doorways, load_assigned_smokes, load_doorway_data
+from analysis_test import synthetic_records
+from watcher import DemoWatcher
+
+
+def fake_extract_smokes(demo_file):
+    """Stands in for the awpy parse, returns a set of synthetic smokes per demo and fails for demos named corrupt
+    """
+    name = os.path.basename(demo_file).replace(".dem", "")
+    if "corrupt" in name:
+        raise ValueError("Demo file is corrupt")
+    return [dict(record, demoID=name) for record in synthetic_records(200, seed=ord(name[-1]))]
+
+
+class TestDemoWatcher(unittest.TestCase):
+    """Tests new demos are parsed, scored and appended to the dataset as they appear, without reparsing or
+    rescoring the demos already in it
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.demo_dir = os.path.join(self.temp_dir.name, "demos")
+        self.dataset_path = os.path.join(self.temp_dir.name, "dataset_columns")
+        self.doorway_path = os.path.join(self.temp_dir.name, "doorways.json")
+        self.smoke_cache_dir = os.path.join(self.temp_dir.name, "smoke_cache")
+        self.coverage_cache_dir = os.path.join(self.temp_dir.name, "coverage_cache")
+        os.makedirs(self.demo_dir)
+        with open(self.doorway_path, 'w') as f:
+            json.dump({"a": {"x1": -300, "y1": -300, "x2": -200, "y2": -300, "z": 64.093811},
+                       "b": {"x1": 0, "y1": 0, "x2": 0, "y2": 150, "z": 64.093811}}, f)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write_demo(self, name, contents=b"demo"):
+        with open(os.path.join(self.demo_dir, name), 'wb') as f:
+            f.write(contents)
+
+    def watcher(self, max_pending=None):
+        return DemoWatcher(self.demo_dir, self.dataset_path, self.doorway_path, self.smoke_cache_dir,
+                           self.coverage_cache_dir, workers=1, max_pending=max_pending)
+
+    def poll(self, watcher):
+        with mock.patch("parser.extract_smokes", side_effect=fake_extract_smokes) as extract_smokes:
+            appended = watcher.poll()
+        return appended, sorted(os.path.basename(call.args[0]) for call in extract_smokes.call_args_list)
+
+    def test_new_demos_appended(self):
+        self.write_demo("demo-a.dem")
+        self.write_demo("demo-b.dem")
+        watcher = self.watcher()
+        # Demos are only parsed once they are unchanged between two scans
+        self.assertEqual(self.poll(watcher), (0, []))
+        self.assertEqual(self.poll(watcher), (400, ["demo-a.dem", "demo-b.dem"]))
+
+        # Later demos are appended to the dataset files and the stats in place, rather than rewriting them
+        self.assertEqual(watcher.stats.stats()["count"], len(watcher.stats))
+        self.write_demo("demo-c.dem")
+        self.poll(watcher)
+        column_file = os.path.join(self.dataset_path, "x.npy")
+        inode = os.stat(column_file).st_ino
+        with mock.patch.object(SmokeTable, "save") as save, \
+                mock.patch.object(CoverageStats, "from_table") as from_table:
+            self.assertEqual(self.poll(watcher), (200, ["demo-c.dem"]))
+        self.assertFalse(save.called)
+        self.assertFalse(from_table.called)
+        self.assertEqual(os.stat(column_file).st_ino, inode)
+        self.assertEqual(self.poll(watcher), (0, []))
+
+        # The appended dataset and its cached assignments match scoring every smoke from scratch
+        names = ("demo-a.dem", "demo-b.dem", "demo-c.dem")
+        records = [smoke for name in names for smoke in fake_extract_smokes(name)]
+        expected = SmokeTable.from_records(records)
+        assign_doorways(expected, load_doorway_data(self.doorway_path), attach=False)
+        table = SmokeTable.load(self.dataset_path)
+        np.testing.assert_array_equal(table.x, expected.x)
+        self.assertEqual([smoke.demo_id for smoke in table], [smoke.demo_id for smoke in expected])
+
+        with mock.patch("analysis.assign_doorways", side_effect=assign_doorways) as assign:
+            _, _, valid_smokes = load_assigned_smokes(self.dataset_path, self.doorway_path, self.coverage_cache_dir)
+        self.assertFalse(assign.called)
+        self.assertEqual([(smoke.doorway.name, smoke.coverage) for smoke in valid_smokes],
+                         [(doorway.name, coverage) for doorway, coverage in zip(expected.doorway, expected.coverage)
+                          if doorway is not None])
+        self.assertEqual(watcher.stats.stats()["count"], len(valid_smokes))
+
+        # The extended stats match building them from the whole dataset
+        rebuilt = CoverageStats.from_table(expected)
+        self.assertEqual(watcher.stats.stats(), rebuilt.stats())
+        self.assertEqual(watcher.stats.group_stats(("demo_id", "side", "round_num")),
+                         rebuilt.group_stats(("demo_id", "side", "round_num")))
+        self.assertEqual({doorway.name: stats for doorway, stats in watcher.stats.group_stats("doorway").items()},
+                         {doorway.name: stats for doorway, stats in rebuilt.group_stats("doorway").items()})
+
+    def test_backpressure(self):
+        for name in ("demo-a.dem", "demo-b.dem", "demo-c.dem"):
+            self.write_demo(name)
+        watcher = self.watcher(max_pending=1)
+        self.poll(watcher)
+        with mock.patch.object(watcher, "_pending", {"demo-busy.dem": (None, mock.Mock(done=lambda: False))}):
+            # No demos are started while the only slot is taken
+            self.assertEqual(self.poll(watcher), (0, []))
+        parsed = [self.poll(watcher)[1] for _ in range(4)]
+        self.assertEqual(parsed, [["demo-a.dem"], ["demo-b.dem"], ["demo-c.dem"], []])
+
+    def test_restart(self):
+        self.write_demo("demo-a.dem")
+        self.write_demo("corrupt.dem")
+        watcher = self.watcher()
+        self.poll(watcher)
+        self.assertEqual(self.poll(watcher), (200, ["corrupt.dem", "demo-a.dem"]))
+
+        # Demos in the dataset are skipped after a restart, failed demos are retried
+        watcher = self.watcher()
+        self.poll(watcher)
+        self.assertEqual(self.poll(watcher), (0, ["corrupt.dem"]))
+
+        # Demos which have been parsed before are read from the smoke cache
+        shutil.rmtree(self.dataset_path)
+        watcher = self.watcher()
+        self.poll(watcher)
+        self.assertEqual(self.poll(watcher), (200, ["corrupt.dem"]))
+        self.assertEqual(len(SmokeTable.load(self.dataset_path)), 200)
+
+
+if __name__ == '__main__':
+    unittest.main()